@@ -0,0 +1,474 @@
+import sys
+import numpy as np
+
+#non-standard imports
+try:
+    import pandas as pd
+except ModuleNotFoundError as err:
+    print(err)
+    print("\n\n")
+    print("Missing module is likely not part of standard dunedaq releases.")
+    print("\n")
+    print("Please install the missing module and try again.")
+    sys.exit(1)
+except:
+    raise
+
+
+def channel_stats_key(det_data_key):
+    """
+    df_dict key of the accumulated channel statistics for a detector data key,
+    e.g. detd_kHD_TPC_kWIBEth -> chst_kHD_TPC_kWIBEth.
+    """
+    return "chst"+det_data_key[len("detd"):]
+
+def adc_histogram_key(det_waveform_key):
+    """
+    df_dict key of the accumulated ADC histograms for a waveform key,
+    e.g. detw_kHD_TPC_kWIBEth -> adch_kHD_TPC_kWIBEth.
+    """
+    return "adch"+det_waveform_key[len("detw"):]
+
+def _get_column(rows,name):
+    if isinstance(rows,pd.DataFrame):
+        if name in rows.index.names:
+            return np.asarray(rows.index.get_level_values(name))
+        return rows[name].values
+    return np.array([ getattr(r,name) for r in rows ])
+
+def _info_array(values):
+    #labels such as apa names are kept as python objects, not fixed-width strings
+    values = np.asarray(values)
+    return values.astype(object) if values.dtype.kind in "US" else values
+
+class ChannelStatsAccumulator:
+    """
+    Running per-channel mean and variance of per-record statistics (by default
+    adc_rms and adc_mean), updated as records stream in.
+
+    Each batch is reduced per channel to (count, mean, M2) and folded in with
+    the parallel Welford update (Chan et al.), so accumulators filled by
+    different workers or from different files merge to the same result as a
+    single pass over all rows. Non-finite values are skipped, as in pandas.
+    Info columns (apa, plane) keep their input dtype and the first value seen
+    for each channel.
+    """
+
+    def __init__(self,stat_names=("adc_rms","adc_mean"),info_names=("apa","plane")):
+        self.stat_names = list(stat_names)
+        self.info_names = list(info_names)
+        self.channels = np.empty(0,dtype=np.int64) #sorted
+        self.n = { s: np.empty(0,dtype=np.int64) for s in self.stat_names }
+        self.mean = { s: np.empty(0) for s in self.stat_names }
+        self.m2 = { s: np.empty(0) for s in self.stat_names }
+        self.info = { name: np.empty(0,dtype=np.int64) for name in self.info_names }
+        self.n_updates = 0
+
+    def __len__(self):
+        return len(self.channels)
+
+    def _combine(self,channels,n,mean,m2,info):
+        all_channels = np.union1d(self.channels,channels)
+        idx_a = np.searchsorted(all_channels,self.channels)
+        idx_b = np.searchsorted(all_channels,channels)
+
+        for s in self.stat_names:
+            n_a = np.zeros(len(all_channels),dtype=np.int64)
+            n_b = np.zeros(len(all_channels),dtype=np.int64)
+            mean_a = np.zeros(len(all_channels))
+            mean_b = np.zeros(len(all_channels))
+            m2_tot = np.zeros(len(all_channels))
+            n_a[idx_a] = self.n[s]
+            n_b[idx_b] = n[s]
+            mean_a[idx_a] = self.mean[s]
+            mean_b[idx_b] = mean[s]
+            m2_tot[idx_a] += self.m2[s]
+            m2_tot[idx_b] += m2[s]
+
+            n_tot = n_a+n_b
+            has = n_tot>0
+            delta = mean_b-mean_a
+            mean_tot = mean_a.copy()
+            mean_tot[has] += delta[has]*n_b[has]/n_tot[has]
+            m2_tot[has] += delta[has]**2*n_a[has]*n_b[has]/n_tot[has]
+
+            self.n[s] = n_tot
+            self.mean[s] = mean_tot
+            self.m2[s] = m2_tot
+
+        for name in self.info_names:
+            values_a, values_b = self.info[name], _info_array(info[name])
+            if len(values_a)==0:
+                dtype = values_b.dtype
+            elif values_a.dtype==values_b.dtype:
+                dtype = values_a.dtype
+            else:
+                dtype = object
+            values = np.empty(len(all_channels),dtype=dtype)
+            values[idx_b] = values_b
+            values[idx_a] = values_a
+            self.info[name] = values
+
+        self.channels = all_channels
+
+    def update_arrays(self,channels,values,info=None):
+        """
+        Fold in one batch of rows: channels, {stat: values} and {info: values}
+        as parallel arrays.
+        """
+        channels = np.asarray(channels,dtype=np.int64)
+        if len(channels)==0:
+            return self
+        batch_channels, first, inverse = np.unique(channels,return_index=True,return_inverse=True)
+
+        n, mean, m2 = {}, {}, {}
+        for s in self.stat_names:
+            x = np.asarray(values[s],dtype=np.float64)
+            good = np.isfinite(x)
+            x = np.where(good,x,0.)
+            n[s] = np.bincount(inverse,weights=good,minlength=len(batch_channels)).astype(np.int64)
+            sums = np.bincount(inverse,weights=x,minlength=len(batch_channels))
+            mean[s] = np.divide(sums,n[s],out=np.zeros(len(batch_channels)),where=n[s]>0)
+            m2[s] = np.bincount(inverse,weights=np.where(good,(x-mean[s][inverse])**2,0.),minlength=len(batch_channels))
+
+        batch_info = {}
+        for name in self.info_names:
+            if info is not None and name in info:
+                batch_info[name] = _info_array(info[name])[first]
+            else:
+                batch_info[name] = np.zeros(len(batch_channels),dtype=np.int64)
+
+        self._combine(batch_channels,n,mean,m2,batch_info)
+        self.n_updates += 1
+        return self
+
+    def update(self,rows):
+        """
+        Fold in detector data rows, as a list of dataclasses or a DataFrame.
+        """
+        if len(rows)==0:
+            return self
+        return self.update_arrays(_get_column(rows,"channel"),
+                                  { s: _get_column(rows,s) for s in self.stat_names },
+                                  { name: _get_column(rows,name) for name in self.info_names })
+
+    def merge(self,other):
+        """
+        Fold in another accumulator, e.g. from another worker or file.
+        """
+        if len(other)>0:
+            self._combine(other.channels,other.n,other.mean,other.m2,other.info)
+            self.n_updates += other.n_updates
+        return self
+
+    def get_std(self,stat):
+        return np.sqrt(np.divide(self.m2[stat],self.n[stat]-1,
+                                 out=np.full(len(self.channels),np.nan),where=self.n[stat]>1))
+
+    def to_dataframe(self):
+        """
+        One row per channel: channel, the info columns, and for each statistic
+        its mean (under the statistic's name), count and sample std.
+        """
+        data = { "channel": self.channels }
+        for name in self.info_names:
+            data[name] = self.info[name]
+        for s in self.stat_names:
+            data[s] = np.where(self.n[s]>0,self.mean[s],np.nan)
+            data[f'{s}_n'] = self.n[s]
+            data[f'{s}_std'] = self.get_std(s)
+        return pd.DataFrame(data)
+
+    def new_empty(self):
+        return ChannelStatsAccumulator(self.stat_names,self.info_names)
+
+class ChannelADCHistogram:
+    """
+    Per-channel histograms of raw ADC samples (14-bit by default), filled from
+    waveform rows.
+
+    Each channel keeps a window of uint32 bins, one per ADC code, starting at
+    an origin set below its mean ADC when the channel is first filled and
+    rounded down to a multiple of window//4, so histograms filled
+    independently mostly share origins. The few samples outside the window
+    (signals, glitches) are kept sparsely, as one count per (channel, code).
+    With the default 512 bins, 10240 channels take about 21 MB plus the sparse
+    counts.
+
+    Histograms add bin by bin, re-binning where origins differ, so records,
+    threads and processes can be merged in any order, and run-level medians,
+    percentiles, extrema and stuck-bit diagnostics are exact without keeping
+    any waveforms.
+    """
+
+    #bins per bincount or cumsum block, to bound the temporary arrays
+    block_bins = 1<<22
+
+    def __init__(self,n_bits=14,window=512,adc_name="adcs",stuck_low_bits=6):
+        self.n_bits = n_bits
+        self.n_codes = 1<<n_bits
+        self.window = min(window,self.n_codes)
+        self.adc_name = adc_name
+        self.stuck_low_bits = stuck_low_bits
+        self.channels = np.empty(0,dtype=np.int64) #sorted
+        self.origins = np.empty(0,dtype=np.int64)  #ADC code of the first bin
+        self.counts = np.zeros((0,self.window),dtype=np.uint32)
+        self.adc_min = np.empty(0,dtype=np.int64)
+        self.adc_max = np.empty(0,dtype=np.int64)
+        #samples outside the window: sorted unique channel*n_codes+code, and counts
+        self.outside_keys = np.empty(0,dtype=np.int64)
+        self.outside_counts = np.empty(0,dtype=np.uint64)
+        self._pending = []
+        self.n_updates = 0
+
+    def __len__(self):
+        return len(self.channels)
+
+    def new_empty(self):
+        return ChannelADCHistogram(self.n_bits,self.window,self.adc_name,self.stuck_low_bits)
+
+    def _get_origins(self,means):
+        step = max(1,self.window//4)
+        origins = np.floor((means-self.window/2)/step).astype(np.int64)*step
+        return np.clip(origins,0,self.n_codes-self.window)
+
+    def _is_stuck(self,codes):
+        low = codes&((1<<self.stuck_low_bits)-1)
+        return (low==0)|(low==(1<<self.stuck_low_bits)-1)
+
+    def _add_channels(self,channels,origins):
+        """
+        Rows of the (sorted, unique) channels, adding the new ones with the
+        given origins.
+        """
+        is_new = ~np.isin(channels,self.channels)
+        if is_new.any():
+            all_channels = np.union1d(self.channels,channels[is_new])
+            old = np.searchsorted(all_channels,self.channels)
+            new = np.searchsorted(all_channels,channels[is_new])
+            def grow(values,fill):
+                out = np.full((len(all_channels),)+values.shape[1:],fill,dtype=values.dtype)
+                out[old] = values
+                return out
+            self.origins = grow(self.origins,0)
+            self.origins[new] = origins[is_new]
+            self.counts = grow(self.counts,0)
+            self.adc_min = grow(self.adc_min,np.iinfo(np.int64).max)
+            self.adc_max = grow(self.adc_max,-1)
+            self.channels = all_channels
+        return np.searchsorted(self.channels,channels)
+
+    def _add_outside(self,channels,codes,counts):
+        self._pending.append((channels*self.n_codes+codes,counts))
+        if sum([ len(keys) for keys, _ in self._pending ])>max(1<<20,len(self.outside_keys)):
+            self._consolidate()
+
+    def _consolidate(self):
+        if len(self._pending)==0:
+            return
+        keys = np.concatenate([self.outside_keys]+[ keys for keys, _ in self._pending ])
+        counts = np.concatenate([self.outside_counts]+[ counts for _, counts in self._pending ])
+        self._pending = []
+        self.outside_keys, inverse = np.unique(keys,return_inverse=True)
+        self.outside_counts = np.zeros(len(self.outside_keys),dtype=np.uint64)
+        np.add.at(self.outside_counts,inverse,counts)
+
+    def get_outside(self):
+        """
+        (rows, codes, counts) of the samples outside the windows, sorted by
+        row and code.
+        """
+        self._consolidate()
+        return (np.searchsorted(self.channels,self.outside_keys//self.n_codes),
+                self.outside_keys%self.n_codes, self.outside_counts)
+
+    def update_arrays(self,channels,adcs,lengths):
+        """
+        Fill with one batch of waveforms: the channel of each row, the
+        concatenated ADC samples of all rows, and the number of samples per row.
+        """
+        channels = np.asarray(channels,dtype=np.int64)
+        lengths = np.asarray(lengths,dtype=np.int64)
+        if len(channels)==0 or lengths.sum()==0:
+            return self
+        adcs = np.asarray(adcs).astype(np.int64)
+        batch_channels, row_index = np.unique(channels,return_inverse=True)
+        sample_index = np.repeat(row_index,lengths)
+
+        #new channels get their window around the mean of this batch
+        n_batch = np.bincount(row_index,weights=lengths,minlength=len(batch_channels))
+        has = n_batch>0
+        means = np.zeros(len(batch_channels))
+        if not np.isin(batch_channels[has],self.channels).all():
+            means = np.bincount(sample_index,weights=adcs,minlength=len(batch_channels))/np.maximum(n_batch,1)
+        batch_rows = np.full(len(batch_channels),-1,dtype=np.int64)
+        batch_rows[has] = self._add_channels(batch_channels[has],self._get_origins(means[has]))
+
+        #extrema per waveform row, then per channel
+        nonempty = lengths>0
+        starts = np.concatenate(([0],np.cumsum(lengths)[:-1]))[nonempty]
+        np.minimum.at(self.adc_min,batch_rows[row_index[nonempty]],np.minimum.reduceat(adcs,starts))
+        np.maximum.at(self.adc_max,batch_rows[row_index[nonempty]],np.maximum.reduceat(adcs,starts))
+
+        sample_rows = batch_rows[sample_index]
+        bins = adcs-self.origins[sample_rows]
+        inside = (bins>=0)&(bins<self.window)
+        if not inside.all():
+            self._add_outside(self.channels[sample_rows[~inside]],adcs[~inside],
+                              np.ones(np.count_nonzero(~inside),dtype=np.uint64))
+
+        #count over the span of rows this batch touches, in blocks of block_bins
+        first_row = batch_rows[has].min()
+        keys = (sample_rows[inside]-first_row)*self.window+bins[inside]
+        flat_counts = self.counts[first_row:batch_rows.max()+1].reshape(-1)
+        for lo in range(0,len(flat_counts),self.block_bins):
+            hi = min(lo+self.block_bins,len(flat_counts))
+            block_keys = keys if (lo==0 and hi==len(flat_counts)) else keys[(keys>=lo)&(keys<hi)]-lo
+            flat_counts[lo:hi] += np.bincount(block_keys,minlength=hi-lo).astype(np.uint32)
+
+        self.n_updates += 1
+        return self
+
+    def update(self,rows):
+        """
+        Fill from waveform rows, as a list of dataclasses or a DataFrame.
+        """
+        if len(rows)==0:
+            return self
+        channels = _get_column(rows,"channel")
+        if isinstance(rows,pd.DataFrame):
+            waveforms = rows[self.adc_name].values
+        else:
+            waveforms = [ getattr(r,self.adc_name) for r in rows ]
+        waveforms = [ np.atleast_1d(w) if w is not None else np.empty(0,dtype=np.int64) for w in waveforms ]
+        lengths = np.fromiter((len(w) for w in waveforms),dtype=np.int64,count=len(waveforms))
+        return self.update_arrays(channels,np.concatenate(waveforms),lengths)
+
+    def merge(self,other):
+        """
+        Add another histogram set, e.g. from another worker or file.
+        """
+        if (other.n_bits,other.window)!=(self.n_bits,self.window):
+            raise ValueError(f"Cannot merge ADC histograms of {other.n_bits} bits and {other.window} bins into {self.n_bits} bits and {self.window} bins")
+        if len(other)==0:
+            return self
+        rows = self._add_channels(other.channels,other.origins)
+        shifts = other.origins-self.origins[rows]
+        same = shifts==0
+        self.counts[rows[same]] += other.counts[same]
+        for i in np.nonzero(~same)[0]:
+            codes = other.origins[i]+np.arange(self.window)
+            bins = codes-self.origins[rows[i]]
+            inside = (bins>=0)&(bins<self.window)
+            self.counts[rows[i],bins[inside]] += other.counts[i,inside]
+            outside = ~inside&(other.counts[i]>0)
+            self._add_outside(np.full(np.count_nonzero(outside),other.channels[i]),codes[outside],
+                              other.counts[i,outside].astype(np.uint64))
+
+        #the other's sparse samples may fall inside this histogram's windows
+        other_rows, codes, counts = other.get_outside()
+        other_rows = rows[other_rows]
+        bins = codes-self.origins[other_rows]
+        inside = (bins>=0)&(bins<self.window)
+        np.add.at(self.counts,(other_rows[inside],bins[inside]),counts[inside].astype(np.uint32))
+        self._add_outside(self.channels[other_rows[~inside]],codes[~inside],counts[~inside])
+
+        self.adc_min[rows] = np.minimum(self.adc_min[rows],other.adc_min)
+        self.adc_max[rows] = np.maximum(self.adc_max[rows],other.adc_max)
+        self.n_updates += other.n_updates
+        return self
+
+    def _row_blocks(self):
+        rows_per_block = max(1,self.block_bins//self.window)
+        for lo in range(0,len(self.channels),rows_per_block):
+            yield slice(lo,min(lo+rows_per_block,len(self.channels)))
+
+    def _outside_sums(self,rows,weights):
+        return np.bincount(rows,weights=weights,minlength=len(self.channels)).astype(np.uint64)
+
+    def get_n(self):
+        rows, _, counts = self.get_outside()
+        return self.counts.sum(axis=1,dtype=np.uint64)+self._outside_sums(rows,counts)
+
+    def get_percentile(self,q):
+        """
+        ADC code at percentile q of each channel (the smallest code whose
+        cumulative count reaches q% of the samples); -1 for empty channels.
+        """
+        out_rows, out_codes, out_counts = self.get_outside()
+        below = out_codes<self.origins[out_rows]
+        n_below = self._outside_sums(out_rows[below],out_counts[below])
+        n_inside = self.counts.sum(axis=1,dtype=np.uint64)
+        n = n_inside+self._outside_sums(out_rows,out_counts)
+        target = np.maximum(np.ceil(n*(q/100.)),1).astype(np.uint64)
+
+        codes = np.full(len(self.channels),-1,dtype=np.int64)
+        for rows in self._row_blocks():
+            cumsum = np.cumsum(self.counts[rows],axis=1,dtype=np.uint64)
+            cumsum += n_below[rows,None]
+            codes[rows] = self.origins[rows]+(cumsum<target[rows,None]).sum(axis=1)
+
+        #percentiles below or above the window come from the sparse counts
+        if len(out_rows)>0:
+            cumsum = np.cumsum(out_counts)
+            cumsum -= (cumsum-out_counts)[np.searchsorted(out_rows,out_rows)]
+            cumsum += np.where(below,np.uint64(0),n_inside[out_rows])
+            hit = cumsum>=target[out_rows]
+            hit_rows, first = np.unique(out_rows[hit],return_index=True)
+            is_outside = (target[hit_rows]<=n_below[hit_rows])|(target[hit_rows]>n_below[hit_rows]+n_inside[hit_rows])
+            codes[hit_rows[is_outside]] = out_codes[hit][first[is_outside]]
+        return np.where(n>0,codes,-1)
+
+    def get_median(self):
+        return self.get_percentile(50)
+
+    def get_min(self):
+        return np.where(self.get_n()>0,self.adc_min,-1)
+
+    def get_max(self):
+        return np.where(self.get_n()>0,self.adc_max,-1)
+
+    def get_bit_fractions(self):
+        """
+        Fraction of samples with each ADC bit set, shape (channels, n_bits).
+        A bit stuck at 0 or 1 shows up as 0 or 1 on channels with a wide spread.
+        """
+        out_rows, out_codes, out_counts = self.get_outside()
+        bit_counts = np.zeros((len(self.channels),self.n_bits))
+        for bit in range(self.n_bits):
+            bit_counts[:,bit] = self._outside_sums(out_rows,((out_codes>>bit)&1)*out_counts)
+        for rows in self._row_blocks():
+            codes = self.origins[rows,None]+np.arange(self.window)
+            for bit in range(self.n_bits):
+                bit_counts[rows,bit] += np.where((codes>>bit)&1,self.counts[rows],0).sum(axis=1,dtype=np.uint64)
+        n = self.get_n().astype(np.float64)
+        return np.divide(bit_counts,n[:,None],out=np.full((len(self.channels),self.n_bits),np.nan),where=n[:,None]>0)
+
+    def get_stuck_code_fraction(self):
+        """
+        Fraction of samples whose stuck_low_bits lowest bits are all 0 or all
+        1, the usual signature of stuck ADC codes.
+        """
+        out_rows, out_codes, out_counts = self.get_outside()
+        stuck = self._is_stuck(out_codes)
+        stuck_counts = self._outside_sums(out_rows[stuck],out_counts[stuck]).astype(np.float64)
+        for rows in self._row_blocks():
+            codes = self.origins[rows,None]+np.arange(self.window)
+            stuck_counts[rows] += np.where(self._is_stuck(codes),self.counts[rows],0).sum(axis=1,dtype=np.uint64)
+        n = self.get_n().astype(np.float64)
+        return np.divide(stuck_counts,n,out=np.full(len(self.channels),np.nan),where=n>0)
+
+    def to_dataframe(self,percentiles=()):
+        """
+        One row per channel: sample count, adc_min, adc_max, adc_median,
+        any extra percentiles (as adc_p<q>) and the stuck code fraction.
+        """
+        data = { "channel": self.channels,
+                 "n_samples": self.get_n(),
+                 "adc_min": self.get_min(),
+                 "adc_max": self.get_max(),
+                 "adc_median": self.get_median() }
+        for q in percentiles:
+            data[f'adc_p{q:g}'] = self.get_percentile(q)
+        data["stuck_code_fraction"] = self.get_stuck_code_fraction()
+        return pd.DataFrame(data)
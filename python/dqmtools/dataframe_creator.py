@@ -1,5 +1,6 @@
 import rawdatautils.unpack.utils
 import detdataformats
+import daqdataformats
 import hdf5libs
 import h5py
 
@@ -9,8 +10,14 @@ import numpy.fft
 from datetime import datetime
 import pytz
 import concurrent.futures
+import multiprocessing
+import threading
+import queue
+import time
 
 from rawdatautils.unpack.dataclasses import *
+from dqmtools.dataframe_dict import DataFrameDict
+from dqmtools.record_cache import get_file_fingerprint
 
 #non-standard imports
 try:
@@ -115,24 +122,165 @@ def get_fragment_unpacker(frag_type, det_id, op_env, ana_data_prescale, wvfm_dat
     else:
         return None
     
-def process_source_id(h5_file, sid, record_index, op_env, ana_data_prescale, wvfm_data_prescale):
+def get_type_string(frag_type, det_id):
+    return f'{detdataformats.DetID.Subdetector(det_id).name}_{frag_type.name}'
 
-    sid_unpacker = rawdatautils.unpack.utils.SourceIDUnpacker(record_index)
-    return_dict = sid_unpacker.get_all_data(sid)
+def parse_data_key(key):
+    """
+    Split a df_dict key into its prefix and fragment type string, e.g.
+    detd_kHD_TPC_kWIBEth -> ("detd", "kHD_TPC_kWIBEth"); ("frh", None) for
+    keys not tied to a fragment type.
+    """
+    prefix, sep, type_string = key.partition("_")
+    if sep=="" or not type_string.startswith("k"):
+        return prefix, None
+    return prefix, type_string
+
+#prefixes of keys holding decoded detector or trigger data rather than headers
+DATA_KEY_PREFIXES = ["detd","detw","chst","adch","trgd"]
+
+#keys holding the headers of every fragment type; frh_<qualifier> and daqh_<qualifier>
+#declare that only the types matching a detector (kHD_PDS), a fragment type (kDAPHNE)
+#or both (kHD_PDS_kDAPHNE) are read
+HEADER_KEY_PREFIXES = ["frh","daqh"]
+
+def matches_type_string(type_string,qualifier):
+    return (type_string==qualifier or type_string.startswith(qualifier+"_")
+            or type_string.endswith("_"+qualifier))
+
+class UnpackFilter:
+    """
+    Which parts of a record to unpack, built from the df_dict keys the
+    configured tests read (DQMTest.get_input_keys()); keys=None keeps
+    everything.
+
+    - trigger record headers (trh) are only unpacked if requested;
+    - fragments are only read and decoded for the fragment types named in
+      per-type keys (deth_/detd_/detw_/trgd_<det>_<fragment type>) or matching
+      qualified header keys (frh_<qualifier>, daqh_<qualifier>); plain frh or
+      daqh keeps every fragment type, and no key keeps none;
+    - detector data (detd_, and the chst_ channel statistics built from it) and
+      waveforms (detw_, and the adch_ ADC histograms built from them) are
+      switched off per type, by a None prescale, unless requested.
+
+    headers_only=True is the quick-look mode: only header keys (trh, frh, daqh,
+    deth_) are kept, no detector data or waveforms are decoded for any type,
+    and trigger (TP/TA/TC) fragments, whose content is all data, are skipped.
+    """
+
+    def __init__(self,keys=None,headers_only=False):
+        self.headers_only = headers_only
+        if keys is not None and headers_only:
+            keys = [ key for key in keys if parse_data_key(key)[0] not in DATA_KEY_PREFIXES ]
+        self.keys = None if keys is None else set(keys)
+        self.type_levels = {}
+        self.header_qualifiers = set()
+        self.all_headers = self.keys is None
+        if self.keys is not None:
+            for key in self.keys:
+                prefix, type_string = parse_data_key(key)
+                if prefix in HEADER_KEY_PREFIXES:
+                    if type_string is None:
+                        self.all_headers = True
+                    else:
+                        self.header_qualifiers.add(type_string)
+                elif type_string is not None:
+                    self.type_levels.setdefault(type_string,set()).add(prefix)
+
+    @classmethod
+    def quick_look(cls,keys=None):
+        """
+        Headers-only filter, for scanning many records at high rate.
+        """
+        return cls(keys,headers_only=True)
+
+    def get_signature(self):
+        keys = None if self.keys is None else tuple(sorted(self.keys))
+        return (keys,"headers_only") if self.headers_only else keys
+
+    def needs_trh(self):
+        return self.keys is None or "trh" in self.keys
+
+    def needs_fragments(self):
+        return self.all_headers or len(self.type_levels)>0 or len(self.header_qualifiers)>0
 
+    def accepts_subsystem(self,subsystem):
+        if subsystem==daqdataformats.SourceID.Subsystem.kTRBuilder:
+            return self.needs_trh()
+        if self.headers_only and subsystem==daqdataformats.SourceID.Subsystem.kTrigger:
+            return False
+        return self.needs_fragments()
+
+    def accepts_fragment(self,type_string):
+        if self.all_headers or type_string in self.type_levels:
+            return True
+        return any([ matches_type_string(type_string,q) for q in self.header_qualifiers ])
+
+    def get_fragment_types(self):
+        """
+        Names of the fragment types to read, or None for all (or when a header
+        key only names a detector, so the types are not known before reading).
+        """
+        if self.all_headers:
+            return None
+        frag_types = set([ "k"+type_string.rsplit("_k",1)[-1] for type_string in self.type_levels ])
+        for qualifier in self.header_qualifiers:
+            parts = qualifier.rsplit("_k",1)
+            frag_type = "k"+parts[1] if len(parts)==2 else qualifier
+            if frag_type not in daqdataformats.FragmentType.__members__:
+                return None
+            frag_types.add(frag_type)
+        return frag_types if len(frag_types)>0 else None
+
+    def get_prescales(self,type_string,ana_data_prescale,wvfm_data_prescale):
+        if self.headers_only:
+            return None, None
+        if self.keys is None:
+            return ana_data_prescale, wvfm_data_prescale
+        levels = self.type_levels.get(type_string,set())
+        return (ana_data_prescale if ("detd" in levels or "chst" in levels) else None,
+                wvfm_data_prescale if ("detw" in levels or "adch" in levels) else None)
+
+def read_source_id(h5_file, sid, record_index):
+    """
+    Read the raw input of one source ID from the file: (trh, n_frags) for the
+    trigger record builder, the fragment for readout and trigger, else None.
+    """
     if(sid.subsystem==daqdataformats.SourceID.Subsystem.kTRBuilder):
         trh = h5_file.get_trh(record_index.trigger,record_index.sequence)
         n_frags = len(h5_file.get_fragment_dataset_paths(record_index.trigger,record_index.sequence))
-        return (return_dict | rawdatautils.unpack.utils.TriggerRecordHeaderUnpacker().get_all_data((trh,n_frags)) )
+        return (trh,n_frags)
 
     if(sid.subsystem==daqdataformats.SourceID.Subsystem.kDetectorReadout or sid.subsystem==daqdataformats.SourceID.Subsystem.kTrigger):
-        frag = h5_file.get_frag((record_index.trigger, record_index.sequence), sid)
+        return h5_file.get_frag((record_index.trigger, record_index.sequence), sid)
+
+    return None
+
+def unpack_source_id(sid, raw, record_index, op_env, ana_data_prescale, wvfm_data_prescale, get_unpacker=None, unpack_filter=None):
+    """
+    Unpack the raw input of one source ID, as returned by read_source_id.
+    Does not touch the file.
+    """
+    sid_unpacker = rawdatautils.unpack.utils.SourceIDUnpacker(record_index)
+    return_dict = sid_unpacker.get_all_data(sid)
+
+    if(sid.subsystem==daqdataformats.SourceID.Subsystem.kTRBuilder):
+        return (return_dict | rawdatautils.unpack.utils.TriggerRecordHeaderUnpacker().get_all_data(raw) )
+
+    if(sid.subsystem==daqdataformats.SourceID.Subsystem.kDetectorReadout or sid.subsystem==daqdataformats.SourceID.Subsystem.kTrigger):
+        frag = raw
 
         frag_type=frag.get_fragment_type()
         det_id=frag.get_detector_id()
-        type_string = f'{detdataformats.DetID.Subdetector(det_id).name}_{frag_type.name}'
+        type_string = get_type_string(frag_type, det_id)
+
+        if unpack_filter is not None and not unpack_filter.accepts_fragment(type_string):
+            return return_dict
 
-        fragment_unpacker = get_fragment_unpacker(frag_type, det_id, op_env, ana_data_prescale, wvfm_data_prescale)
+        if get_unpacker is None:
+            fragment_unpacker = get_fragment_unpacker(frag_type, det_id, op_env, ana_data_prescale, wvfm_data_prescale)
+        else:
+            fragment_unpacker = get_unpacker(frag_type, det_id)
         if fragment_unpacker is None:
             print(f'Unknown fragment {type_string}. Source ID {sid}')
             return return_dict
@@ -141,27 +289,526 @@ def process_source_id(h5_file, sid, record_index, op_env, ana_data_prescale, wvf
 
     return return_dict
 
-def process_record(h5_file,rid,df_dict,MAX_WORKERS=10,ana_data_prescale=1,wvfm_data_prescale=None):
+def process_source_id(h5_file, sid, record_index, op_env, ana_data_prescale, wvfm_data_prescale, get_unpacker=None, unpack_filter=None):
+    return unpack_source_id(sid, read_source_id(h5_file, sid, record_index), record_index, op_env,
+                            ana_data_prescale, wvfm_data_prescale, get_unpacker, unpack_filter)
 
-    with h5py.File(h5_file.get_file_name(), 'r') as f:
-        record_index = RecordDataBase(run=f.attrs["run_number"],trigger=rid[0],sequence=rid[1])
-        op_env = f.attrs["operational_environment"]
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_sid = {executor.submit(process_source_id,
-                                         h5_file,
+def _object_array(values):
+    arr = np.empty(len(values),dtype=object)
+    for i, v in enumerate(values):
+        arr[i] = v
+    return arr
+
+def _is_array_value(v):
+    return isinstance(v,(np.ndarray,list,tuple))
+
+def _row_nbytes(row):
+    #array fields at their size, scalars at 8 bytes
+    return sum([ np.asarray(v).nbytes if _is_array_value(v) else 8 for v in vars(row).values() ])
+
+class ColumnarBuilder:
+    """
+    Accumulates the rows for one df_dict key as typed numpy column chunks.
+
+    Dataclass rows are buffered up to chunk_size and then converted column by
+    column. Scalar fields become typed arrays; array-valued fields are kept
+    ragged, as one flat value array plus per-row lengths. A field becomes ragged
+    as soon as an array value appears in it, with the earlier rows converted
+    (None to empty, scalars to one value). Finalizing builds the
+    indexed DataFrame directly from the concatenated columns, with array-valued
+    cells as views into the flat buffer.
+    """
+
+    def __init__(self,index_names=None,chunk_size=4096):
+        self.index_names = index_names
+        self.chunk_size = chunk_size
+        self.n_rows = 0
+        self._pending = []
+        self._names = []    #field order
+        self._columns = {}  #name -> list of 1D arrays
+        self._ragged = {}   #name -> (list of flat arrays, list of length arrays)
+
+    def __len__(self):
+        return self.n_rows
+
+    def get_nbytes(self):
+        """
+        Memory held by the columns. Buffered rows are not converted, so that
+        polling does not break up the chunks; they are estimated at the bytes
+        per row of the converted chunks (or of the last buffered row).
+        """
+        nbytes = sum([ a.nbytes for arrs in self._columns.values() for a in arrs ])
+        nbytes += sum([ a.nbytes for flats, lens in self._ragged.values() for a in flats+lens ])
+        n_pending = len(self._pending)
+        if n_pending>0:
+            n_converted = self.n_rows-n_pending
+            if n_converted>0:
+                nbytes += nbytes*n_pending//n_converted
+            else:
+                nbytes += n_pending*_row_nbytes(self._pending[-1])
+        return nbytes
+
+    def append(self,rows):
+        if len(rows)==0:
+            return
+        if self.index_names is None:
+            self.index_names = rows[0].index_names()
+        self._pending.extend(rows)
+        self.n_rows += len(rows)
+        if len(self._pending)>=self.chunk_size:
+            self._flush()
+
+    def append_columns(self,index_names,columns,ragged,n_rows):
+        """
+        Append already-columnar data, as produced by export().
+        """
+        if n_rows==0:
+            return
+        self._flush()
+        if self.index_names is None:
+            self.index_names = index_names
+        self._names.extend([ name for name in list(columns)+list(ragged) if name not in self._names ])
+        for name, arr in columns.items():
+            if name in self._ragged:
+                self._append_ragged(name,arr)
+            else:
+                self._columns.setdefault(name,[]).append(arr)
+        for name, (flat, lengths) in ragged.items():
+            self._promote_to_ragged(name)
+            flats, lens = self._ragged.setdefault(name,([],[]))
+            flats.append(flat)
+            lens.append(lengths)
+        self.n_rows += n_rows
+
+    def _append_ragged(self,name,values):
+        arrs = [ np.atleast_1d(v) if v is not None else np.empty(0) for v in values ]
+        lengths = np.fromiter((len(a) for a in arrs),dtype=np.int64,count=len(arrs))
+        #empty rows would otherwise upcast integer values to float
+        nonempty = [ a for a in arrs if len(a)>0 ]
+        flat = np.concatenate(nonempty) if len(nonempty)>0 else np.empty(0)
+        flats, lens = self._ragged.setdefault(name,([],[]))
+        flats.append(flat)
+        lens.append(lengths)
+
+    def _promote_to_ragged(self,name):
+        #earlier chunks held only None or scalar values for this field
+        for arr in self._columns.pop(name,[]):
+            self._append_ragged(name,arr)
+
+    def _flush(self):
+        if len(self._pending)==0:
+            return
+        rows = self._pending
+        self._pending = []
+        for name in rows[0].__dataclass_fields__:
+            if name not in self._names:
+                self._names.append(name)
+            values = [ getattr(r,name) for r in rows ]
+            if name in self._ragged or any(_is_array_value(v) for v in values):
+                self._promote_to_ragged(name)
+                self._append_ragged(name,values)
+            else:
+                self._columns.setdefault(name,[]).append(np.asarray(values))
+
+    @staticmethod
+    def _concat(arrs):
+        if len(arrs)==1:
+            return arrs[0]
+        nonempty = [ a for a in arrs if len(a)>0 ]
+        if len(nonempty)==0:
+            return arrs[0]
+        return np.concatenate(nonempty)
+
+    def export(self):
+        """
+        Return (index_names, columns, ragged, n_rows), with ragged columns as
+        (flat values, per-row lengths). Chunks are merged in place.
+        """
+        self._flush()
+        columns = {}
+        for name, arrs in self._columns.items():
+            columns[name] = self._concat(arrs)
+            self._columns[name] = [columns[name]]
+        ragged = {}
+        for name, (flats, lens) in self._ragged.items():
+            ragged[name] = (self._concat(flats), np.concatenate(lens))
+            self._ragged[name] = ([ragged[name][0]],[ragged[name][1]])
+        return self.index_names, columns, ragged, self.n_rows
+
+    def to_dataframe(self):
+        index_names, columns, ragged, n_rows = self.export()
+
+        data = {}
+        for name in self._names:
+            if name in ragged:
+                flat, lengths = ragged[name]
+                offsets = np.concatenate(([0],np.cumsum(lengths)))
+                data[name] = _object_array(np.split(flat,offsets[1:-1]))
+            else:
+                data[name] = columns[name]
+
+        idx_arrays = [ data.pop(name) for name in index_names ]
+        if len(idx_arrays)==1:
+            index = pd.Index(idx_arrays[0],name=index_names[0])
+        else:
+            index = pd.MultiIndex.from_arrays(idx_arrays,names=index_names)
+
+        return pd.DataFrame(data,index=index,copy=False)
+
+def add_rows(df_dict,key,rows):
+    if key not in df_dict.keys():
+        df_dict[key] = ColumnarBuilder()
+    if isinstance(df_dict[key],ColumnarBuilder):
+        df_dict[key].append(rows)
+    else:
+        df_dict[key].extend(rows)
+
+def add_columns(df_dict,key,exported):
+    """
+    Add rows in the columnar form of ColumnarBuilder.export() to df_dict.
+    """
+    if key not in df_dict.keys():
+        df_dict[key] = ColumnarBuilder()
+    df_dict[key].append_columns(*exported)
+
+class RecordProcessor:
+    """
+    Record-processing session bound to one HDF5RawDataFile.
+
+    File attributes (run number, operational environment) and source ID lists
+    are read once, the worker pool lives as long as the session, and fragment
+    unpackers are memoized by (fragment type, det ID, op_env, prescales).
+    Unpackers keep per-fragment state, so each worker thread holds its own set.
+
+    channel_stats maps df_dict keys to accumulators (ChannelStatsAccumulator for
+    detector data, ChannelADCHistogram for waveforms) that are updated with every
+    record's rows; with keep_channel_rows=False those rows are not added to
+    df_dict at all, and with a list of keys only the rows of those keys are.
+
+    With a RecordCache, each record's unpacked output is looked up by file
+    fingerprint, record ID and prescales before unpacking, and stored after.
+
+    With an UnpackFilter, source IDs, fragment types and data levels that no
+    test reads are skipped.
+
+    Only one thread reads the file at a time: fragments are read in file offset
+    order and handed to the pool for unpacking. process_records() reads up to
+    prefetch records ahead on a reader thread, so reads overlap with unpacking.
+    Time spent reading, unpacking and waiting on reads is kept in timings.
+
+    Use as a context manager, or call close() when done, to shut the pool down.
+    """
+
+    def __init__(self,h5_file,MAX_WORKERS=10,ana_data_prescale=1,wvfm_data_prescale=None,
+                 channel_stats=None,keep_channel_rows=True,cache=None,unpack_filter=None,prefetch=2):
+        if isinstance(h5_file,str):
+            h5_file = hdf5libs.HDF5RawDataFile(h5_file)
+        self.h5_file = h5_file
+        self.max_workers = MAX_WORKERS
+        self.ana_data_prescale = ana_data_prescale
+        self.wvfm_data_prescale = wvfm_data_prescale
+        self.channel_stats = channel_stats if channel_stats is not None else {}
+        self.keep_channel_rows = keep_channel_rows
+        self.cache = cache
+        self.unpack_filter = unpack_filter
+        self.prefetch = prefetch
+        self.fingerprint = get_file_fingerprint(h5_file.get_file_name()) if cache is not None else None
+        self.timings = { "read": 0., "unpack": 0., "wait": 0. }
+        self.n_records = 0
+
+        with h5py.File(h5_file.get_file_name(), 'r') as f:
+            self.run_number = f.attrs["run_number"]
+            self.op_env = f.attrs["operational_environment"]
+
+        self._record_ids = None
+        self._source_ids = {}
+        self._local = threading.local()
+        self._executor = None
+        self._offset_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._offset_file is not None:
+            self._offset_file.close()
+            self._offset_file = None
+
+    def get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def get_all_record_ids(self):
+        if self._record_ids is None:
+            self._record_ids = self.h5_file.get_all_record_ids()
+        return self._record_ids
+
+    def get_source_ids(self,rid):
+        rid = tuple(rid)
+        if rid not in self._source_ids:
+            self._source_ids[rid] = self._filter_source_ids(rid,self.h5_file.get_source_ids(rid))
+        return self._source_ids[rid]
+
+    def _filter_source_ids(self,rid,sids):
+        if self.unpack_filter is None:
+            return sids
+        sids = [ sid for sid in sids if self.unpack_filter.accepts_subsystem(sid.subsystem) ]
+
+        #where the file can list source IDs by fragment type, skip others without reading them
+        frag_types = self.unpack_filter.get_fragment_types()
+        if frag_types is not None and hasattr(self.h5_file,"get_source_ids_for_fragment_type"):
+            wanted = set()
+            for name in frag_types:
+                wanted |= set(self.h5_file.get_source_ids_for_fragment_type(rid,daqdataformats.FragmentType.__members__[name]))
+            sids = [ sid for sid in sids if sid.subsystem==daqdataformats.SourceID.Subsystem.kTRBuilder or sid in wanted ]
+        return sids
+
+    def get_read_order(self,rid,sids):
+        """
+        Source IDs sorted by the file offset of their fragment dataset, so a
+        record is read front to back. The trigger record header comes first;
+        fragments without a known offset (chunked datasets, or files without
+        dataset path lookup) keep their order at the end.
+        """
+        if not hasattr(self.h5_file,"get_fragment_dataset_path"):
+            return list(sids)
+        if self._offset_file is None:
+            self._offset_file = h5py.File(self.h5_file.get_file_name(),'r')
+
+        keys = []
+        for i, sid in enumerate(sids):
+            offset = -1
+            if sid.subsystem!=daqdataformats.SourceID.Subsystem.kTRBuilder:
+                try:
+                    offset = self._offset_file[self.h5_file.get_fragment_dataset_path(rid,sid)].id.get_offset()
+                except (KeyError,RuntimeError):
+                    offset = None
+            keys.append((offset is None, offset or 0, i))
+        return [ sids[i] for _, _, i in sorted(keys) ]
+
+    def read_record(self,rid):
+        """
+        Raw inputs of all source IDs of a record, as [(sid, raw)] in read order.
+        """
+        record_index = self.get_record_index(rid)
+        start = time.perf_counter()
+        sids = self.get_read_order(rid,self.get_source_ids(rid))
+        raws = [ (sid,read_source_id(self.h5_file,sid,record_index)) for sid in sids ]
+        self.timings["read"] += time.perf_counter()-start
+        return raws
+
+    def get_unpacker(self,frag_type,det_id):
+        if not hasattr(self._local,"unpackers"):
+            self._local.unpackers = {}
+        ana_data_prescale, wvfm_data_prescale = self.ana_data_prescale, self.wvfm_data_prescale
+        if self.unpack_filter is not None:
+            ana_data_prescale, wvfm_data_prescale = self.unpack_filter.get_prescales(get_type_string(frag_type,det_id),
+                                                                                     ana_data_prescale,wvfm_data_prescale)
+        key = (frag_type,det_id,self.op_env,ana_data_prescale,wvfm_data_prescale)
+        if key not in self._local.unpackers:
+            self._local.unpackers[key] = get_fragment_unpacker(frag_type, det_id, self.op_env,
+                                                               ana_data_prescale, wvfm_data_prescale)
+        return self._local.unpackers[key]
+
+    def keeps_rows(self,key):
+        if isinstance(self.keep_channel_rows,bool):
+            return self.keep_channel_rows
+        return key in self.keep_channel_rows
+
+    def get_cache_extra(self):
+        return None if self.unpack_filter is None else self.unpack_filter.get_signature()
+
+    def get_record_index(self,rid):
+        return RecordDataBase(run=self.run_number,trigger=rid[0],sequence=rid[1])
+
+    def process_record(self,rid,df_dict,raws=None):
+        if self.cache is None:
+            self.unpack_record(rid,df_dict,raws=raws)
+        else:
+            entry = self.get_cache_entry(rid)
+            if entry is None:
+                entry = self.unpack_to_cache(rid,raws)
+            self.add_cache_entry(entry,df_dict)
+        self.n_records += 1
+        return df_dict
+
+    def get_cache_entry(self,rid):
+        return self.cache.get(self.fingerprint,rid,self.ana_data_prescale,self.wvfm_data_prescale,
+                              extra=self.get_cache_extra())
+
+    def unpack_to_cache(self,rid,raws=None):
+        rec_dict = self.unpack_record(rid,{},accumulate=False,raws=raws)
+        entry = { key: builder.export() for key, builder in rec_dict.items() if len(builder)>0 }
+        self.cache.put(self.fingerprint,rid,self.ana_data_prescale,self.wvfm_data_prescale,entry,
+                       extra=self.get_cache_extra())
+        return entry
+
+    def add_cache_entry(self,entry,df_dict):
+        for key, exported in entry.items():
+            if key in self.channel_stats:
+                builder = ColumnarBuilder()
+                builder.append_columns(*exported)
+                self.channel_stats[key].update(builder.to_dataframe())
+                if not self.keeps_rows(key):
+                    continue
+            add_columns(df_dict,key,exported)
+        return df_dict
+
+    def unpack_record(self,rid,df_dict,accumulate=True,raws=None):
+        record_index = self.get_record_index(rid)
+        if raws is None:
+            raws = self.read_record(rid)
+
+        start = time.perf_counter()
+        executor = self.get_executor()
+        future_to_sid = {executor.submit(unpack_source_id,
                                          sid,
+                                         raw,
                                          record_index,
-                                         op_env,
-                                         ana_data_prescale,
-                                         wvfm_data_prescale): sid for sid in h5_file.get_source_ids(rid) }
+                                         self.op_env,
+                                         self.ana_data_prescale,
+                                         self.wvfm_data_prescale,
+                                         self.get_unpacker,
+                                         self.unpack_filter): sid for sid, raw in raws }
         for future in concurrent.futures.as_completed(future_to_sid):
-            sid = future_to_sid[future]
             res = future.result()
             for key, df in res.items():
-                if key not in df_dict.keys():
-                    df_dict[key] = []
-                df_dict[key].extend(df)
+                if accumulate and key in self.channel_stats:
+                    self.channel_stats[key].update(df)
+                    if not self.keeps_rows(key):
+                        continue
+                add_rows(df_dict,key,df)
+
+        self.timings["unpack"] += time.perf_counter()-start
+        return df_dict
+
+    def _read_ahead(self,rids,read_queue,stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    read_queue.put(item,timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for rid in rids:
+                entry = self.get_cache_entry(rid) if self.cache is not None else None
+                raws = self.read_record(rid) if entry is None else None
+                if not put((rid,entry,raws,None)):
+                    return
+        except Exception as err:
+            put((None,None,None,err))
+            return
+        put(None)
+
+    def process_records(self,rids,df_dict,prefetch=None):
+        """
+        Process records in order, yielding each record ID once its rows are in
+        df_dict. A reader thread reads (or fetches from the cache) up to prefetch
+        records ahead into a bounded queue while the pool unpacks the current one.
+        """
+        prefetch = self.prefetch if prefetch is None else prefetch
+        read_queue = queue.Queue(maxsize=max(1,prefetch))
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_ahead,args=(list(rids),read_queue,stop),daemon=True)
+        reader.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = read_queue.get()
+                self.timings["wait"] += time.perf_counter()-start
+                if item is None:
+                    break
+                rid, entry, raws, err = item
+                if err is not None:
+                    raise err
+
+                if self.cache is None:
+                    self.unpack_record(rid,df_dict,raws=raws)
+                else:
+                    if entry is None:
+                        entry = self.unpack_to_cache(rid,raws)
+                    self.add_cache_entry(entry,df_dict)
+                self.n_records += 1
+                yield rid
+        finally:
+            stop.set()
+            reader.join()
+
+    def get_timing_summary(self):
+        return (f'{self.n_records} records: {self.timings["read"]:.1f} s reading, '
+                f'{self.timings["unpack"]:.1f} s unpacking, {self.timings["wait"]:.1f} s waiting on reads')
+
+def process_record(h5_file,rid,df_dict,MAX_WORKERS=10,ana_data_prescale=1,wvfm_data_prescale=None):
+
+    with RecordProcessor(h5_file,MAX_WORKERS=MAX_WORKERS,
+                         ana_data_prescale=ana_data_prescale,
+                         wvfm_data_prescale=wvfm_data_prescale) as processor:
+        return processor.process_record(rid,df_dict)
+
+def _process_record_slice(filename,rids,MAX_WORKERS,ana_data_prescale,wvfm_data_prescale,
+                          channel_stats=None,keep_channel_rows=True,cache=None,unpack_filter=None):
+
+    df_dict = {}
+    with RecordProcessor(filename,MAX_WORKERS=MAX_WORKERS,
+                         ana_data_prescale=ana_data_prescale,
+                         wvfm_data_prescale=wvfm_data_prescale,
+                         channel_stats=channel_stats,
+                         keep_channel_rows=keep_channel_rows,
+                         cache=cache,
+                         unpack_filter=unpack_filter) as processor:
+        for rid in processor.process_records(rids,df_dict):
+            pass
+
+    #ship flat numpy columns back to the parent, not lists of dataclasses
+    return { key: builder.export() for key, builder in df_dict.items() if len(builder)>0 }, (channel_stats or {})
+
+def process_records_multiprocess(filename,rids,df_dict,nprocs,MAX_WORKERS=10,ana_data_prescale=1,wvfm_data_prescale=None,
+                                 channel_stats=None,keep_channel_rows=True,cache=None,unpack_filter=None):
+    """
+    Process records with a pool of nprocs processes. Each worker opens its own
+    HDF5RawDataFile and processes a contiguous slice of the record IDs, returning
+    columnar numpy results that are merged into the ColumnarBuilders in df_dict.
+    Per-worker channel statistics are merged into the accumulators in channel_stats.
+    """
+
+    rids = list(rids)
+    if len(rids)==0:
+        return df_dict
+    nprocs = max(1,min(nprocs,len(rids)))
+    slice_size = -(-len(rids)//nprocs)
+    rid_slices = [ rids[i:i+slice_size] for i in range(0,len(rids),slice_size) ]
+
+    #spawn, so workers do not inherit the parent's HDF5 library state
+    mp_context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs,mp_context=mp_context) as executor:
+        futures = [ executor.submit(_process_record_slice,
+                                    filename,
+                                    rid_slice,
+                                    MAX_WORKERS,
+                                    ana_data_prescale,
+                                    wvfm_data_prescale,
+                                    { key: acc.new_empty() for key, acc in channel_stats.items() } if channel_stats is not None else None,
+                                    keep_channel_rows,
+                                    cache,
+                                    unpack_filter) for rid_slice in rid_slices ]
+        #keep record order stable by collecting in submission order
+        for future in futures:
+            exported_dict, worker_stats = future.result()
+            if channel_stats is not None:
+                for key, acc in worker_stats.items():
+                    channel_stats[key].merge(acc)
+            for key, exported in exported_dict.items():
+                add_columns(df_dict,key,exported)
 
     return df_dict
 
@@ -190,13 +837,37 @@ def select_record(df,run=None,trigger=None,sequence=None):
 
 
 def concatenate_dataframes(df_dict):
+    """
+    Turn the accumulated rows into indexed DataFrames. Returns a DataFrameDict
+    that keeps the flat (values, offsets) form of array-valued columns built
+    by ColumnarBuilder; df_dict itself is updated in place as well.
+    """
+    out_dict = DataFrameDict()
     for key, dc_list in df_dict.items():
         if len(dc_list)==0:
             print(f'List for key {key} has zero length.')
+            out_dict[key] = dc_list
+            continue
+
+        if isinstance(dc_list,ColumnarBuilder):
+            _, _, ragged, _ = dc_list.export()
+            out_dict[key] = dc_list.to_dataframe()
+            for name, (values, lengths) in ragged.items():
+                offsets = np.zeros(len(lengths)+1,dtype=np.int64)
+                np.cumsum(lengths,out=offsets[1:])
+                out_dict.set_ragged(key,name,values,offsets)
+            continue
+
+        if isinstance(dc_list,pd.DataFrame):
+            out_dict[key] = dc_list
             continue
+
         idx = dc_list[0].index_names()
-        df_dict[key] = pd.DataFrame(dc_list)
-        df_dict[key] = df_dict[key].set_index(idx)
+        out_dict[key] = pd.DataFrame(dc_list)
+        out_dict[key] = out_dict[key].set_index(idx)
+
+    for key, df in out_dict.items():
+        df_dict[key] = df
     
-    return df_dict
+    return out_dict
     
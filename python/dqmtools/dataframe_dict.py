@@ -0,0 +1,184 @@
+import threading
+import numpy as np
+
+
+class DataFrameDict(dict):
+    """
+    dict of DataFrames, as returned by concatenate_dataframes, with a memo of
+    derived frames ("views") computed from them: ragged forms of array-valued
+    columns, fragment-type slices, joins, lookup tables.
+
+    Each view records the DataFrame objects of the keys it was computed from.
+    It is recomputed when any of them has been replaced, and dropped when one
+    of its keys is set or deleted. Views are shared, so treat them as read-only.
+    """
+
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self._views = {}
+        self._view_locks = {}
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        #views and locks are not pickled
+        return (DataFrameDict,(dict(self),))
+
+    def __setitem__(self,key,value):
+        self._invalidate(key)
+        super().__setitem__(key,value)
+
+    def __delitem__(self,key):
+        self._invalidate(key)
+        super().__delitem__(key)
+
+    def pop(self,key,*args):
+        self._invalidate(key)
+        return super().pop(key,*args)
+
+    def clear(self):
+        self._views = {}
+        super().clear()
+
+    def _invalidate(self,key):
+        for name in [ name for name, (deps, _) in self._views.items() if key in [ k for k, _ in deps ] ]:
+            del self._views[name]
+
+    def _deps(self,keys):
+        return tuple([ (key, self.get(key)) for key in keys ])
+
+    def set_view(self,name,keys,value):
+        self._views[name] = (self._deps(keys),value)
+
+    def get_cached_view(self,name):
+        entry = self._views.get(name)
+        if entry is None:
+            return None
+        deps, value = entry
+        for key, df in deps:
+            if df is not self.get(key):
+                return None
+        return value
+
+    def get_view(self,name,keys,func):
+        """
+        Return the view called name, computing func(self) at most once for the
+        current frames under keys.
+        """
+        value = self.get_cached_view(name)
+        if value is not None:
+            return value
+
+        with self._lock:
+            lock = self._view_locks.setdefault(name,threading.Lock())
+        with lock:
+            value = self.get_cached_view(name)
+            if value is None:
+                value = func(self)
+                self.set_view(name,keys,value)
+        return value
+
+    def set_ragged(self,key,column,values,offsets):
+        self.set_view(("ragged",key,column),[key],(values,offsets))
+
+    def get_ragged(self,key,column):
+        return self.get_cached_view(("ragged",key,column))
+
+
+def get_view(df_dict,name,keys,func):
+    """
+    Memoized func(df_dict) when df_dict is a DataFrameDict, computed directly otherwise.
+    """
+    if isinstance(df_dict,DataFrameDict):
+        return df_dict.get_view(name,keys,func)
+    return func(df_dict)
+
+def ragged_from_series(series):
+    """
+    Flatten a column of per-row arrays into (values, offsets), so that row i
+    holds values[offsets[i]:offsets[i+1]].
+    """
+    arrs = [ np.atleast_1d(v) if v is not None else np.empty(0) for v in series.values ]
+    lengths = np.fromiter((len(a) for a in arrs),dtype=np.int64,count=len(arrs))
+    offsets = np.zeros(len(arrs)+1,dtype=np.int64)
+    np.cumsum(lengths,out=offsets[1:])
+    nonempty = [ a for a in arrs if len(a)>0 ]
+    values = np.concatenate(nonempty) if len(nonempty)>0 else np.empty(0)
+    return values, offsets
+
+def get_ragged_column(df_dict,key,column):
+    """
+    Return (values, offsets) for an array-valued column of df_dict[key],
+    using the stored flat arrays when df_dict is a DataFrameDict.
+    """
+    return get_view(df_dict,("ragged",key,column),[key],
+                    lambda d: ragged_from_series(d[key][column]))
+
+def ragged_reduceat(values,offsets,ufunc=np.add):
+    """
+    Per-row reduction of a ragged array, e.g. per-fragment error counts.
+    Empty rows get the ufunc identity (0 for np.add).
+    """
+    if values.dtype==bool:
+        values = values.astype(np.int64)
+    lengths = np.diff(offsets)
+    nonempty = lengths>0
+    out = np.full(len(lengths),ufunc.identity if ufunc.identity is not None else 0,dtype=values.dtype)
+    if np.any(nonempty):
+        out[nonempty] = ufunc.reduceat(values,offsets[:-1][nonempty])
+    return out
+
+def get_frh_by_fragment_type(df_dict,fragment_type):
+    """
+    Fragment headers of one fragment type.
+    """
+    return get_view(df_dict,("frh_by_fragment_type",fragment_type),["frh"],
+                    lambda d: d["frh"].loc[d["frh"]["fragment_type"]==fragment_type])
+
+def _join_frh_daqh(df_dict,fragment_type):
+    df_frh = df_dict["frh"] if fragment_type is None else get_frh_by_fragment_type(df_dict,fragment_type)
+    df_daqh = df_dict["daqh"]
+    return df_frh.join(df_daqh[[ col for col in df_daqh.columns if col not in df_frh.columns ]])
+
+def get_frh_daqh(df_dict,fragment_type=None):
+    """
+    Fragment headers (optionally of one fragment type) joined with the DAQ headers.
+    Columns present in both keep the fragment header values.
+    """
+    return get_view(df_dict,("frh_daqh",fragment_type),["frh","daqh"],
+                    lambda d: _join_frh_daqh(d,fragment_type))
+
+def get_reset_index(df_dict,key):
+    """
+    df_dict[key] with its index levels moved to columns.
+    """
+    return get_view(df_dict,("reset_index",key),[key],
+                    lambda d: d[key].reset_index())
+
+def get_channel_map(df_dict,key):
+    """
+    One row per channel with its apa and plane, from a frame with those columns.
+    """
+    return get_view(df_dict,("channel_map",key),[key],
+                    lambda d: get_reset_index(d,key)[["channel","apa","plane"]].drop_duplicates(["channel"]))
+
+def get_record_rows(df_dict,key):
+    """
+    Row positions of df_dict[key] for each (run, trigger, sequence).
+    """
+    return get_view(df_dict,("record_rows",key),[key],
+                    lambda d: d[key].groupby(level=["run","trigger","sequence"],sort=False).indices)
+
+def find_record(df_dict,key,run=None,trigger=None,sequence=None):
+    """
+    (run, trigger, sequence) of the first record in df_dict[key] matching the
+    given values, as picked by select_record, or None if there is none.
+    """
+    first = None
+    for record, rows in get_record_rows(df_dict,key).items():
+        if ((run is not None and record[0]!=run) or
+            (trigger is not None and record[1]!=trigger) or
+            (sequence is not None and record[2]!=sequence)):
+            continue
+        if first is None or rows[0]<first[1]:
+            first = (record,rows[0])
+    return None if first is None else tuple([ int(v) for v in first[0] ])
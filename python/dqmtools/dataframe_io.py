@@ -0,0 +1,480 @@
+import sys
+import os
+import json
+import time
+import numpy as np
+
+from dqmtools.dataframe_dict import DataFrameDict, get_ragged_column
+
+#non-standard imports
+try:
+    import pandas as pd
+except ModuleNotFoundError as err:
+    print(err)
+    print("\n\n")
+    print("Missing module is likely not part of standard dunedaq releases.")
+    print("\n")
+    print("Please install the missing module and try again.")
+    sys.exit(1)
+except:
+    raise
+
+#pyarrow is only needed for the parquet format, so it is imported on first use
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ModuleNotFoundError as err:
+        print(err)
+        print("\n\n")
+        print("Missing module is likely not part of standard dunedaq releases.")
+        print("\n")
+        print("Please install the missing module (pyarrow) and try again.")
+        sys.exit(1)
+    except:
+        raise
+    return pa, pq
+
+METADATA_KEY = b"dqmtools"
+
+def _is_ragged(series):
+    for v in series.values:
+        if v is not None:
+            return isinstance(v,(np.ndarray,list,tuple))
+    return False
+
+def _is_string(series):
+    for v in series.values:
+        if v is not None:
+            return isinstance(v,str)
+    return False
+
+def _ragged_to_arrow(pa,values,offsets):
+    values = pa.array(values)
+    if offsets[-1] < np.iinfo(np.int32).max:
+        return pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)),values)
+    return pa.LargeListArray.from_arrays(pa.array(offsets),values)
+
+def dataframe_to_arrow(df_dict,key):
+    """
+    Arrow table of df_dict[key] with its index levels as leading columns.
+    Array-valued columns become native list columns (from the flat ragged
+    buffers when df_dict is a DataFrameDict) and string columns are
+    dictionary encoded. Index names and dtypes are kept in the schema metadata.
+    """
+    pa, _ = _import_pyarrow()
+    df = df_dict[key]
+
+    names, arrays = [], []
+    for name in df.index.names:
+        names.append(name)
+        arrays.append(pa.array(np.asarray(df.index.get_level_values(name))))
+    for col in df.columns:
+        series = df[col]
+        if series.dtype==object and _is_ragged(series):
+            arr = _ragged_to_arrow(pa,*get_ragged_column(df_dict,key,col))
+        elif _is_string(series):
+            arr = pa.array(series.values,type=pa.string()).dictionary_encode()
+        else:
+            arr = pa.array(np.asarray(series.values))
+        names.append(col)
+        arrays.append(arr)
+
+    metadata = { "key": key,
+                 "index_names": list(df.index.names),
+                 "index_dtypes": [ str(df.index.get_level_values(name).dtype) for name in df.index.names ] }
+    table = pa.Table.from_arrays(arrays,names=names)
+    return table.replace_schema_metadata({ METADATA_KEY: json.dumps(metadata).encode() })
+
+def get_partition_dir(path,key,run=None):
+    key_dir = os.path.join(path,f'key={key}')
+    return key_dir if run is None else os.path.join(key_dir,f'run={run}')
+
+def _next_part_name(part_dir):
+    n_parts = len([ f for f in os.listdir(part_dir) if f.endswith(".parquet") ])
+    return os.path.join(part_dir,f'part-{n_parts:05d}.parquet')
+
+def write_parquet_dataset(df_dict,path,compression="zstd",compression_level=None,row_group_size=65536):
+    """
+    Write every key of df_dict under path as parquet files partitioned by key
+    and run: <path>/key=<key>/run=<run>/part-NNNNN.parquet. The run is kept in
+    the directory name only. Writing again to the same path adds new parts,
+    so records can be appended. Returns the list of files written.
+    """
+    pa, pq = _import_pyarrow()
+    os.makedirs(path,exist_ok=True)
+
+    written = []
+    for key, df in df_dict.items():
+        if not isinstance(df,pd.DataFrame) or len(df)==0:
+            continue
+        table = dataframe_to_arrow(df_dict,key)
+
+        if "run" in df.index.names:
+            runs = np.asarray(df.index.get_level_values("run"))
+            tables = []
+            for run in np.unique(runs):
+                rows = np.flatnonzero(runs==run)
+                tables.append((run,table.take(pa.array(rows)).drop_columns(["run"])))
+        else:
+            tables = [ (None,table) ]
+
+        for run, run_table in tables:
+            part_dir = get_partition_dir(path,key,run)
+            os.makedirs(part_dir,exist_ok=True)
+            filename = _next_part_name(part_dir)
+            pq.write_table(run_table,filename,
+                           compression=compression,compression_level=compression_level,
+                           row_group_size=row_group_size)
+            written.append(filename)
+
+    return written
+
+def _table_to_dataframe(table,run=None):
+    metadata = json.loads(table.schema.metadata[METADATA_KEY])
+    df = table.to_pandas()
+    for col in df.columns:
+        if isinstance(df[col].dtype,pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    index_names = [ name for name in metadata["index_names"] ]
+    if "run" in index_names and "run" not in df.columns:
+        run_dtype = metadata["index_dtypes"][index_names.index("run")]
+        df.insert(0,"run",np.full(len(df),int(run),dtype=run_dtype))
+    return df.set_index(index_names)
+
+def _in_range(value,value_range):
+    return value_range is None or (value_range[0] <= value <= value_range[1])
+
+def _parquet_parts(path,key,runs=None,run_range=None):
+    key_dir = get_partition_dir(path,key)
+    parts = []
+    if not os.path.isdir(key_dir):
+        return parts
+    run_dirs = sorted([ d for d in os.listdir(key_dir) if d.startswith("run=") ])
+    if len(run_dirs)==0:
+        run_dirs = [ None ]
+    for run_dir in run_dirs:
+        run = None if run_dir is None else run_dir[len("run="):]
+        if run is not None:
+            if runs is not None and int(run) not in [ int(r) for r in runs ]:
+                continue
+            if not _in_range(int(run),run_range):
+                continue
+        part_dir = key_dir if run_dir is None else os.path.join(key_dir,run_dir)
+        parts.extend([ (run,os.path.join(part_dir,f)) for f in sorted(os.listdir(part_dir)) if f.endswith(".parquet") ])
+    return parts
+
+def read_parquet_key(path,key,columns=None,runs=None,filters=None,run_range=None):
+    """
+    Read one key of a dataset written by write_parquet_dataset. Only the
+    requested columns (index levels are always read) and runs are loaded;
+    filters are pyarrow filters on the remaining columns, e.g.
+    [("trigger","in",[1,2,3])], and are pushed down to the row groups.
+    """
+    _, pq = _import_pyarrow()
+
+    parts = []
+    for run, filename in _parquet_parts(path,key,runs,run_range):
+        file_columns = None
+        if columns is not None:
+            index_names = json.loads(pq.read_schema(filename).metadata[METADATA_KEY])["index_names"]
+            file_columns = [ c for c in index_names if c!="run" ] + [ c for c in columns if c not in index_names ]
+        table = pq.read_table(filename,columns=file_columns,filters=filters)
+        parts.append(_table_to_dataframe(table,run))
+
+    return concat_frames(parts)
+
+def read_parquet_dataset(path,keys=None,columns=None,runs=None,filters=None):
+    """
+    Read a dataset written by write_parquet_dataset into a DataFrameDict.
+    columns may be a list applied to every key, or a dict of lists by key.
+    """
+    if keys is None:
+        keys = sorted([ d[len("key="):] for d in os.listdir(path) if d.startswith("key=") ])
+    df_dict = DataFrameDict()
+    for key in keys:
+        key_columns = columns.get(key) if isinstance(columns,dict) else columns
+        df = read_parquet_key(path,key,columns=key_columns,runs=runs,filters=filters)
+        if df is not None:
+            df_dict[key] = df
+    return df_dict
+
+def concat_frames(frames):
+    """
+    Concatenate frames with the same index levels and columns into one,
+    allocating each output column once and filling it part by part.
+    Falls back to pd.concat when the layouts differ.
+    """
+    frames = [ df for df in frames if df is not None and len(df)>0 ]
+    if len(frames)==0:
+        return None
+    if len(frames)==1:
+        return frames[0]
+
+    index_names = list(frames[0].index.names)
+    columns = list(frames[0].columns)
+    for df in frames[1:]:
+        if list(df.index.names)!=index_names or list(df.columns)!=columns:
+            return pd.concat(frames)
+
+    n_rows = sum([ len(df) for df in frames ])
+    bounds = np.concatenate(([0],np.cumsum([ len(df) for df in frames ])))
+
+    def fill(parts):
+        dtypes = [ p.dtype for p in parts ]
+        if all([ isinstance(dt,np.dtype) and dt!=object for dt in dtypes ]):
+            out = np.empty(n_rows,dtype=np.result_type(*dtypes))
+        else:
+            out = np.empty(n_rows,dtype=object)
+        for i, p in enumerate(parts):
+            out[bounds[i]:bounds[i+1]] = np.asarray(p,dtype=out.dtype)
+        return out
+
+    index_arrays = [ fill([ df.index.get_level_values(name) for df in frames ]) for name in index_names ]
+    if len(index_arrays)==1:
+        index = pd.Index(index_arrays[0],name=index_names[0])
+    else:
+        index = pd.MultiIndex.from_arrays(index_arrays,names=index_names)
+    data = { col: fill([ df[col].values for df in frames ]) for col in columns }
+    return pd.DataFrame(data,index=index,copy=False)
+
+def get_hdf5_part_key(key,i_part):
+    return f'{key}/part_{i_part:05d}'
+
+def get_hdf5_base_key(store_key):
+    """
+    df_dict key of an HDF5 store key, which is either /<key> or, for files
+    written in parts, /<key>/part_NNNNN.
+    """
+    return store_key.lstrip("/").split("/part_")[0]
+
+def is_parquet_dataset(path):
+    return os.path.isdir(path) and any([ d.startswith("key=") for d in os.listdir(path) ])
+
+def _hdf5_index_names(storer):
+    if storer.is_table:
+        levels = getattr(storer,"levels",None)
+        return list(levels) if isinstance(levels,list) else [ storer.index_axes[0].name ]
+    group = storer.group
+    nlevels = getattr(group._v_attrs,"axis1_nlevels",None)
+    if nlevels is None:
+        return [ getattr(group._v_children["axis1"]._v_attrs,"name",None) ]
+    return [ getattr(group._v_children[f'axis1_level{i}']._v_attrs,"name",None) for i in range(nlevels) ]
+
+def describe_file(filename):
+    """
+    Keys of an HDF5 file written with to_hdf, or of a parquet dataset
+    directory, with their row counts, index names and columns. Only metadata
+    is read.
+    """
+    info = []
+    if is_parquet_dataset(filename):
+        _, pq = _import_pyarrow()
+        for key in sorted([ d[len("key="):] for d in os.listdir(filename) if d.startswith("key=") ]):
+            parts = _parquet_parts(filename,key)
+            if len(parts)==0:
+                continue
+            schema = pq.read_schema(parts[0][1])
+            index_names = json.loads(schema.metadata[METADATA_KEY])["index_names"]
+            info.append({ "key": key,
+                          "n_rows": sum([ pq.read_metadata(f).num_rows for _, f in parts ]),
+                          "index_names": index_names,
+                          "columns": [ c for c in schema.names if c not in index_names ] })
+    else:
+        with pd.HDFStore(filename,'r') as store:
+            info_by_key = {}
+            for key in store.keys():
+                storer = store.get_storer(key)
+                index_names = [ str(name) if name is not None else None for name in _hdf5_index_names(storer) ]
+                if storer.is_table:
+                    n_rows = int(storer.nrows)
+                    columns = [ str(c) for c in storer.non_index_axes[0][1] if c not in index_names ]
+                else:
+                    #row count from the shape of the stored index, without reading it
+                    nlevels = getattr(storer.group._v_attrs,"axis1_nlevels",None)
+                    index_node = storer.group._v_children["axis1" if nlevels is None else "axis1_label0"]
+                    n_rows = int(index_node.shape[0])
+                    columns = [ str(c) for c in storer.read_index("axis0") ]
+                #parts written by DataFrameWriter count towards their key
+                base_key = get_hdf5_base_key(key)
+                if base_key in info_by_key:
+                    info_by_key[base_key]["n_rows"] += n_rows
+                    continue
+                info_by_key[base_key] = { "key": base_key,
+                                          "n_rows": n_rows,
+                                          "index_names": index_names,
+                                          "columns": columns }
+            info = list(info_by_key.values())
+    return info
+
+def describe_files(filenames):
+    """
+    describe_file summed over several files: one entry per key with the
+    total row count and the number of files containing it.
+    """
+    info = {}
+    for filename in filenames:
+        for entry in describe_file(filename):
+            if entry["key"] not in info:
+                info[entry["key"]] = dict(entry,n_files=0,n_rows=0)
+            info[entry["key"]]["n_rows"] += entry["n_rows"]
+            info[entry["key"]]["n_files"] += 1
+    return info
+
+def _select_rows(df,run_range,trigger_range):
+    mask = np.ones(len(df),dtype=bool)
+    for name, value_range in [("run",run_range),("trigger",trigger_range)]:
+        if value_range is not None and name in df.index.names:
+            values = df.index.get_level_values(name)
+            mask &= (values>=value_range[0])&(values<=value_range[1])
+    return df if mask.all() else df.loc[mask]
+
+def load_key(filename,key,columns=None,run_range=None,trigger_range=None):
+    """
+    Load one key from an HDF5 file or parquet dataset, restricted to the given
+    columns and inclusive (first, last) run and trigger ranges.
+    """
+    if is_parquet_dataset(filename):
+        filters = None
+        if trigger_range is not None:
+            filters = [("trigger",">=",trigger_range[0]),("trigger","<=",trigger_range[1])]
+        return read_parquet_key(filename,key,columns=columns,filters=filters,run_range=run_range)
+
+    with pd.HDFStore(filename,'r') as store:
+        parts = []
+        for store_key in sorted([ k for k in store.keys() if get_hdf5_base_key(k)==key ]):
+            storer = store.get_storer(store_key)
+            if storer.is_table:
+                df = store.select(store_key,columns=columns)
+            else:
+                df = store[store_key]
+                if columns is not None:
+                    df = df[[ c for c in columns if c in df.columns ]]
+            parts.append(_select_rows(df,run_range,trigger_range))
+    return concat_frames(parts)
+
+def load_dataframes(filenames,keys=None,columns=None,run_range=None,trigger_range=None):
+    """
+    Load the selected keys from several HDF5 files and/or parquet datasets into
+    one DataFrameDict, concatenating each key across files with concat_frames.
+    columns may be a list applied to every key, or a dict of lists by key.
+    """
+    if keys is None:
+        keys = list(describe_files(filenames).keys())
+    df_dict = DataFrameDict()
+    for key in keys:
+        key_columns = columns.get(key) if isinstance(columns,dict) else columns
+        df = concat_frames([ load_key(filename,key,key_columns,run_range,trigger_range) for filename in filenames ])
+        if df is not None:
+            df_dict[key] = df
+    return df_dict
+
+def get_nbytes(df_dict):
+    """
+    Approximate memory held by df_dict: DataFrames and anything with a
+    get_nbytes() method, such as ColumnarBuilder.
+    """
+    nbytes = 0
+    for value in df_dict.values():
+        if isinstance(value,pd.DataFrame):
+            nbytes += int(value.memory_usage(index=True,deep=False).sum())
+        elif hasattr(value,"get_nbytes"):
+            nbytes += value.get_nbytes()
+    return nbytes
+
+class DataFrameWriter:
+    """
+    Writes DataFrame dicts to an HDF5 file or a parquet dataset in successive
+    flushes, so that memory is bounded by the flush size and an interrupted job
+    still leaves every completed flush readable.
+
+    A flush is due every flush_records records or once the pending data exceed
+    flush_mb megabytes (0 disables either limit). HDF5 flushes are stored as
+    fixed-format keys <key>/part_NNNNN, since array-valued columns cannot go in
+    appendable tables; parquet flushes add part files to each partition. The
+    loaders in this module read both layouts back as single keys. Without any
+    flush limit, everything is written once under the plain keys. Appending to
+    an HDF5 file written with the other layout raises ValueError.
+    """
+
+    def __init__(self,path,output_format="hdf5",flush_records=0,flush_mb=0,
+                 complevel=0,complib=None,verbose=True):
+        self.path = path
+        self.output_format = output_format
+        self.flush_records = flush_records
+        self.flush_mb = flush_mb
+        self.complevel = complevel
+        self.complib = complib
+        self.verbose = verbose
+
+        self.n_flushes = 0
+        self.n_records = 0
+        self.n_bytes = 0
+        self.write_time = 0.
+        self.start_time = time.perf_counter()
+        self._n_parts = {}
+
+        #continue the part numbering of an existing file when appending;
+        #a key is either one plain node or a group of parts, so layouts can not mix
+        if output_format=="hdf5" and os.path.isfile(path):
+            with pd.HDFStore(path,'r') as store:
+                store_keys = store.keys()
+            plain_keys = [ k for k in store_keys if "/part_" not in k ]
+            if self.is_chunked() and len(plain_keys)>0:
+                raise ValueError(f"Cannot append flushed parts to {path}, it holds unflushed keys {plain_keys}. "
+                                 f"Append without --flush-records/--flush-mb, or write a new file.")
+            if not self.is_chunked() and len(plain_keys)<len(store_keys):
+                raise ValueError(f"Cannot append unflushed keys to {path}, it was written in parts. "
+                                 f"Append with --flush-records/--flush-mb, or write a new file.")
+            for store_key in store_keys:
+                key = get_hdf5_base_key(store_key)
+                self._n_parts[key] = self._n_parts.get(key,0)+1
+
+    def is_chunked(self):
+        return self.flush_records>0 or self.flush_mb>0
+
+    def should_flush(self,df_dict,n_pending_records):
+        if n_pending_records==0:
+            return False
+        if self.flush_records>0 and n_pending_records>=self.flush_records:
+            return True
+        if self.flush_mb>0 and get_nbytes(df_dict)>=self.flush_mb*1e6:
+            return True
+        return False
+
+    def write(self,frames,n_records):
+        """
+        Write one flush of finalized frames (as from concatenate_dataframes)
+        holding n_records records.
+        """
+        t_start = time.perf_counter()
+        n_bytes = get_nbytes(frames)
+
+        if self.output_format=="parquet":
+            compression = self.complib if self.complib is not None else "zstd"
+            write_parquet_dataset(frames,self.path,compression=compression,
+                                  compression_level=self.complevel if self.complevel>0 else None)
+        else:
+            for key, df in frames.items():
+                if not isinstance(df,pd.DataFrame) or len(df)==0:
+                    continue
+                store_key = key
+                if self.is_chunked():
+                    store_key = get_hdf5_part_key(key,self._n_parts.get(key,0))
+                    self._n_parts[key] = self._n_parts.get(key,0)+1
+                df.to_hdf(self.path,key=store_key,complevel=self.complevel,complib=self.complib)
+
+        dt = time.perf_counter()-t_start
+        self.write_time += dt
+        self.n_records += n_records
+        self.n_bytes += n_bytes
+        self.n_flushes += 1
+        if self.verbose:
+            print(f'Flushed {n_records} records ({n_bytes/1e6:.1f} MB) to {self.path} in {dt:.2f} s '
+                  f'({n_records/dt if dt>0 else float("inf"):.1f} records/s written)')
+
+    def get_summary(self):
+        elapsed = time.perf_counter()-self.start_time
+        return (f'Wrote {self.n_records} records ({self.n_bytes/1e6:.1f} MB) in {self.n_flushes} flushes: '
+                f'{self.n_records/self.write_time if self.write_time>0 else float("inf"):.1f} records/s written, '
+                f'{self.n_records/elapsed if elapsed>0 else float("inf"):.1f} records/s overall')
@@ -0,0 +1,121 @@
+import numpy as np
+
+from dqmtools.dataframe_dict import get_view
+from .plot_utils import get_WIBEth_adc_matrix
+
+POOLING_MODES = ("maxabs","mean")
+
+def _pool2(adcs,pooling):
+    """
+    Halve both axes of a 2D array by pooling 2x2 blocks. Odd edges are
+    padded by repeating the last row/column.
+    """
+    adcs = np.pad(adcs,((0,adcs.shape[0]%2),(0,adcs.shape[1]%2)),mode="edge")
+    n0, n1 = adcs.shape[0]//2, adcs.shape[1]//2
+    blocks = adcs.reshape(n0,2,n1,2)
+    if pooling=="mean":
+        return np.rint(blocks.mean(axis=(1,3))).astype(adcs.dtype)
+
+    #keep the signed value with the largest magnitude, so single-tick spikes survive
+    blocks = blocks.transpose(0,2,1,3).reshape(n0,n1,4)
+    i_max = np.abs(blocks.astype(np.int32)).argmax(axis=2)
+    return np.take_along_axis(blocks,i_max[...,None],axis=2)[...,0]
+
+class ADCPyramid:
+    """
+    Level-of-detail pyramid of an ADCMatrix for interactive displays. Level 0
+    is the full channel x tick matrix; each further level halves both axes by
+    pooling 2x2 blocks ("maxabs" keeps the largest deviation, "mean" averages),
+    down to a single tile. Each level is split into tile_size x tile_size tiles,
+    and the channel and time coordinates of a level are those of the first
+    channel and tick of each block.
+    """
+
+    def __init__(self,matrix,pooling="maxabs",tile_size=256):
+        if pooling not in POOLING_MODES:
+            raise ValueError(f"Unknown pooling {pooling}, use one of {POOLING_MODES}")
+        self.index = matrix.index
+        self.pooling = pooling
+        self.tile_size = tile_size
+        self.levels = [ matrix.adcs ]
+        while max(self.levels[-1].shape)>tile_size and min(self.levels[-1].shape)>1:
+            self.levels.append(_pool2(self.levels[-1],pooling))
+        self.channels = [ matrix.channels[::1<<k] for k in range(len(self.levels)) ]
+        self.times = [ matrix.times[::1<<k] for k in range(len(self.levels)) ]
+
+    def get_n_levels(self):
+        return len(self.levels)
+
+    def _index_range(self,coords,value_range):
+        if value_range is None:
+            return 0, len(coords)
+        lo, hi = value_range
+        return int(np.searchsorted(coords,lo,side="left")), int(np.searchsorted(coords,hi,side="right"))
+
+    def get_level_for_window(self,channel_range=None,time_range=None,max_pixels=(1024,1024)):
+        """
+        Finest level at which the window fits in max_pixels (channels, ticks).
+        """
+        ch_lo, ch_hi = self._index_range(self.channels[0],channel_range)
+        t_lo, t_hi = self._index_range(self.times[0],time_range)
+        for level in range(len(self.levels)):
+            if (-(-(ch_hi-ch_lo)>>level)<=max_pixels[0]) and (-(-(t_hi-t_lo)>>level)<=max_pixels[1]):
+                return level
+        return len(self.levels)-1
+
+    def get_tile_indices(self,level,channel_range=None,time_range=None):
+        """
+        (i, j) of the tiles of a level covering the window, i along channels
+        and j along ticks.
+        """
+        ch_lo, ch_hi = self._index_range(self.channels[level],channel_range)
+        t_lo, t_hi = self._index_range(self.times[level],time_range)
+        if ch_hi<=ch_lo or t_hi<=t_lo:
+            return []
+        ts = self.tile_size
+        return [ (i,j) for i in range(ch_lo//ts,(ch_hi-1)//ts+1) for j in range(t_lo//ts,(t_hi-1)//ts+1) ]
+
+    def get_tile(self,level,i,j):
+        """
+        (channels, times, adcs) of one tile, as views into the level.
+        """
+        ts = self.tile_size
+        return (self.channels[level][i*ts:(i+1)*ts],
+                self.times[level][j*ts:(j+1)*ts],
+                self.levels[level][i*ts:(i+1)*ts,j*ts:(j+1)*ts])
+
+    def get_tiles(self,channel_range=None,time_range=None,max_pixels=(1024,1024)):
+        """
+        Level and {(i, j): tile} of the tiles needed to draw the window at
+        no more than max_pixels.
+        """
+        level = self.get_level_for_window(channel_range,time_range,max_pixels)
+        return level, { ij: self.get_tile(level,*ij) for ij in self.get_tile_indices(level,channel_range,time_range) }
+
+    def get_window(self,channel_range=None,time_range=None,max_pixels=(1024,1024)):
+        """
+        (channels, times, adcs) of the window at the finest level that fits in
+        max_pixels, as views into that level.
+        """
+        level = self.get_level_for_window(channel_range,time_range,max_pixels)
+        ch_lo, ch_hi = self._index_range(self.channels[level],channel_range)
+        t_lo, t_hi = self._index_range(self.times[level],time_range)
+        return (self.channels[level][ch_lo:ch_hi],
+                self.times[level][t_lo:t_hi],
+                self.levels[level][ch_lo:ch_hi,t_lo:t_hi])
+
+def get_WIBEth_adc_pyramid(df_dict,tpc_det_key,apa,plane,offset=True,offset_type="median",
+                           pooling="maxabs",tile_size=256,run=None,trigger=None,seq=None):
+    """
+    ADCPyramid of the ADC matrix of one record, APA and plane, built once per
+    record, APA, plane, offset and pooling when df_dict is a DataFrameDict.
+    None if the record is not found or has no data for the plane.
+    """
+    matrix = get_WIBEth_adc_matrix(df_dict,tpc_det_key,apa,plane,offset=offset,offset_type=offset_type,
+                                   run=run,trigger=trigger,seq=seq)
+    if matrix is None or len(matrix.channels)==0:
+        return None
+    record = (matrix.index.run,matrix.index.trigger,matrix.index.sequence)
+    return get_view(df_dict,("wibeth_adc_pyramid",tpc_det_key,record,apa,plane,offset,offset_type,pooling,tile_size),
+                    ["detw"+tpc_det_key[4:],tpc_det_key,"frh"],
+                    lambda d: ADCPyramid(matrix,pooling=pooling,tile_size=tile_size))
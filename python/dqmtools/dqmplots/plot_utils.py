@@ -1,6 +1,10 @@
 import rawdatautils.unpack.utils
 import dqmtools.dataframe_creator as dfc
 from dqmtools.dqmtools import *
+from dqmtools.dataframe_dict import get_view, get_ragged_column, get_record_rows, find_record
+
+from dataclasses import dataclass
+import numpy as np
 
 try:
     import pandas as pd
@@ -25,7 +29,191 @@ def _rename_PD2HD_APAs(apa_name):
     if(apa_name=="APA_P01NL"): return "APA4"
     return apa_name
 
+def _rename_frame_APAs(df):
+    df["apa"] = df["apa"].apply(_rename_PD2HD_APAs)
+    return True
+
 def rename_PD2HD_APAs(df_dict):
     for key, val in df_dict.items():
         if "apa" in val.columns:
-            val["apa"] = val["apa"].apply(_rename_PD2HD_APAs)
+            #the frame is renamed in place, so on a DataFrameDict this runs once per frame
+            get_view(df_dict,("renamed_apas",key),[key],lambda d: _rename_frame_APAs(val))
+
+def _get_values(df,name):
+    if name in df.columns:
+        return df[name].values
+    return df.index.get_level_values(name).values
+
+def get_trigger_timestamp(df_dict,record):
+    """
+    Trigger timestamp of a (run, trigger, sequence) record, from its fragment
+    headers (it is the same in all of them), or None.
+    """
+    frh_rows = get_record_rows(df_dict,"frh").get(record)
+    if frh_rows is None:
+        return None
+    return np.int64(df_dict["frh"]["trigger_timestamp_dts"].values[frh_rows[0]])
+
+def _channel_rows(df):
+    keys = zip(*[ _get_values(df,name).tolist() for name in ["run","trigger","sequence","channel"] ])
+    #built back to front, so the first row of a channel wins
+    return dict(reversed(list(zip(keys,range(len(df))))))
+
+def get_channel_rows(df_dict,key):
+    """
+    Row position in df_dict[key] of each (run, trigger, sequence, channel).
+    """
+    return get_view(df_dict,("channel_rows",key),[key],lambda d: _channel_rows(d[key]))
+
+def get_channel_value(df_dict,key,record,channel,column):
+    """
+    Value of column for one channel of a record in df_dict[key], or None.
+    """
+    row = get_channel_rows(df_dict,key).get((*record,channel))
+    return None if row is None else df_dict[key][column].values[row]
+
+def get_waveform_arrays(df_dict,tpc_wvfm_key,record,channel):
+    """
+    (timestamps, adcs) of one channel of a record, as views into the flat
+    waveform buffers, or None if the channel is not in the record.
+    """
+    row = get_channel_rows(df_dict,tpc_wvfm_key).get((*record,channel))
+    if row is None:
+        return None
+    ts_values, ts_offsets = get_ragged_column(df_dict,tpc_wvfm_key,"timestamps")
+    adc_values, adc_offsets = get_ragged_column(df_dict,tpc_wvfm_key,"adcs")
+    return ts_values[ts_offsets[row]:ts_offsets[row+1]], adc_values[adc_offsets[row]:adc_offsets[row+1]]
+
+@dataclass
+class ADCMatrix:
+    """
+    Waveforms of one record, APA and plane as a channel x tick int16 matrix,
+    rows sorted by channel, with one time axis (DTS ticks relative to the
+    trigger timestamp) shared by all channels. Shorter waveforms are zero padded.
+    """
+    index: object
+    channels: np.ndarray
+    times: np.ndarray
+    adcs: np.ndarray
+
+    def get_waveform(self,channel):
+        """
+        (times, adcs) of one channel, as views into the matrix, or None.
+        """
+        i = np.searchsorted(self.channels,channel)
+        if i>=len(self.channels) or self.channels[i]!=channel:
+            return None
+        return self.times, self.adcs[i]
+
+def _build_WIBEth_adc_matrix(df_dict,tpc_det_key,record,apa,plane,offset_var):
+    tpc_wvfm_key = "detw"+tpc_det_key[4:]
+    df_wvfm = df_dict[tpc_wvfm_key]
+
+    rows = get_record_rows(df_dict,tpc_wvfm_key)[record]
+    rows = rows[(df_wvfm["apa"].values[rows]==apa)&(df_wvfm["plane"].values[rows]==plane)]
+    channels = _get_values(df_wvfm,"channel")[rows]
+    order = np.argsort(channels,kind="stable")
+    rows, channels = rows[order], channels[order]
+
+    #gather the ragged ADC arrays into the matrix in one step
+    values, offsets = get_ragged_column(df_dict,tpc_wvfm_key,"adcs")
+    lengths = offsets[rows+1]-offsets[rows]
+    n_ticks = int(lengths.max()) if len(rows)>0 else 0
+    ticks = np.arange(n_ticks)
+    valid = ticks[None,:]<lengths[:,None]
+    adcs = np.zeros((len(rows),n_ticks),dtype=np.int32)
+    adcs[valid] = values[(offsets[rows][:,None]+ticks[None,:])[valid]]
+
+    if offset_var is not None:
+        df_det = df_dict[tpc_det_key]
+        det_rows = get_record_rows(df_dict,tpc_det_key).get(record,np.empty(0,dtype=np.int64))
+        pedestals = pd.Series(df_det[offset_var].values[det_rows],index=_get_values(df_det,"channel")[det_rows])
+        pedestals = pedestals[~pedestals.index.duplicated()].reindex(channels).fillna(0).values
+        adcs -= np.rint(pedestals).astype(np.int32)[:,None]
+        adcs[~valid] = 0
+
+    times = np.empty(0,dtype=np.int64)
+    if len(rows)>0:
+        ts_values, ts_offsets = get_ragged_column(df_dict,tpc_wvfm_key,"timestamps")
+        longest = rows[np.argmax(lengths)]
+        times = ts_values[ts_offsets[longest]:ts_offsets[longest+1]].astype(np.int64)
+        trigger_ts = get_trigger_timestamp(df_dict,record)
+        if trigger_ts is not None:
+            times = times-trigger_ts
+
+    return ADCMatrix(index=dfc.RecordDataBase(run=record[0],trigger=record[1],sequence=record[2]),
+                     channels=channels,times=times,adcs=adcs.astype(np.int16))
+
+def get_WIBEth_adc_matrix(df_dict,tpc_det_key,apa,plane,offset=True,offset_type="median",
+                          run=None,trigger=None,seq=None):
+    """
+    ADCMatrix of the selected record (the first one by default) for one APA
+    and plane, pedestal subtracted with the adc_{offset_type} column of
+    tpc_det_key if offset. Built once per record, APA, plane and offset when
+    df_dict is a DataFrameDict. None if the record is not found.
+    """
+    #the matrix selects on the renamed APAs, so rename before it is cached
+    rename_PD2HD_APAs(df_dict)
+    tpc_wvfm_key = "detw"+tpc_det_key[4:]
+    record = find_record(df_dict,tpc_wvfm_key,run,trigger,seq)
+    if record is None:
+        return None
+    offset_var = f'adc_{offset_type}' if offset else None
+    return get_view(df_dict,("wibeth_adc_matrix",tpc_det_key,record,apa,plane,offset_var),[tpc_wvfm_key,tpc_det_key,"frh"],
+                    lambda d: _build_WIBEth_adc_matrix(d,tpc_det_key,record,apa,plane,offset_var))
+
+TP_KEY = "trgd_kDAQ_kTriggerPrimitive"
+
+#a TP read out through more than one source ID shows up once per source ID
+TP_DUPLICATE_INDEX = ["run","trigger","sequence","channel","time_start","time_over_threshold"]
+
+TP_HOVER_TEMPLATE = ("start: %{customdata[0]}<br>peak: %{customdata[1]}<br>end: %{customdata[2]}<br>tot: %{customdata[3]}<br>"
+                     "channel: %{customdata[4]}<br>sum adc: %{customdata[5]}<br>peak adc: %{customdata[6]}<extra></extra>")
+
+def get_TP_hover_data(df_tp):
+    """
+    Per-TP values shown by TP_HOVER_TEMPLATE, as one array for customdata.
+    """
+    return np.column_stack([ df_tp[col].values for col in ["time_start_trg_sub","time_peak_trg_sub","time_end_trg_sub",
+                                                          "time_over_threshold","channel","adc_integral","adc_peak"] ])
+
+def _prepare_TPs(df_dict):
+    df_tp = df_dict[TP_KEY].reset_index()
+    df_tp = df_tp.drop_duplicates(TP_DUPLICATE_INDEX)
+
+    #the trigger timestamp is the same in all fragment headers of a record
+    trigger_ts = df_dict["frh"]["trigger_timestamp_dts"].groupby(level=["run","trigger","sequence"]).first()
+    df_tp = df_tp.join(trigger_ts,on=["run","trigger","sequence"],how="inner")
+
+    trigger_ts = df_tp["trigger_timestamp_dts"].values.astype(np.int64)
+    df_tp["time_start_trg_sub"] = df_tp["time_start"].values.astype(np.int64)-trigger_ts
+    df_tp["time_peak_trg_sub"] = df_tp["time_peak"].values.astype(np.int64)-trigger_ts
+    df_tp["time_end_trg_sub"] = df_tp["time_start_trg_sub"].values+df_tp["time_over_threshold"].values.astype(np.int64)
+    return df_tp.reset_index(drop=True)
+
+def get_TPs(df_dict):
+    """
+    Trigger primitives with duplicates (same record, channel, start time and
+    time over threshold) removed, index levels as columns, and start, peak and
+    end times relative to the trigger timestamp.
+    """
+    rename_PD2HD_APAs(df_dict)
+    return get_view(df_dict,("tp_overlay",),[TP_KEY,"frh"],_prepare_TPs)
+
+def select_TPs(df_dict,apa=None,plane=None,channel=None,run=None,trigger=None,seq=None):
+    """
+    Rows of get_TPs for one record (the first one by default), optionally
+    restricted to an APA, plane or channel.
+    """
+    df_tp = get_TPs(df_dict)
+    record = find_record(df_dict,TP_KEY,run,trigger,seq)
+    if record is None:
+        return df_tp.iloc[:0]
+    mask = (df_tp["run"].values==record[0])&(df_tp["trigger"].values==record[1])&(df_tp["sequence"].values==record[2])
+    if apa is not None:
+        mask &= df_tp["apa"].values==apa
+    if plane is not None:
+        mask &= df_tp["plane"].values==plane
+    if channel is not None:
+        mask &= df_tp["channel"].values==channel
+    return df_tp.loc[mask]
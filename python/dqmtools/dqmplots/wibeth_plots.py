@@ -11,7 +11,8 @@ try:
     from plotly.subplots import make_subplots
     import numpy as np
 
-    from PIL import Image
+    from PIL import Image, ImageDraw, ImageFont
+    import matplotlib
     from matplotlib.colors import Normalize
     from matplotlib import cm
 
@@ -26,6 +27,7 @@ except:
     raise
 
 from .plot_utils import *
+from .adc_pyramid import *
 
 def empty_plot(text="NO DATA"):
 
@@ -139,12 +141,17 @@ def plot_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,
                         offset=True,offset_type="median",
                         make_static=False,make_tp_overlay=False,
                         orientation="vertical",colorscale='plasma',color_range=(-256,256),
+                        channel_range=None,time_range=None,max_pixels=(1024,1024),pooling="maxabs",
                         run=None,trigger=None,seq=None):
+    """
+    ADC map of one APA and plane. The static version is drawn from the full
+    matrix; the interactive one only sends the channel_range x time_range window
+    (default: all), at the finest level of the ADC pyramid that fits in
+    max_pixels (channels, ticks).
+    """
 
     rename_PD2HD_APAs(df_dict)
 
-    offset_var = f'adc_{offset_type}'
-    
     tpc_wvfm_key = "detw"+tpc_det_key[4:]
 
     if tpc_det_key not in df_dict.keys():
@@ -154,31 +161,23 @@ def plot_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,
     if tpc_wvfm_key not in df_dict.keys():
         print(f"Can not make plots for {tpc_wvfm_key}, no DATA found")
         return empty_plot()
-    
-    df_tmp = df_dict[tpc_wvfm_key]
-    df_tmp = df_tmp.loc[(df_tmp["apa"]==apa)&(df_tmp["plane"]==plane)]
 
-    df_tmp = df_tmp.merge(df_dict["frh"]["trigger_timestamp_dts"],left_index=True,right_index=True)
-    if offset:
-        df_tmp = df_tmp.merge(df_dict[tpc_det_key][offset_var],left_index=True,right_index=True)
-
-    df_tmp, index = dfc.select_record(df_tmp,run,trigger,seq)
-    df_tmp = df_tmp.reset_index()
-    df_tmp["timestamps_trg_sub"] = df_tmp.apply(lambda x: x.timestamps.astype(np.int64) - x.trigger_timestamp_dts,axis=1)
-    if offset:
-        df_tmp["adcs"] = df_tmp["adcs"]-df_tmp[offset_var]
-    df_tmp = df_tmp.sort_values("channel")
+    matrix = get_WIBEth_adc_matrix(df_dict,tpc_det_key,apa,plane,offset=offset,offset_type=offset_type,
+                                   run=run,trigger=trigger,seq=seq)
+    if matrix is None or len(matrix.channels)==0:
+        print(f"Can not make plots for {apa} plane {plane}, no DATA found")
+        return empty_plot()
 
     if orientation=="horizontal":
-        xdata = df_tmp.iloc[0]["timestamps_trg_sub"]
-        ydata = df_tmp["channel"].values
-        zdata = np.vstack(df_tmp["adcs"].values)
+        xdata = matrix.times
+        ydata = matrix.channels
+        zdata = matrix.adcs
         yaxis_title='Offline Channel'
         xaxis_title='DTS time ticks (16ns)'
     else:
-        ydata = df_tmp.iloc[0]["timestamps_trg_sub"]
-        xdata = df_tmp["channel"].values
-        zdata = np.vstack(df_tmp["adcs"].values).T
+        ydata = matrix.times
+        xdata = matrix.channels
+        zdata = matrix.adcs.T
         xaxis_title='Offline Channel'
         yaxis_title='DTS time ticks (16ns)'
 
@@ -239,9 +238,16 @@ def plot_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,
             yaxis=dict(showgrid=False, zeroline=False, range=[ymin, ymax]))
 
     else:
+        pyramid = get_WIBEth_adc_pyramid(df_dict,tpc_det_key,apa,plane,offset=offset,offset_type=offset_type,
+                                         pooling=pooling,run=run,trigger=trigger,seq=seq)
+        channels, times, adcs = pyramid.get_window(channel_range,time_range,max_pixels)
+        if orientation=="horizontal":
+            xdata, ydata, zdata = times, channels, adcs
+        else:
+            xdata, ydata, zdata = channels, times, adcs.T
         fig=px.imshow(zdata,
                       aspect="auto", origin='lower',
-                      x=list(xdata),y=list(ydata),
+                      x=xdata,y=ydata,
                       color_continuous_scale=colorscale,
                       zmin=zmin,zmax=zmax)
 
@@ -255,50 +261,36 @@ def plot_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,
         return fig
 
     #if we are, let's grab the TPs
-    df_tmp = df_dict["trgd_kDAQ_kTriggerPrimitive"]
-
-    #ugly hack while we can't better decide which src ids to ignore for duplicated TPs
-    n_apas = len(np.unique(df_tmp["apa"]))
-    idx_names = df_tmp.index.names
-    df_tmp = df_tmp.reset_index()
-    df_tmp = df_tmp.loc[(df_tmp["src_id"]<n_apas*3)]
-    df_tmp = df_tmp.set_index(idx_names)
-
-    df_tmp = df_tmp.loc[(df_tmp["apa"]==apa)&(df_tmp["plane"]==plane)]
-    df_tmp = df_tmp.merge(df_dict["frh"]["trigger_timestamp_dts"],left_index=True,right_index=True)
+    if TP_KEY not in df_dict:
+        return fig
 
+    #TPs of the record the ADC map shows
+    df_tmp = select_TPs(df_dict,apa=apa,plane=plane,run=matrix.index.run,trigger=matrix.index.trigger,seq=matrix.index.sequence)
     if len(df_tmp)==0:
         return fig
-    
-    df_tmp, index = dfc.select_record(df_tmp,run,trigger,seq)
-    df_tmp = df_tmp.reset_index()
-
-    df_tmp["time_peak_trg_sub"] = df_tmp.apply(lambda x: x.time_peak - x.trigger_timestamp_dts,axis=1)
-    df_tmp["time_start_trg_sub"] = df_tmp.apply(lambda x: x.time_start - x.trigger_timestamp_dts,axis=1)
-
-    df_tmp["marker_string"] = df_tmp.apply(lambda x: f"start: {x.time_start_trg_sub}<br>peak: {x.time_peak_trg_sub}<br>end: {x.time_start_trg_sub+x.time_over_threshold}<br>tot: {x.time_over_threshold}<br>channel: {x.channel}<br>sum adc: {x.adc_integral}<br>peak adc: {x.adc_peak}",axis=1)
 
     if orientation=="horizontal":
-        xdata = df_tmp["time_peak_trg_sub"]
-        ydata = df_tmp["channel"]
+        xdata = df_tmp["time_peak_trg_sub"].values
+        ydata = df_tmp["channel"].values
     else:
-        ydata = df_tmp["time_peak_trg_sub"]
-        xdata = df_tmp["channel"]
+        ydata = df_tmp["time_peak_trg_sub"].values
+        xdata = df_tmp["channel"].values
 
     tp_fig=go.Scattergl(
         x=xdata,
         y=ydata,
         mode='markers', name="Trigger Primitives",
-        marker=dict(size=df_tmp["adc_integral"],
+        marker=dict(size=df_tmp["adc_integral"].values,
                     sizemode='area',
-                    sizeref=2.*max(df_tmp['adc_integral'])/(12**2),sizemin=3,
-                    color=df_tmp['adc_peak'], #set color equal to a variable
+                    sizeref=2.*df_tmp['adc_integral'].max()/(12**2),sizemin=3,
+                    color=df_tmp['adc_peak'].values, #set color equal to a variable
                     colorscale="delta", # one of plotly colorscales
                     cmin = 0,
                     cmax = zmax,
                     showscale=True,colorbar=dict( x=1.12 )
                     ),
-        text=df_tmp["marker_string"],
+        customdata=get_TP_hover_data(df_tmp),
+        hovertemplate=TP_HOVER_TEMPLATE,
     )
 
     fig.add_trace(tp_fig)
@@ -306,6 +298,131 @@ def plot_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,
     return fig
 
 
+#image formats written directly by render_adc_matrix, without plotly
+RASTER_FORMATS = ("png","webp","jpeg","jpg")
+
+def _get_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        #older Pillow: fixed size bitmap font
+        return ImageFont.load_default()
+
+def _nice_ticks(vmin,vmax,n_ticks=6):
+    if vmax<=vmin:
+        return np.array([vmin])
+    raw_step = (vmax-vmin)/n_ticks
+    magnitude = 10**np.floor(np.log10(raw_step))
+    step = magnitude*min([ m for m in (1,2,5,10) if m*magnitude>=raw_step ])
+    return np.arange(np.ceil(vmin/step)*step,vmax+step*1e-9,step)
+
+def _tick_label(v):
+    return f"{v:.0f}" if float(v).is_integer() else f"{v:g}"
+
+def render_adc_matrix(matrix,filename,title=None,orientation="vertical",colorscale="plasma",color_range=(-256,256),
+                      plot_size=(1200,900),font_size=18):
+    """
+    Write an ADCMatrix straight to an image file (PNG, WebP or JPEG, by the
+    file extension) with PIL. Pixels are colormapped through a 256-entry
+    lookup table, resampled to plot_size (None keeps one pixel per channel
+    and tick), and axes, ticks and a colorbar are drawn with ImageDraw.
+    Returns the file name, or None if the matrix is empty.
+    """
+    if matrix.adcs.size==0:
+        print(f"Can not write {filename}, the ADC matrix is empty")
+        return None
+
+    zmin, zmax = color_range
+    if zmin is None:
+        zmin = int(matrix.adcs.min())
+    if zmax is None:
+        zmax = int(matrix.adcs.max())
+
+    #time (or channel) increases upwards, so the first image row is the last matrix row
+    if orientation=="horizontal":
+        zdata = matrix.adcs[::-1]
+        xdata, ydata = matrix.times, matrix.channels
+        xaxis_title, yaxis_title = 'DTS time ticks (16ns)', 'Offline Channel'
+    else:
+        zdata = matrix.adcs.T[::-1]
+        xdata, ydata = matrix.channels, matrix.times
+        xaxis_title, yaxis_title = 'Offline Channel', 'DTS time ticks (16ns)'
+
+    lut = (matplotlib.colormaps[colorscale](np.linspace(0,1,256))[:,:3]*255).astype(np.uint8)
+    scale = 255./(zmax-zmin) if zmax>zmin else 0.
+    codes = np.clip((zdata.astype(np.float32)-zmin)*scale,0,255).astype(np.uint8)
+    plot_img = Image.fromarray(lut[codes])
+    if plot_size is not None:
+        plot_img = plot_img.resize(plot_size,Image.Resampling.BOX)
+    plot_w, plot_h = plot_img.size
+
+    font = _get_font(font_size)
+    left, right, top, bottom = 5*font_size, 7*font_size, 3*font_size, 4*font_size
+    img = Image.new("RGB",(left+plot_w+right,top+plot_h+bottom),"white")
+    img.paste(plot_img,(left,top))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([left-1,top-1,left+plot_w,top+plot_h],outline="black")
+
+    def x_pixel(v):
+        return left+(v-xdata[0])/(xdata[-1]-xdata[0])*(plot_w-1) if xdata[-1]!=xdata[0] else left
+    def y_pixel(v,vmin,vmax,height=plot_h):
+        return top+(vmax-v)/(vmax-vmin)*(height-1) if vmax!=vmin else top
+
+    for v in _nice_ticks(xdata[0],xdata[-1]):
+        x = x_pixel(v)
+        draw.line([x,top+plot_h,x,top+plot_h+font_size//3],fill="black")
+        draw.text((x,top+plot_h+font_size//2),_tick_label(v),fill="black",font=font,anchor="mt")
+    draw.text((left+plot_w//2,top+plot_h+2*font_size),xaxis_title,fill="black",font=font,anchor="mt")
+
+    for v in _nice_ticks(ydata[0],ydata[-1]):
+        y = y_pixel(v,ydata[0],ydata[-1])
+        draw.line([left-font_size//3,y,left,y],fill="black")
+        draw.text((left-font_size//2,y),_tick_label(v),fill="black",font=font,anchor="rm")
+    label = Image.new("RGB",(plot_h,int(1.5*font_size)),"white")
+    ImageDraw.Draw(label).text((plot_h//2,0),yaxis_title,fill="black",font=font,anchor="mt")
+    label = label.rotate(90,expand=True)
+    img.paste(label,(0,top),label.convert("L").point(lambda p: 255-p))
+
+    #colorbar
+    bar_x = left+plot_w+font_size
+    bar = Image.fromarray(np.repeat(lut[::-1][:,None,:],font_size,axis=1)).resize((font_size,plot_h),Image.Resampling.BILINEAR)
+    img.paste(bar,(bar_x,top))
+    draw.rectangle([bar_x-1,top-1,bar_x+font_size,top+plot_h],outline="black")
+    for v in _nice_ticks(zmin,zmax):
+        y = y_pixel(v,zmin,zmax)
+        draw.line([bar_x+font_size,y,bar_x+font_size+font_size//3,y],fill="black")
+        draw.text((bar_x+font_size+font_size//2,y),_tick_label(v),fill="black",font=font,anchor="lm")
+
+    if title is not None:
+        draw.text((left+plot_w//2,top//2),title,fill="black",font=font,anchor="mm")
+
+    img.save(filename)
+    return filename
+
+def render_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,filename,
+                          offset=True,offset_type="median",title=None,
+                          orientation="vertical",colorscale='plasma',color_range=(-256,256),plot_size=(1200,900),
+                          run=None,trigger=None,seq=None):
+    """
+    Static ADC map of one APA and plane written directly to an image file,
+    the fast counterpart of plot_WIBEth_adc_map(make_static=True).
+    Returns the file name, or None if there is no data.
+    """
+    rename_PD2HD_APAs(df_dict)
+
+    if tpc_det_key not in df_dict.keys() or "detw"+tpc_det_key[4:] not in df_dict.keys():
+        print(f"Can not make plots for {tpc_det_key}, no DATA found")
+        return None
+
+    matrix = get_WIBEth_adc_matrix(df_dict,tpc_det_key,apa,plane,offset=offset,offset_type=offset_type,
+                                   run=run,trigger=trigger,seq=seq)
+    if matrix is None or len(matrix.channels)==0:
+        print(f"Can not make plots for {apa} plane {plane}, no DATA found")
+        return None
+
+    return render_adc_matrix(matrix,filename,title=title,orientation=orientation,
+                             colorscale=colorscale,color_range=color_range,plot_size=plot_size)
+
 def plot_WIBEth_waveform(df_dict,tpc_det_key,channel,
                          offset=False,offset_type='median',
                          overlay_tps=False,
@@ -325,30 +442,23 @@ def plot_WIBEth_waveform(df_dict,tpc_det_key,channel,
         print(f"Can not make plots for {tpc_wvfm_key}, no DATA found")
         return empty_plot()
 
-    df_tmp = df_dict[tpc_wvfm_key]
-    idx_names = df_tmp.index.names
-    df_tmp = df_tmp.reset_index()
-    df_tmp = df_tmp.loc[df_tmp["channel"]==channel]
-    df_tmp = df_tmp.set_index(idx_names)
-
-    df_tmp = df_tmp.merge(df_dict["frh"]["trigger_timestamp_dts"],left_index=True,right_index=True)
-    if offset:
-        df_tmp = df_tmp.merge(df_dict[tpc_det_key][offset_var],left_index=True,right_index=True)
-
-    df_tmp, index = dfc.select_record(df_tmp,run,trigger,seq)
-    df_tmp = df_tmp.reset_index()
+    record = find_record(df_dict,tpc_wvfm_key,run,trigger,seq)
+    wvfm = None if record is None else get_waveform_arrays(df_dict,tpc_wvfm_key,record,channel)
+    if wvfm is None:
+        print(f"Can not make plots for channel {channel}, no DATA found")
+        return empty_plot()
+    timestamps, wvfm_adcs = wvfm
 
-    df_tmp["timestamps_trg_sub"] = df_tmp.apply(lambda x: x.timestamps.astype(np.int64) - x.trigger_timestamp_dts,axis=1)
+    trigger_ts = get_trigger_timestamp(df_dict,record)
+    times = timestamps.astype(np.int64)-(trigger_ts if trigger_ts is not None else 0)
     yaxis_title = "ADC counts"
     if offset:
-        df_tmp["adcs"] = df_tmp["adcs"]-df_tmp[offset_var]
-        yaxis_title = yaxis_title + " (pedestal subtracted)"
-
-    print(df_tmp)
-    print(df_tmp["timestamps"].values[0])
-    print(df_tmp["adcs"].values[0])
-    fig = go.Figure(data=go.Scatter(x=df_tmp["timestamps_trg_sub"].values[0], y=df_tmp["adcs"].values[0]))
+        pedestal = get_channel_value(df_dict,tpc_det_key,record,channel,offset_var)
+        if pedestal is not None:
+            wvfm_adcs = wvfm_adcs-pedestal
+            yaxis_title = yaxis_title + " (pedestal subtracted)"
 
+    fig = go.Figure(data=go.Scatter(x=times, y=wvfm_adcs, name=f"Channel {channel}"))
 
     fig.update_layout(xaxis_title='DTS Timestmap (16ns) relative to trigger',
                       yaxis_title=yaxis_title,
@@ -359,37 +469,27 @@ def plot_WIBEth_waveform(df_dict,tpc_det_key,channel,
         return fig
 
     #if we are, let's grab the TPs
-
-    if "trgd_kDAQ_kTriggerPrimitive" not in df_dict:
+    if TP_KEY not in df_dict:
         return fig
-            
-    df_tmp = df_dict["trgd_kDAQ_kTriggerPrimitive"]
-
-    #ugly hack while we can't better decide which src ids to ignore for duplicated TPs
-    n_apas = len(np.unique(df_tmp["apa"]))
-    idx_names = df_tmp.index.names
-    df_tmp = df_tmp.reset_index()
-    df_tmp = df_tmp.loc[(df_tmp["src_id"]<n_apas*3)]
-    df_tmp = df_tmp.set_index(idx_names)
-
-    idx_names = df_tmp.index.names
-    df_tmp = df_tmp.reset_index()
-    df_tmp = df_tmp.loc[df_tmp["channel"]==channel]
-    df_tmp = df_tmp.set_index(idx_names)
-
-    df_tmp = df_tmp.merge(df_dict["frh"]["trigger_timestamp_dts"],left_index=True,right_index=True)
 
+    df_tmp = select_TPs(df_dict,channel=channel,run=record[0],trigger=record[1],seq=record[2])
     if len(df_tmp)==0:
         return fig
-    
-    df_tmp, index = dfc.select_record(df_tmp,run,trigger,seq)
-    df_tmp = df_tmp.reset_index()
-    df_tmp["time_peak_trg_sub"] = df_tmp.apply(lambda x: x.time_peak - x.trigger_timestamp_dts,axis=1)
-    df_tmp["time_start_trg_sub"] = df_tmp.apply(lambda x: x.time_start - x.trigger_timestamp_dts,axis=1)
-    df_tmp["time_end_trg_sub"] = df_tmp.apply(lambda x: x.time_start_trg_sub + x.time_over_threshold,axis=1)
 
-    for index, tp in df_tmp.iterrows():
-        fig.add_vrect(tp['time_start_trg_sub'], tp['time_end_trg_sub'], line_width=0, fillcolor="red", opacity=0.2)
-        fig.add_vline(x=tp["time_peak_trg_sub"], line_width=1, line_dash="dash", line_color="red")
+    #all TP windows and peak lines as two traces, NaN separated
+    ymin, ymax = np.min(wvfm_adcs), np.max(wvfm_adcs)
+    start = df_tmp["time_start_trg_sub"].values
+    end = df_tmp["time_end_trg_sub"].values
+    peak = df_tmp["time_peak_trg_sub"].values
+    gap = np.full(len(df_tmp),np.nan)
+    fig.add_trace(go.Scatter(x=np.column_stack([start,start,end,end,start,gap]).ravel(),
+                             y=np.tile([ymin,ymax,ymax,ymin,ymin,np.nan],len(df_tmp)),
+                             fill="toself",fillcolor="rgba(255,0,0,0.2)",line_width=0,mode="lines",
+                             name="TP windows",hoverinfo="skip"))
+    fig.add_trace(go.Scatter(x=np.column_stack([peak,peak,gap]).ravel(),
+                             y=np.tile([ymin,ymax,np.nan],len(df_tmp)),
+                             mode="lines",line=dict(width=1,dash="dash",color="red"),name="TP peaks",
+                             customdata=np.repeat(get_TP_hover_data(df_tmp),3,axis=0),
+                             hovertemplate=TP_HOVER_TEMPLATE))
 
     return fig
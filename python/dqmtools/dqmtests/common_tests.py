@@ -1,5 +1,7 @@
 from dqmtools.dqmtools import *
+from dqmtools.dataframe_dict import get_view
 from rawdatautils.unpack.dataclasses import *
+import detdataformats
 
 import numpy as np
 import operator
@@ -9,6 +11,7 @@ class CheckAllExpectedFragmentsTest(DQMTest):
     def __init__(self):
         super().__init__()
         self.name = 'CheckAllExpectedFragmentsTest'
+        self.input_keys = ["trh"]
 
     def run_test(self,df_dict):
         df_tmp = (df_dict["trh"]["n_fragments"]!=df_dict["trh"]["n_requested_components"])
@@ -18,43 +21,72 @@ class CheckAllExpectedFragmentsTest(DQMTest):
         else:
             return DQMTestResult(DQMResultEnum.BAD,f'{n_not_matched} / {len(df_tmp)} records missing fragments.')
 
+def _timestamp_majority(df_dict):
+    df_daqh = df_dict["daqh"]
+    group_names = ["run","trigger","sequence","det_id"]
+    df_tmp = pd.DataFrame({"run": df_daqh.index.get_level_values("run"),
+                           "trigger": df_daqh.index.get_level_values("trigger"),
+                           "sequence": df_daqh.index.get_level_values("sequence"),
+                           "det_id": df_daqh["det_id"].values,
+                           "timestamp_first_dts": df_daqh["timestamp_first_dts"].values})
+
+    #run lengths of each distinct timestamp per record and detector
+    df_counts = df_tmp.groupby(group_names+["timestamp_first_dts"]).size().reset_index(name="count")
+    n_unique = df_counts.groupby(group_names).size()
+
+    #majority is the most frequent timestamp, the earliest one on ties
+    df_mode = df_counts.sort_values(group_names+["count","timestamp_first_dts"],
+                                    ascending=[True,True,True,True,False,True]).drop_duplicates(group_names)
+    df_mode = df_mode.set_index(group_names)
+
+    return pd.DataFrame({"n_unique": n_unique,
+                         "timestamp_first_dts_majority": df_mode["timestamp_first_dts"].reindex(n_unique.index)})
+
+def get_timestamp_majority(df_dict):
+    """
+    Per (run, trigger, sequence, det_id): number of distinct timestamp_first_dts
+    values among the DAQ headers, and the majority value. Computed once for all
+    detector IDs and shared by every CheckTimestampsAligned instance.
+    """
+    return get_view(df_dict,"daqh_timestamp_majority",["daqh"],_timestamp_majority)
+
 class CheckTimestampsAligned(DQMTest):
 
     def __init__(self,det_id,verbose=True):
         super().__init__()
         self.det_id = det_id
-        self.name = f'CheckTimestampsAligned_{det_id}'
+        self.det_ids = list(det_id) if isinstance(det_id,(list,tuple)) else [det_id]
+        self.name = f'CheckTimestampsAligned_{"_".join([ str(d) for d in self.det_ids ])}'
         self.verbose = verbose
-        
-    def any_different(arr):
-        return (arr.values!=arr.values[0]).sum()
-
-    def unique(arr):
-        return np.unique(arr.values,return_counts=True)
+        det_names = [ detdataformats.DetID.Subdetector(d).name for d in self.det_ids ]
+        self.input_keys = [ f'{prefix}_{det_name}' for prefix in ["daqh","frh"] for det_name in det_names ]
     
     def run_test(self,df_dict):
-        df_tmp = df_dict["daqh"].loc[df_dict["daqh"]["det_id"]==self.det_id]
+        df_major = get_timestamp_majority(df_dict)
+        df_major = df_major.loc[df_major.index.get_level_values("det_id").isin(self.det_ids)]
         
-        if len(df_tmp)==0:
+        if len(df_major)==0:
             return DQMTestResult(DQMResultEnum.WARNING,f'WARNING: No components found with detector id {self.det_id}.')
         
-        df_tmp_gb = df_tmp.groupby(by=["run","trigger","sequence"])["timestamp_first_dts"].agg(CheckTimestampsAligned.unique)
-        df_tmp_gb_n = df_tmp_gb.apply(lambda x: len(x[1]))
-        n_different = (df_tmp_gb_n!=1).sum()
+        n_different = (df_major["n_unique"]!=1).sum()
 
         if n_different==0:
             return DQMTestResult(DQMResultEnum.OK,f'OK')
         else:
             if self.verbose:
-                df_tmp_fr = df_dict["frh"].loc[df_dict["frh"]["det_id"]==self.det_id][["trigger_timestamp_dts","window_begin_dts","window_end_dts"]]
-                
-                df_tmp_gb_mode = df_tmp_gb.apply(lambda x: x[0][np.argmax(x[1])])
-                df_tmp = df_tmp.join(df_tmp_gb_mode,rsuffix='_majority')
-                df_tmp = df_tmp.join(df_tmp_fr)
-                df_tmp = df_tmp.loc[(df_tmp["timestamp_first_dts"]!=df_tmp["timestamp_first_dts_majority"])]
+                df_tmp = df_dict["daqh"].loc[df_dict["daqh"]["det_id"].isin(self.det_ids)]
+                group_index = pd.MultiIndex.from_arrays([df_tmp.index.get_level_values("run"),
+                                                         df_tmp.index.get_level_values("trigger"),
+                                                         df_tmp.index.get_level_values("sequence"),
+                                                         df_tmp["det_id"].values])
+                majority = df_major["timestamp_first_dts_majority"].reindex(group_index).values
+                is_different = (df_tmp["timestamp_first_dts"].values!=majority)
+                df_tmp = df_tmp.loc[is_different].assign(timestamp_first_dts_majority=majority[is_different])
+                n_different = len(np.unique(np.asarray(df_tmp.index.get_level_values("src_id"),dtype=np.int64)))
 
+                df_tmp_fr = df_dict["frh"].loc[df_dict["frh"]["det_id"].isin(self.det_ids)][["trigger_timestamp_dts","window_begin_dts","window_end_dts"]]
+                df_tmp = df_tmp.join(df_tmp_fr)
                 df_tmp["timestamp_diff"] = df_tmp["timestamp_first_dts"]-df_tmp["timestamp_first_dts_majority"]
-                n_different = len(np.unique(df_tmp.reset_index()["src_id"].apply(lambda x: int(x))))
                 print(f"\nFRAGMENTS FAILING TIMESTAMP ALIGNMENT for Detector ID {self.det_id}")
                 print(tabulate(df_tmp.reset_index()[["trigger","sequence","crate_id","slot_id","stream_id","timestamp_first_dts","timestamp_first_dts_majority","timestamp_diff",
                                                      "window_begin_dts","window_end_dts"]],
@@ -63,4 +95,3 @@ class CheckTimestampsAligned(DQMTest):
 
             return DQMTestResult(DQMResultEnum.BAD,
                                  f'{n_different} sources have some timestamp misalignment for det_id {self.det_id}.')
-
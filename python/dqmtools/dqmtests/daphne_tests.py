@@ -9,6 +9,8 @@ class CheckEmptyFragments_DAPHNE(DQMTest):
     def __init__(self):
         super().__init__()
         self.name = "CheckEmptyFragments_DAPHNE"
+        #self-triggered DAPHNE fragments only
+        self.input_keys = ["frh_kDAPHNE"]
 
     def run_test(self,df_dict):
         df_tmp1 = df_dict["frh"].loc[df_dict["frh"]["fragment_type"]==3]
@@ -29,6 +31,7 @@ class CheckFramesInTimeWindow_DAPHNE(DQMTest):
     def __init__(self):
         super().__init__()
         self.name = "CheckFramesInTimeWindow_DAPHNE"
+        self.input_keys = []
 
     def run_test(self,df_dict):
         ...
@@ -37,6 +40,8 @@ class CheckTimestampDiffs_DAPHNE(DQMTest):
     def __init__(self):
         super().__init__()
         self.name = "CheckTimestampDiffs_DAPHNE"
+        self.input_keys = ["detd_kHD_PDS_kDAPHNEStream","detd_kHD_PDS_kDAPHNE",
+                           "deth_kHD_PDS_kDAPHNEStream","deth_kHD_PDS_kDAPHNE"]
 
     def run_test(self, df_dict, verbose=False):
 
@@ -47,13 +52,13 @@ class CheckTimestampDiffs_DAPHNE(DQMTest):
         
         if "deth_kHD_PDS_kDAPHNEStream" in df_dict.keys():
 
-            tmp_df_stream  = df_dict["deth_kHD_PDS_kDAPHNEStream"]
+            tmp_df_stream  = df_dict["deth_kHD_PDS_kDAPHNEStream"][["ts_diffs_vals","ts_diffs_counts"]].copy()
             tmp_df_stream["ts_check"] = tmp_df_stream.apply(lambda x: 1 if (len(x.ts_diffs_vals)!=1) else 0, axis=1)
             n_bad_stream = tmp_df_stream["ts_check"].sum()
 
         if "deth_kHD_PDS_kDAPHNE" in df_dict.keys():
 
-            tmp_df  = df_dict["deth_kHD_PDS_kDAPHNEStream"]
+            tmp_df  = df_dict["deth_kHD_PDS_kDAPHNEStream"][["ts_diffs_vals","ts_diffs_counts"]].copy()
             tmp_df["ts_check"] = tmp_df.apply(lambda x: 1 if (len(x.ts_diffs_vals)!=1) else 0, axis=1)
             n_bad = tmp_df["ts_check"].sum()
 
@@ -78,6 +83,7 @@ class CheckADCData_DAPHNE(DQMTest):
     def __init__(self):
         super().__init__()
         self.name = "CheckADCData_DAPHNE"
+        self.input_keys = ["detd_kHD_PDS_kDAPHNEStream","detd_kHD_PDS_kDAPHNE"]
     
     def run_test(self, df_dict):
 
@@ -1,4 +1,6 @@
 from dqmtools.dqmtools import *
+from dqmtools.dataframe_dict import get_view, get_ragged_column, ragged_reduceat, get_frh_daqh, get_reset_index
+from dqmtools.accumulators import channel_stats_key, adc_histogram_key
 from rawdatautils.unpack.dataclasses import *
 
 import numpy as np
@@ -10,6 +12,7 @@ class CheckTimestampDiffs_WIBEth(DQMTest):
         super().__init__()
         self.name = f'CheckTimestampDiffs_WIBEth_{det_name}'
         self.det_head_key=f'deth_k{det_name}_kWIBEth'
+        self.input_keys = [self.det_head_key]
         
     def run_test(self,df_dict):
 
@@ -17,8 +20,8 @@ class CheckTimestampDiffs_WIBEth(DQMTest):
             return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.det_head_key} in DataFrame dict.')
         
         df_tmp = df_dict[self.det_head_key]
-        df_tmp["ts_diff_wrong"] = df_tmp.apply(lambda x: (x.timestamp_dts_diff_vals!=x.sampling_period).sum(), axis=1)
-        n_ts_diff_wrong = df_tmp["ts_diff_wrong"].sum()
+        ts_diff_wrong = df_tmp.apply(lambda x: (x.timestamp_dts_diff_vals!=x.sampling_period).sum(), axis=1)
+        n_ts_diff_wrong = ts_diff_wrong.sum()
         if n_ts_diff_wrong==0:
             return DQMTestResult(DQMResultEnum.OK,f'OK')
         else:
@@ -31,6 +34,7 @@ class CheckWIBEth_COLDDATA_Timestamps_Aligned(DQMTest):
         super().__init__()
         self.name = f'CheckWIBEth_COLDDATA_Timestamps_Aligned_{det_name}'
         self.det_head_key=f'deth_k{det_name}_kWIBEth'
+        self.input_keys = [self.det_head_key]
 
     def run_test(self,df_dict):
 
@@ -38,11 +42,11 @@ class CheckWIBEth_COLDDATA_Timestamps_Aligned(DQMTest):
             return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.det_head_key} in DataFrame dict.')
 
         df_tmp = df_dict[self.det_head_key]
-        df_tmp["timestamp_dts_first_15bit"] = df_tmp["timestamp_dts_first"] & 0x7fff
-        df_tmp["ts_diff_cd0_dts"] = df_tmp["timestamp_dts_first_15bit"]-df_tmp["colddata_timestamp_0_first"]
-        df_tmp["ts_diff_cd1_dts"] = df_tmp["timestamp_dts_first_15bit"]-df_tmp["colddata_timestamp_1_first"]
+        timestamp_dts_first_15bit = df_tmp["timestamp_dts_first"] & 0x7fff
+        ts_diff_cd0_dts = timestamp_dts_first_15bit-df_tmp["colddata_timestamp_0_first"]
+        ts_diff_cd1_dts = timestamp_dts_first_15bit-df_tmp["colddata_timestamp_1_first"]
         
-        df_tmp = df_tmp[ (df_tmp["ts_diff_cd0_dts"]!=0) | (df_tmp["ts_diff_cd1_dts"]!=0) ]
+        df_tmp = df_tmp[ (ts_diff_cd0_dts!=0) | (ts_diff_cd1_dts!=0) ]
 
         if len(df_tmp)==0:
             return DQMTestResult(DQMResultEnum.OK,f'OK')
@@ -51,144 +55,254 @@ class CheckWIBEth_COLDDATA_Timestamps_Aligned(DQMTest):
                                  f'{len(df_tmp)} COLDDATA timestamps across {len(df_tmp)} fragments have bad timestamp differences relative to DTS.')
 
         
+def _header_field_result(df_dict,det_head_key,field,good_value,n_err,n_vals,severity=DQMResultEnum.BAD):
+    """
+    Result of one header field check from its per-fragment error and entry counts.
+    """
+    n_frags = len(n_vals)
+
+    is_empty = (n_vals==0)
+    n_empty_err = np.count_nonzero(is_empty)
+    if n_empty_err != 0:
+        print(df_dict[det_head_key].loc[is_empty,[f"{field}_vals",f"{field}_idx"]])
+        return DQMTestResult(severity,
+                             f'{n_empty_err} {field}!={good_value} errors across {n_frags} fragments.')
+
+    n_total_err = int(n_err.sum())
+    if n_total_err==0:
+        return DQMTestResult(DQMResultEnum.OK,f'OK')
+    else:
+        print(df_dict[det_head_key].loc[n_err>0,[f"{field}_vals",f"{field}_idx"]])
+        return DQMTestResult(severity,
+                             f'{n_total_err} {field}!={good_value} errors across {n_frags} fragments.')
+
+def _check_header_field(df_dict,det_head_key,field,good_value,severity=DQMResultEnum.BAD):
+
+    vals, offsets = get_ragged_column(df_dict,det_head_key,f"{field}_vals")
+    return _header_field_result(df_dict,det_head_key,field,good_value,
+                                ragged_reduceat(vals!=good_value,offsets),np.diff(offsets),severity)
+
 class CheckWIBEth_Header_Value(DQMTest):
-    
-    def __init__(self,det_name,field,good_value):
+    """
+    Checks that every entry of a WIBEth detector header field has the expected
+    value. The CheckWIBEth_* subclasses fix the field and value, and are the
+    rules CheckWIBEth_Header_Rules evaluates by default.
+    """
+
+    header_field = None
+    good_value = None
+    severity = DQMResultEnum.BAD
+
+    def __init__(self,det_name,field=None,good_value=None):
         super().__init__()
-        self.name = f'CheckWIBEth_Header_Value_{det_name}'
+        self.name = f'{type(self).__name__}_{det_name}'
         self.det_head_key=f'deth_k{det_name}_kWIBEth'
-        self.header_field = field
-        self.good_value = good_value
+        if field is not None:
+            self.header_field = field
+        if good_value is not None:
+            self.good_value = good_value
+        self.input_keys = [self.det_head_key]
+
+    def get_error_counts(self,df_dict):
+        """
+        Number of {field}!=good_value entries per fragment.
+        """
+        vals, offsets = get_ragged_column(df_dict,self.det_head_key,f"{self.header_field}_vals")
+        return pd.Series(ragged_reduceat(vals!=self.good_value,offsets),
+                         index=df_dict[self.det_head_key].index,name=f"{self.header_field}_n_err")
 
     def run_test(self,df_dict):
 
         if self.det_head_key not in df_dict.keys():
             return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.det_head_key} in DataFrame dict.')
-        
-        df_tmp = df_dict[self.det_head_key].rename(columns={f"{self.header_field}_vals":"vals",f"{self.header_field}_idx":"idx"})
-        df_tmp["n_empty"] = df_tmp.apply(lambda x: (1 if x.vals == [] else 0), axis=1)
-        n_empty_err = df_tmp["n_empty"].sum()
-        if n_empty_err != 0:
-            print(df_tmp[["vals","idx"]])
-            return DQMTestResult(DQMResultEnum.BAD,
-                                 f'{n_empty_err} {self.header_field}!={self.good_value} errors across {len(df_tmp)} fragments.')
-        
-        df_tmp["n_err"] = df_tmp.apply(lambda x: (x.vals!=self.good_value).sum(), axis=1)
-        n_total_err = df_tmp["n_err"].sum()
-        if n_total_err==0:
-            return DQMTestResult(DQMResultEnum.OK,f'OK')
-        else:
-            print(df_tmp[["vals","idx"]])
-            return DQMTestResult(DQMResultEnum.BAD,
-                                 f'{n_total_err} {self.header_field}!={self.good_value} errors across {len(df_tmp)} fragments.')
 
-        
+        return _check_header_field(df_dict,self.det_head_key,self.header_field,self.good_value,self.severity)
+
 class CheckWIBEth_COLDDATA_Timestamp_0_Diff(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"colddata_timestamp_0_diff",512/16*64)
-        self.name = f'CheckWIBEth_COLDDATA_Timestamp_0_Diff_{det_name}'
-        
+    header_field, good_value = "colddata_timestamp_0_diff", 512/16*64
+
 class CheckWIBEth_COLDDATA_Timestamp_1_Diff(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"colddata_timestamp_1_diff",512/16*64)
-        self.name = f'CheckWIBEth_COLDDATA_Timestamp_1_Diff_{det_name}'
-        
+    header_field, good_value = "colddata_timestamp_1_diff", 512/16*64
+
 class CheckWIBEth_CRC_Err(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"crc_err",0)
-        self.name = f'CheckWIBEth_CRC_Err_{det_name}'
-        
+    header_field, good_value = "crc_err", 0
+
 class CheckWIBEth_Pulser(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"pulser",0)
-        self.name = f'CheckWIBEth_Pulser_{det_name}'
+    header_field, good_value = "pulser", 0
 
 class CheckWIBEth_Calibration(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"calibration",0)
-        self.name = f'CheckWIBEth_Calibration_{det_name}'
+    header_field, good_value = "calibration", 0
 
 class CheckWIBEth_Ready(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"ready",0)
-        self.name = f'CheckWIBEth_Ready_{det_name}'
+    header_field, good_value = "ready", 0
 
 class CheckWIBEth_Context(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"context",0)
-        self.name = f'CheckWIBEth_Context_{det_name}'
-        
+    header_field, good_value = "context", 0
+
 class CheckWIBEth_CD(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"cd",0)
-        self.name = f'CheckWIBEth_CD_{det_name}'
+    header_field, good_value = "cd", 0
 
 class CheckWIBEth_Link_Valid(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"link_valid",3)
-        self.name = f'CheckWIBEth_Link_Valid_{det_name}'
+    header_field, good_value = "link_valid", 3
 
 class CheckWIBEth_LOL(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"lol",0)
-        self.name = f'CheckWIBEth_LOL_{det_name}'
+    header_field, good_value = "lol", 0
 
 class CheckWIBEth_WIB_Sync(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"wib_sync",0)
-        self.name = f'CheckWIBEth_WIB_Sync_{det_name}'
+    header_field, good_value = "wib_sync", 0
 
 class CheckWIBEth_FEMB_Sync(CheckWIBEth_Header_Value):
-    
-    def __init__(self,det_name):
-        super().__init__(det_name,"femb_sync",3)
-        self.name = f'CheckWIBEth_FEMB_Sync_{det_name}'
+    header_field, good_value = "femb_sync", 3
+
+class CheckWIBEth_Header_Rules(DQMTest):
+    """
+    Evaluates CheckWIBEth_Header_Value checks (by default all the CheckWIBEth_*
+    header value classes) in one pass over the WIBEth detector header frame,
+    reporting one result per check under its own name.
+    """
+
+    default_rules = [ CheckWIBEth_COLDDATA_Timestamp_0_Diff, CheckWIBEth_COLDDATA_Timestamp_1_Diff,
+                      CheckWIBEth_CRC_Err, CheckWIBEth_Pulser, CheckWIBEth_Calibration, CheckWIBEth_Ready,
+                      CheckWIBEth_Context, CheckWIBEth_CD, CheckWIBEth_LOL, CheckWIBEth_Link_Valid,
+                      CheckWIBEth_WIB_Sync, CheckWIBEth_FEMB_Sync ]
+
+    def __init__(self,det_name,rules=None):
+        super().__init__()
+        self.name = f'CheckWIBEth_Header_Rules_{det_name}'
+        self.det_head_key=f'deth_k{det_name}_kWIBEth'
+        #CheckWIBEth_Header_Value instances, or classes built for det_name
+        self.rules = [ rule(det_name) if isinstance(rule,type) else rule
+                       for rule in (self.default_rules if rules is None else rules) ]
+        self.input_keys = [self.det_head_key]
+        self.rule_names = [ rule.get_name() for rule in self.rules ]
+
+    def get_error_counts(self,df_dict):
+        """
+        Per-rule, per-fragment error and entry counts, shape (rules, fragments),
+        from one comparison over the values of all rule fields laid end to end.
+        """
+        columns = [ get_ragged_column(df_dict,self.det_head_key,f"{rule.header_field}_vals") for rule in self.rules ]
+        n_vals = np.stack([ np.diff(offsets) for _, offsets in columns ])
+        vals = np.concatenate([ values[offsets[0]:offsets[-1]] for values, offsets in columns ])
+        good_values = np.repeat([ rule.good_value for rule in self.rules ],n_vals.sum(axis=1))
+        offsets = np.concatenate(([0],np.cumsum(n_vals)))
+        n_err = ragged_reduceat(vals!=good_values,offsets).reshape(n_vals.shape)
+        return n_err, n_vals
+
+    def run_rules(self,df_dict):
+
+        if self.det_head_key not in df_dict.keys():
+            return { name: DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.det_head_key} in DataFrame dict.')
+                     for name in self.rule_names }
+
+        n_err, n_vals = self.get_error_counts(df_dict)
+        return { name: _header_field_result(df_dict,self.det_head_key,rule.header_field,rule.good_value,
+                                            n_err[i],n_vals[i],rule.severity)
+                 for i, (name, rule) in enumerate(zip(self.rule_names,self.rules)) }
+
+    def run_test(self,df_dict):
+        results = self.run_rules(df_dict)
+        for result in [ DQMResultEnum.BAD, DQMResultEnum.INVALID, DQMResultEnum.WARNING ]:
+            n_result = sum([ res.result==result for res in results.values() ])
+            if n_result>0:
+                return DQMTestResult(result,f'{n_result}/{len(results)} header rules have result {result.name}.')
+        return DQMTestResult(DQMResultEnum.OK,f'OK')
+
+    def do_tests(self,name,*args,**kwargs):
+        try:
+            results = self.run_rules(*args,**kwargs)
+        except Exception as err:
+            results = { rule_name: DQMTestResult(DQMResultEnum.BAD,f'Check raised exception: {err}') for rule_name in self.rule_names }
+
+        last_update = datetime.now()
+        return [ { "result": res.result, "message": res.message, "last_update": last_update, "name": rule_name }
+                 for rule_name, res in results.items() ]
 
 class CheckNFrames_WIBEth(DQMTest):
 
     def __init__(self):
         super().__init__()
         self.name = "CheckNFrames_WIBEth"
+        self.input_keys = ["frh_kWIBEth","daqh_kWIBEth"]
 
     def run_test(self,df_dict):
-        df_tmp = df_dict["frh"].loc[df_dict["frh"]["fragment_type"]==12][["window_begin_dts","window_end_dts"]]
+        df_tmp = get_frh_daqh(df_dict,12)
         if len(df_tmp)==0:
             return DQMTestResult(DQMResultEnum.WARNING,f'WARNING: No WIBEth components found.')
-        df_tmp["expected_frames"] = np.floor((df_tmp["window_end_dts"]-df_tmp["window_begin_dts"])/(32*64))+1
-        df_tmp = df_tmp.join(df_dict["daqh"][["n_obj"]])
-        n_frames_wrong = (df_tmp["expected_frames"]!=df_tmp["n_obj"]).sum()
+        expected_frames = np.floor((df_tmp["window_end_dts"]-df_tmp["window_begin_dts"])/(32*64))+1
+        n_frames_wrong = (expected_frames!=df_tmp["n_obj"]).sum()
         if n_frames_wrong==0:
             return DQMTestResult(DQMResultEnum.OK,f'OK')
         else:            
             return DQMTestResult(DQMResultEnum.BAD,
                                  f'{n_frames_wrong} / {len(df_tmp)} WIBEth fragments have the wrong number of frames.')
 
+def _sparse_diff_segments(df_dict,deth_key):
+    #segments of constant timestamp difference, as stored by the WIBEth unpacker:
+    #segment k starts at sample locs[k] of the diff array and runs to the next one
+    #(or to the end of the n_frames*64-1 diffs of its fragment)
+    locs, offsets = get_ragged_column(df_dict,deth_key,"timestamp_dts_diff_idx")
+    vals, _ = get_ragged_column(df_dict,deth_key,"timestamp_dts_diff_vals")
+    locs = locs.astype(np.int64)
+    vals = vals.astype(np.int64)
+
+    n_diffs = df_dict[deth_key]["n_frames"].values.astype(np.int64)*64-1
+    lengths = np.diff(offsets)
+    frag = np.repeat(np.arange(len(lengths)),lengths)
+
+    ends = np.empty_like(locs)
+    ends[:-1] = locs[1:]
+    last_in_frag = offsets[1:][lengths>0]-1
+    ends[last_in_frag] = n_diffs[lengths>0]
+    return frag, locs, ends, vals, offsets
+
+def get_WIBEth_first_last_timestamps(df_dict,deth_key):
+    """
+    First and last DTS timestamp of every WIBEth fragment, computed in closed form
+    from the sparse timestamp-difference representation, without expanding the
+    n_frames*64 per-sample timestamps.
+    """
+    def compute(d):
+        frag, locs, ends, vals, offsets = _sparse_diff_segments(d,deth_key)
+        first = d[deth_key]["timestamp_dts_first"].values.astype(np.int64)
+        last = first + ragged_reduceat(vals*(ends-locs),offsets)
+        return pd.DataFrame({"timestamp_dts_first":first,"timestamp_dts_last":last},index=d[deth_key].index)
+
+    return get_view(df_dict,("wibeth_first_last",deth_key),[deth_key],compute)
+
+def get_WIBEth_timestamp_gaps(df_dict,deth_key):
+    """
+    One row per run of samples whose timestamp difference is not the sampling period,
+    with the frame it starts in, its difference and its length in samples.
+    """
+    frag, locs, ends, vals, offsets = _sparse_diff_segments(df_dict,deth_key)
+    sampling_period = df_dict[deth_key]["sampling_period"].values.astype(np.int64)
+    bad = (vals!=sampling_period[frag])
+    df_gaps = pd.DataFrame({"frame": (locs[bad]+1)//64,
+                            "sample": locs[bad]+1,
+                            "timestamp_diff": vals[bad],
+                            "n_samples": ends[bad]-locs[bad],
+                            "sampling_period": sampling_period[frag[bad]]},
+                           index=df_dict[deth_key].index[frag[bad]])
+    return df_gaps
+
 class CheckRequestTimes_WIBEth(DQMTest):
 
-    def __init__(self,det_name,verbose=True):
+    def __init__(self,det_name,verbose=True,report_gaps=False):
         super().__init__()
         self.name = f'CheckRequestTimes_WIBEth'
         self.deth_name=f'deth_k{det_name}_kWIBEth'
         self.verbose = verbose
+        self.report_gaps = report_gaps
+        self.input_keys = ["frh_kWIBEth","daqh_kWIBEth",self.deth_name]
 
     def run_test(self,df_dict):
-        df_tmp = df_dict["frh"].loc[df_dict["frh"]["fragment_type"]==12][["window_begin_dts","window_end_dts"]]
-        if len(df_tmp)==0:
-            return DQMTestResult(DQMResultEnum.WARNING,f'WARNING: No components with detid {self.det_id} found.')
-        df_tmp = df_tmp.join(df_dict[self.deth_name][["timestamp_dts_diff_vals","timestamp_dts_diff_idx","timestamp_dts_first","n_frames"]])
-        print(df_tmp.iloc[0]["timestamp_dts_first"],df_tmp.iloc[0]["timestamp_dts_diff_vals"],df_tmp.iloc[0]["timestamp_dts_diff_idx"])
-        df_tmp["timestamp_dts_last"] = df_tmp.apply(lambda x: desparsify_array_diff_of_diff_locs_and_vals(x.timestamp_dts_first,x.timestamp_dts_diff_idx,x.timestamp_dts_diff_vals,x.n_frames*64)[-1],axis=1)
+        df_frh_daqh = get_frh_daqh(df_dict,12)
+        if len(df_frh_daqh)==0:
+            return DQMTestResult(DQMResultEnum.WARNING,f'WARNING: No WIBEth components found.')
+        if self.deth_name not in df_dict.keys():
+            return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.deth_name} in DataFrame dict.')
+        df_tmp = df_frh_daqh[["window_begin_dts","window_end_dts"]].join(get_WIBEth_first_last_timestamps(df_dict,self.deth_name))
 
         df_bad = df_tmp.loc[(df_tmp["timestamp_dts_first"]>df_tmp["window_begin_dts"])|(df_tmp["timestamp_dts_last"]<df_tmp["window_end_dts"])]
         n_bad = len(df_bad)
@@ -197,7 +311,7 @@ class CheckRequestTimes_WIBEth(DQMTest):
             return DQMTestResult(DQMResultEnum.OK,f'OK')
         else:
             if self.verbose:
-                df_bad = df_bad.join(df_dict["daqh"])
+                df_bad = df_bad.join(df_frh_daqh[["crate_id","slot_id","stream_id"]])
                 print(f"\nFRAGMENTS FAILING WIBETH WINDOW ALIGNMENT CHECK")
                 print(tabulate(df_bad.reset_index()[["trigger","sequence","crate_id","slot_id","stream_id",
                                                      "timestamp_dts_first","timestamp_dts_last",
@@ -207,40 +321,85 @@ class CheckRequestTimes_WIBEth(DQMTest):
                                          "Window begin","Window end"],
                                 showindex=False,tablefmt='pretty'))
 
+            if self.report_gaps:
+                df_gaps = get_WIBEth_timestamp_gaps(df_dict,self.deth_name)
+                df_gaps = df_gaps.loc[df_gaps.index.isin(df_bad.index)]
+                print(f"\nTIMESTAMP GAPS IN MISALIGNED WIBETH FRAGMENTS")
+                print(tabulate(df_gaps.reset_index()[["trigger","sequence","frame","sample","timestamp_diff","n_samples","sampling_period"]],
+                               headers=["Record","Seq.","Frame","Sample","Difference","Samples","Sampling period"],
+                               showindex=False,tablefmt='pretty'))
+
             return DQMTestResult(DQMResultEnum.BAD,
                                  f'{n_bad} / {len(df_tmp)} WIBEth fragments have misaligned request windows.')
 
+def _channel_stats(df_dict,det_data_key):
+    df_tmp = get_reset_index(df_dict,det_data_key)
+    df_stats = df_tmp.groupby(by="channel").agg(adc_rms=("adc_rms","mean"),
+                                                adc_mean=("adc_mean","mean"),
+                                                apa=("apa","first"),
+                                                plane=("plane","first"))
+    return df_stats.reset_index()
+
+def get_WIBEth_channel_stats(df_dict,det_data_key):
+    """
+    One row per channel with its mean RMS, mean pedestal, apa and plane,
+    computed once per evaluation and shared by the RMS and pedestal checks.
+    Without detector data rows, the accumulated statistics under the
+    channel_stats_key of det_data_key are used instead.
+    """
+    if det_data_key not in df_dict.keys():
+        return df_dict.get(channel_stats_key(det_data_key))
+    return get_view(df_dict,("wibeth_channel_stats",det_data_key),[det_data_key],
+                    lambda d: _channel_stats(d,det_data_key))
+
+def get_plane_values(values,label="Threshold"):
+    """
+    Expand a per-plane setting into an array indexed by plane number:
+    a single value for all planes, [induction, collection], or one per plane.
+    """
+    if not isinstance(values,list): #one value for all planes
+        return np.full(3,values)
+    elif len(values)==1: #one value for all planes
+        return np.full(3,values[0])
+    elif len(values)==2: #two values, first induction, second collection
+        return np.array([values[0],values[0],values[1]])
+    elif len(values)==3: #three values, one for each plane
+        return np.array(values)
+    else:
+        print(f'{label} length {len(values)} is not valid.',values)
+        raise ValueError
+
+def lookup_by_plane(plane_values,planes):
+    """
+    Per-channel values from a plane-indexed array, NaN for unknown planes.
+    """
+    planes = np.asarray(planes)
+    valid = (planes>=0)&(planes<len(plane_values))
+    out = np.full(len(planes),np.nan)
+    out[valid] = plane_values[planes[valid].astype(np.int64)]
+    return out
+
 class CheckRMS_WIBEth(DQMTest):
 
     def __init__(self,det_name,threshold=100,operator=operator.gt,verbose=False):
         super().__init__()
-        self.name = 'CheckRMS_{det_name}'
+        self.name = f'CheckRMS_{det_name}'
         self.det_data_key=f'detd_k{det_name}_kWIBEth'
-
-        if not isinstance(threshold,list): #one value for all planes
-            self.df_threshold = pd.DataFrame({"plane":[0,1,2],"threshold":np.full(3,threshold)})
-        elif len(threshold)==1: #one value for all planes
-            self.df_threshold = pd.DataFrame({"plane":[0,1,2],"threshold":np.full(3,threshold[0])})
-        elif len(threshold)==2: #two values, first induction, second collection
-            self.df_threshold = pd.DataFrame({"plane":[0,1,2],"threshold":np.array([threshold[0],threshold[0],threshold[1]])})
-        elif len(threshold)==3: #three values, one for each plane
-            self.df_threshold = pd.DataFrame({"plane":[0,1,2],"threshold":np.array(threshold)})
-        else:
-            print(f'Threshold length {len(threshold)} is not valid.',threshold)
-            raise ValueError
+        self.threshold = get_plane_values(threshold,"Threshold")
         self.operator = operator
         self.verbose = verbose
+        self.input_keys = [self.det_data_key,channel_stats_key(self.det_data_key)]
         
 
     def run_test(self,df_dict):
 
-        if self.det_data_key not in df_dict.keys():
+        df_stats = get_WIBEth_channel_stats(df_dict,self.det_data_key)
+        if df_stats is None:
             return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.det_data_key} in DataFrame dict.')
         
-        df_tmp = df_dict[self.det_data_key].reset_index().merge(self.df_threshold,on=["plane"])
-        df_tmp = df_tmp[["channel","adc_rms","threshold"]].groupby(by="channel").mean().reset_index()
-        df_tmp = df_tmp.loc[self.operator(df_tmp["adc_rms"],df_tmp["threshold"])]
-        n_rms_bad = len(np.unique(df_tmp["channel"]))
+        threshold = lookup_by_plane(self.threshold,df_stats["plane"].values)
+        is_bad = self.operator(df_stats["adc_rms"].values,threshold)
+        n_rms_bad = int(np.count_nonzero(is_bad))
 
         if n_rms_bad==0:
             return DQMTestResult(DQMResultEnum.OK,f'OK')
@@ -249,8 +408,8 @@ class CheckRMS_WIBEth(DQMTest):
             if self.verbose:
                 print("CHANNELS FAILING RMS CHECK")
                 print(f"operator {str(self.operator)} ({self.operator.__doc__})")
-                df_tmp = df_tmp.merge(df_dict[self.det_data_key].reset_index()[["channel","apa","plane"]].drop_duplicates(["channel"]),on=["channel"])
-                print(tabulate(df_tmp.reset_index()[["channel","adc_rms","apa","plane","threshold"]],
+                df_tmp = df_stats.loc[is_bad].assign(threshold=threshold[is_bad])
+                print(tabulate(df_tmp[["channel","adc_rms","apa","plane","threshold"]],
                                headers=["Channel","RMS","APA/CRP","Plane","Threshold"],
                                showindex=False,tablefmt='pretty',floatfmt=".2f"))
             return DQMTestResult(DQMResultEnum.BAD,
@@ -262,52 +421,64 @@ class CheckPedestal_WIBEth(DQMTest):
         super().__init__()
         self.name = f'CheckPedestal_{det_name}'
         self.det_data_key=f'detd_k{det_name}_kWIBEth'
-
-        if not isinstance(lower_bound,list): #one value for all planes
-            self.df_lower_bound = pd.DataFrame({"plane":[0,1,2],"lower_bound":np.full(3,lower_bound)})
-        elif len(lower_bound)==1: #one value for all planes
-            self.df_lower_bound = pd.DataFrame({"plane":[0,1,2],"lower_bound":np.full(3,lower_bound[0])})
-        elif len(lower_bound)==2: #two values, first induction, second collection
-            self.df_lower_bound = pd.DataFrame({"plane":[0,1,2],"lower_bound":np.array([lower_bound[0],lower_bound[0],lower_bound[1]])})
-        elif len(lower_bound)==3: #three values, one for each plane
-            self.df_lower_bound = pd.DataFrame({"plane":[0,1,2],"lower_bound":np.array(lower_bound)})
-        else:
-            print(f'Lower_Bound length {len(lower_bound)} is not valid.',lower_bound)
-            raise ValueError
-
-        if not isinstance(upper_bound,list): #one value for all planes
-            self.df_upper_bound = pd.DataFrame({"plane":[0,1,2],"upper_bound":np.full(3,upper_bound)})
-        elif len(upper_bound)==1: #one value for all planes
-            self.df_upper_bound = pd.DataFrame({"plane":[0,1,2],"upper_bound":np.full(3,upper_bound[0])})
-        elif len(upper_bound)==2: #two values, first induction, second collection
-            self.df_upper_bound = pd.DataFrame({"plane":[0,1,2],"upper_bound":np.array([upper_bound[0],upper_bound[0],upper_bound[1]])})
-        elif len(upper_bound)==3: #three values, one for each plane
-            self.df_upper_bound = pd.DataFrame({"plane":[0,1,2],"upper_bound":np.array(upper_bound)})
-        else:
-            print(f'Upper_Bound length {len(upper_bound)} is not valid.',upper_bound)
-            raise ValueError
-
+        self.lower_bound = get_plane_values(lower_bound,"Lower_Bound")
+        self.upper_bound = get_plane_values(upper_bound,"Upper_Bound")
         self.verbose = verbose
+        self.input_keys = [self.det_data_key,channel_stats_key(self.det_data_key)]
         
 
     def run_test(self,df_dict):
 
-        if self.det_data_key not in df_dict.keys():
+        df_stats = get_WIBEth_channel_stats(df_dict,self.det_data_key)
+        if df_stats is None:
             return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.det_data_key} in DataFrame dict.')
         
-        df_tmp = df_dict[self.det_data_key].reset_index().merge(self.df_lower_bound,on=["plane"]).merge(self.df_upper_bound,on=["plane"])
-        df_tmp = df_tmp[["channel","adc_mean","lower_bound","upper_bound"]].groupby(by="channel").mean().reset_index()
-        df_tmp = df_tmp.loc[(df_tmp["adc_mean"]<df_tmp["lower_bound"])|(df_tmp["adc_mean"]>df_tmp["upper_bound"])]
-        n_bad = len(np.unique(df_tmp["channel"]))
+        lower_bound = lookup_by_plane(self.lower_bound,df_stats["plane"].values)
+        upper_bound = lookup_by_plane(self.upper_bound,df_stats["plane"].values)
+        adc_mean = df_stats["adc_mean"].values
+        is_bad = (adc_mean<lower_bound)|(adc_mean>upper_bound)
+        n_bad = int(np.count_nonzero(is_bad))
         if n_bad==0:
             return DQMTestResult(DQMResultEnum.OK,f'OK')
         else:
             if self.verbose:
                 print("CHANNELS FAILING PEDESTAL CHECK")
-                df_tmp = df_tmp.merge(df_dict[self.det_data_key].reset_index()[["channel","apa","plane"]].drop_duplicates(["channel"]),on=["channel"])
-                print(tabulate(df_tmp.reset_index()[["channel","adc_mean","apa","plane","lower_bound","upper_bound"]],
+                df_tmp = df_stats.loc[is_bad].assign(lower_bound=lower_bound[is_bad],upper_bound=upper_bound[is_bad])
+                print(tabulate(df_tmp[["channel","adc_mean","apa","plane","lower_bound","upper_bound"]],
                                headers=["Channel","Pedestal","APA/CRP","Plane","Lower Bound","Upper Bound"],
                                showindex=False,tablefmt='pretty',floatfmt=".2f"))
             return DQMTestResult(DQMResultEnum.BAD,
                                  f'{n_bad} channels have pedestal outside of range.')
 
+class CheckStuckCodes_WIBEth(DQMTest):
+    """
+    Flags channels where more than threshold of the samples have their low
+    bits all 0 or all 1, from the run-level ADC histograms (adch_ key).
+    """
+
+    def __init__(self,det_name,threshold=0.1,verbose=False):
+        super().__init__()
+        self.name = f'CheckStuckCodes_{det_name}'
+        self.adc_histogram_key = adc_histogram_key(f'detw_k{det_name}_kWIBEth')
+        self.threshold = threshold
+        self.verbose = verbose
+        self.input_keys = [self.adc_histogram_key]
+
+    def run_test(self,df_dict):
+
+        if self.adc_histogram_key not in df_dict.keys():
+            return DQMTestResult(DQMResultEnum.WARNING,f'Could not find {self.adc_histogram_key} in DataFrame dict.')
+
+        df_hist = df_dict[self.adc_histogram_key]
+        is_bad = df_hist["stuck_code_fraction"].values>self.threshold
+        n_bad = int(np.count_nonzero(is_bad))
+        if n_bad==0:
+            return DQMTestResult(DQMResultEnum.OK,f'OK')
+        else:
+            if self.verbose:
+                print("CHANNELS FAILING STUCK CODE CHECK")
+                print(tabulate(df_hist.loc[is_bad][["channel","n_samples","adc_median","stuck_code_fraction"]],
+                               headers=["Channel","Samples","Median","Stuck code fraction"],
+                               showindex=False,tablefmt='pretty',floatfmt=".3f"))
+            return DQMTestResult(DQMResultEnum.BAD,
+                                 f'{n_bad} channels have stuck ADC codes.')
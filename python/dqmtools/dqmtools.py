@@ -3,6 +3,8 @@ from enum import Enum
 from datetime import datetime
 import pytz
 import numpy as np
+import threading
+import concurrent.futures
 
 #non-standard imports
 try:
@@ -47,10 +49,16 @@ class DQMTest:
             self.name = name
         self.result = DQMTestResult()
         self.tests = None
+        #df_dict keys the test reads; None if not declared. frh_<qualifier> and
+        #daqh_<qualifier> read the frh/daqh rows of matching fragment types only
+        self.input_keys = None
 
     def get_name(self):
         return self.name
 
+    def get_input_keys(self):
+        return None if self.input_keys is None else set(self.input_keys)
+
     def is_test_suite(self):
         return (self.tests is not None)
     
@@ -67,13 +75,43 @@ class DQMTest:
 
         return { "result": res.result, "message": res.message, "last_update": datetime.now()}
 
+    def do_tests(self,name,*args,**kwargs):
+        """
+        Result rows this test adds to a DQMTestSuite registered under name.
+        Tests that evaluate several checks at once override this to return one row per check.
+        """
+        return [ self.do_test(*args,**kwargs) | {"name": name} ]
+
+
+def get_suite_result(df_results):
+    """
+    Suite verdict from a frame of test results: BAD if any result is bad or
+    invalid, else WARNING if any has a warning, else OK.
+    """
+    if len(df_results)==0:
+        return DQMTestResult(DQMResultEnum.INVALID,"No registered tests or no valid test results.")
+
+    #If anything bad or invalid, suite is bad
+    bad_or_invalid_count = np.count_nonzero(df_results['result']==DQMResultEnum.BAD)+np.count_nonzero(df_results['result']==DQMResultEnum.INVALID)
+    if bad_or_invalid_count>0:
+        return DQMTestResult(DQMResultEnum.BAD,f"{bad_or_invalid_count}/{len(df_results)} bad or invalid results.")
+
+    #else, if anything in warning, suite is in warning
+    warning_count = np.count_nonzero(df_results['result']==DQMResultEnum.WARNING)
+    if warning_count>0:
+        return DQMTestResult(DQMResultEnum.WARNING,f"{warning_count}/{len(df_results)} results have warning.")
+
+    #else, we're ok
+    return DQMTestResult(DQMResultEnum.OK,f"All {len(df_results)} results OK.")
 
 class DQMTestSuite(DQMTest):
 
-    def __init__(self,name):
+    def __init__(self,name,max_workers=1):
         super().__init__(name=name)
         self.df_results = pd.DataFrame(columns=["name","result","message","last_update"])
         self.tests = {}
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
 
     def register_test(self,test,name=None):
         if name is None:
@@ -91,34 +129,106 @@ class DQMTestSuite(DQMTest):
         
     def get_all_results(self):
         return self.df_results
+
+    def get_input_keys(self):
+        keys = set()
+        for test in self.tests.values():
+            test_keys = test.get_input_keys()
+            if test_keys is None:
+                return None
+            keys |= test_keys
+        return keys
+
+    def get_test_groups(self,df_dict=None):
+        """
+        Group registered tests for concurrent execution. Tests declaring the same
+        input keys share a group and run back to back; each nested suite is its own
+        group. Tests without declared keys are returned separately, to run serially.
+        Groups are ordered by the number of input rows they read, largest first.
+        """
+        groups = {}
+        serial = []
+        for name, test in self.tests.items():
+            if test.is_test_suite():
+                groups[("suite",name)] = [ (name,test) ]
+                continue
+            keys = test.get_input_keys()
+            if keys is None:
+                serial.append((name,test))
+            else:
+                groups.setdefault(frozenset(keys),[]).append((name,test))
+
+        def n_input_rows(group):
+            if df_dict is None:
+                return 0
+            keys = set()
+            for _, test in group:
+                keys |= (test.get_input_keys() or set())
+            keys = set([ key if key in df_dict.keys() else key.split("_")[0] for key in keys ])
+            return sum([ len(df_dict[key]) for key in keys if key in df_dict.keys() ])
+
+        return sorted(groups.values(),key=n_input_rows,reverse=True), serial
+
+    def _run_test_group(self,group,*args,**kwargs):
+        return { name: test.do_tests(name,*args,**kwargs) for name, test in group }
         
     def get_latest_results(self):
         return self.df_results.sort_values('last_update',ascending=False).drop_duplicates(["name"])
 
-    def run_test(self,*args,**kwargs):
-        new_df = pd.DataFrame([ test.do_test(*args,**kwargs) | {"name": name} for name, test in self.tests.items() ])
+    def get_merged_results(self):
+        """
+        Merge the results of repeated evaluations (e.g. one per chunk of records)
+        into one row per test, keeping the worst result and its message.
+        """
+        if len(self.df_results)==0:
+            return self.df_results
+
+        severity = { DQMResultEnum.OK: 0, DQMResultEnum.WARNING: 1, DQMResultEnum.INVALID: 2, DQMResultEnum.BAD: 3 }
+        df_tmp = self.df_results.copy()
+        df_tmp["severity"] = df_tmp["result"].map(severity)
+        n_evals = df_tmp.groupby("name",sort=False)["result"].size()
+        n_not_ok = df_tmp.loc[df_tmp["severity"]>0].groupby("name",sort=False)["result"].size()
+
+        df_tmp = df_tmp.sort_values(["severity","last_update"],ascending=[False,False],kind="stable").drop_duplicates(["name"])
+        df_tmp = df_tmp.set_index("name").loc[n_evals.index].reset_index()
+        n_not_ok = n_not_ok.reindex(df_tmp["name"],fill_value=0).values
+        n_evals = n_evals.loc[df_tmp["name"]].values
+        df_tmp["message"] = [ msg if n_eval==1 else f'{msg} ({n_bad}/{n_eval} evaluations not OK)'
+                              for msg, n_bad, n_eval in zip(df_tmp["message"],n_not_ok,n_evals) ]
+        return df_tmp.drop(columns=["severity"])
 
-        if(len(self.df_results)==0):
-            self.df_results = new_df
+    def run_test(self,*args,**kwargs):
+        if self.max_workers is None or self.max_workers<=1:
+            rows = [ row for name, test in self.tests.items() for row in test.do_tests(name,*args,**kwargs) ]
         else:
-            self.df_results = pd.concat([self.df_results,new_df],ignore_index=True)
-
-        if len(self.df_results)==0:
-            return DQMTestResult(DQMResultEnum.INVALID,"No registered tests or no valid test results.")
+            df_dict = args[0] if len(args)>0 else kwargs.get("df_dict")
+            groups, serial = self.get_test_groups(df_dict)
+            test_rows = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [ executor.submit(self._run_test_group,group,*args,**kwargs) for group in groups ]
+                for future in concurrent.futures.as_completed(futures):
+                    test_rows.update(future.result())
+            test_rows.update(self._run_test_group(serial,*args,**kwargs))
+
+            #report in registration order, whatever order the groups finished in
+            rows = [ row for name in self.tests.keys() for row in test_rows[name] ]
+
+        new_df = pd.DataFrame(rows)
+
+        with self._lock:
+            if(len(self.df_results)==0):
+                self.df_results = new_df
+            else:
+                self.df_results = pd.concat([self.df_results,new_df],ignore_index=True)
 
-        #If anything bad or invalid, suite is bad
-        bad_or_invalid_count = np.count_nonzero(self.df_results['result']==DQMResultEnum.BAD)+np.count_nonzero(self.df_results['result']==DQMResultEnum.INVALID)
-        if bad_or_invalid_count>0:
-            return DQMTestResult(DQMResultEnum.BAD,f"{bad_or_invalid_count}/{len(self.df_results)} bad or invalid results.")
+        #the verdict of this evaluation only; earlier ones (e.g. other chunks) stay in df_results
+        return get_suite_result(new_df)
 
-        #else, if anything in warning, suite is in warning
-        warning_count = np.count_nonzero(self.df_results['result']==DQMResultEnum.WARNING)
-        if warning_count>0:
-            return DQMTestResult(DQMResultEnum.WARNING,f"{warning_count}/{len(self.df_results)} results have warning.")
-        
-        #else, we're ok
-        return DQMTestResult(DQMResultEnum.OK,f"All {len(self.df_results)} results OK.")
-        
+    def get_merged_result(self):
+        """
+        Verdict over all evaluations so far, one merged row per test.
+        """
+        return get_suite_result(self.get_merged_results())
 
     def clear_all_results(self):
         self.df_results = pd.DataFrame(columns=["name","result","message","last_update"])
@@ -154,8 +264,11 @@ class DQMTestSuite(DQMTest):
     def clear_old_results(self):
         self.df_results = self.df_results.sort_values('last_update',ascending=False).drop_duplicates(["name"])
 
-    def get_table(self,latest=True,names=[],show_last_update=True,tablefmt='pretty'):
-        df_tmp = self.get_latest_results() if latest else self.get_all_results()
+    def get_table(self,latest=True,names=[],show_last_update=True,tablefmt='pretty',merged=False):
+        if merged:
+            df_tmp = self.get_merged_results()
+        else:
+            df_tmp = self.get_latest_results() if latest else self.get_all_results()
         for name in names:
             df_tmp = df_tmp.loc[df_tmp["name"]==name]
 
@@ -0,0 +1,144 @@
+import os
+import hashlib
+import pickle
+import tempfile
+import threading
+
+#bump when the cached layout or the unpacked content changes
+CACHE_VERSION = 1
+
+#bytes hashed at each end of a file for its fingerprint
+FINGERPRINT_BLOCK = 1<<20
+
+def get_file_fingerprint(filename):
+    """
+    Content-based identity of a raw data file: its size and a hash of its
+    first and last MiB. Copies of a file share a fingerprint, a rewritten
+    file gets a new one, and nothing close to the whole file is read.
+    """
+    size = os.path.getsize(filename)
+    h = hashlib.sha1()
+    h.update(str(size).encode())
+    with open(filename,'rb') as f:
+        h.update(f.read(FINGERPRINT_BLOCK))
+        if size>FINGERPRINT_BLOCK:
+            f.seek(max(FINGERPRINT_BLOCK,size-FINGERPRINT_BLOCK))
+            h.update(f.read(FINGERPRINT_BLOCK))
+    return h.hexdigest()
+
+class RecordCache:
+    """
+    On-disk cache of the unpacked output of one record, in the columnar form
+    of ColumnarBuilder.export(), keyed by file fingerprint, record ID and
+    unpacking settings (prescales, and anything else passed as extra).
+
+    Entries are pickled numpy columns written atomically. Reads refresh an
+    entry's modification time, and once the cache grows past max_size_mb the
+    least recently used entries are removed.
+
+    Prescales other than 1 or None depend on the order records are unpacked
+    in, so entries are only reproducible for those two settings.
+    """
+
+    def __init__(self,cache_dir,max_size_mb=10000):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size_mb = max_size_mb
+        self.n_hits = 0
+        self.n_misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir,exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_entry_key(self,fingerprint,rid,ana_data_prescale,wvfm_data_prescale,extra=None):
+        key = repr((CACHE_VERSION,fingerprint,tuple(rid),ana_data_prescale,wvfm_data_prescale,extra))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def get_entry_path(self,entry_key):
+        return os.path.join(self.cache_dir,entry_key[:2],f'{entry_key}.pkl')
+
+    def get(self,fingerprint,rid,ana_data_prescale,wvfm_data_prescale,extra=None):
+        """
+        Cached {df_dict key: exported columns} for the record, or None.
+        """
+        path = self.get_entry_path(self.get_entry_key(fingerprint,rid,ana_data_prescale,wvfm_data_prescale,extra))
+        try:
+            with open(path,'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError,EOFError,pickle.UnpicklingError):
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        return entry
+
+    def put(self,fingerprint,rid,ana_data_prescale,wvfm_data_prescale,entry,extra=None):
+        path = self.get_entry_path(self.get_entry_key(fingerprint,rid,ana_data_prescale,wvfm_data_prescale,extra))
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+
+        #write to a temporary file and rename, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),suffix=".tmp")
+        with os.fdopen(fd,'wb') as f:
+            pickle.dump(entry,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path,path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+            if self.get_size()>self.max_size_mb*1e6:
+                self.evict()
+
+    def _entries(self):
+        entries = []
+        for sub in os.listdir(self.cache_dir):
+            sub_dir = os.path.join(self.cache_dir,sub)
+            if not os.path.isdir(sub_dir):
+                continue
+            for name in os.listdir(sub_dir):
+                if name.endswith(".pkl"):
+                    path = os.path.join(sub_dir,name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime,st.st_size,path))
+        return entries
+
+    def get_size(self):
+        if self._size is None:
+            self._size = sum([ size for _, size, _ in self._entries() ])
+        return self._size
+
+    def evict(self,target_fraction=0.9):
+        """
+        Remove least recently used entries until the cache is below
+        target_fraction of max_size_mb.
+        """
+        entries = sorted(self._entries())
+        size = sum([ size for _, size, _ in entries ])
+        for _, entry_size, path in entries:
+            if size<=target_fraction*self.max_size_mb*1e6:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            os.remove(path)
+        self._size = 0
+
+    def get_summary(self):
+        return (f'Record cache {self.cache_dir}: {self.n_hits} hits, {self.n_misses} misses, '
+                f'{self.get_size()/1e6:.1f} of {self.max_size_mb} MB used')
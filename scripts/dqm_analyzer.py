@@ -2,27 +2,38 @@
 
 import rawdatautils.unpack.utils
 import dqmtools.dataframe_creator as dfc
+from dqmtools.accumulators import ChannelStatsAccumulator, ChannelADCHistogram, channel_stats_key, adc_histogram_key
+from dqmtools.record_cache import RecordCache
 from dqmtools.dqmtools import *
 from dqmtools.dqmtests import *
 from dqmtools.dqmplots import *
 
 import hdf5libs
 
+import time
 import click
 @click.command()
 @click.argument('filenames', nargs=-1, type=click.Path(exists=True))
 @click.option('--nrecords', '-n', default=1, help='How many Trigger Records to process (default: 1)')
 @click.option('--nworkers', default=10, help='How many thread workers to launch (default: 10)')
+@click.option('--nprocs', default=1, help='How many worker processes to split records across (default: 1)')
 @click.option('--hd/--vd', default=True, help='Whether we are running HD (or VD) (default: "HD")')
 @click.option('--warm/--cold', default=True, help='Whether we are running warm or cold (default: "warm")')
 @click.option('--pds',is_flag=True, help='If PDS was included and should be processed')
 @click.option('--wibpulser', is_flag=True, help='WIBs in pulser mode')
 @click.option('--make-plots',is_flag=True, help='Option to make plots')
+@click.option('--test-workers', default=1, help='How many threads to run independent tests and suites on (default: 1)')
+@click.option('--chunk-size', default=0, help='Run the tests every N records and merge results, keeping memory bounded (default: 0, all records at once)')
+@click.option('--adc-histograms', is_flag=True, help='With --chunk-size, also fill per-channel ADC histograms from the WIBEth waveforms and check them for stuck codes over the run (unpacks waveforms, slower)')
+@click.option('--headers-only', is_flag=True, help='Quick-look mode: only unpack headers and run the header checks, no ADC data or waveforms')
+@click.option('--unpack-all', is_flag=True, help='Unpack every fragment and data level, not only what the configured tests read')
+@click.option('--cache-dir', default=None, help='Directory of an on-disk cache of unpacked records, reused across runs (default: no cache)')
+@click.option('--cache-size-mb', default=10000, help='Size limit of the record cache in MB, least recently used records are evicted first (default: 10000)')
 
-def main(filenames, nrecords, nworkers, hd, warm, pds, wibpulser, make_plots):
+def main(filenames, nrecords, nworkers, nprocs, hd, warm, pds, wibpulser, make_plots, test_workers, chunk_size, adc_histograms, headers_only, unpack_all, cache_dir, cache_size_mb):
 
     #setup our tests
-    dqm_test_suite_wibs = DQMTestSuite("WIBEth Tests")
+    dqm_test_suite_wibs = DQMTestSuite("WIBEth Tests",max_workers=test_workers)
     dqm_test_suite_wibs.register_test(CheckAllExpectedFragmentsTest())
     dqm_test_suite_wibs.register_test(CheckNFrames_WIBEth())
     
@@ -46,51 +57,83 @@ def main(filenames, nrecords, nworkers, hd, warm, pds, wibpulser, make_plots):
 
     dqm_test_suite_wibs.register_test(CheckTimestampDiffs_WIBEth(tpc_det_name))
 
-    dqm_test_suite_wibs.register_test(CheckWIBEth_COLDDATA_Timestamp_0_Diff(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_COLDDATA_Timestamp_1_Diff(tpc_det_name))
     dqm_test_suite_wibs.register_test(CheckWIBEth_COLDDATA_Timestamps_Aligned(tpc_det_name))
 
-    dqm_test_suite_wibs.register_test(CheckWIBEth_CRC_Err(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_Pulser(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_Calibration(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_Ready(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_Context(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_CD(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_LOL(tpc_det_name))        
-    dqm_test_suite_wibs.register_test(CheckWIBEth_Link_Valid(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_WIB_Sync(tpc_det_name))
-    dqm_test_suite_wibs.register_test(CheckWIBEth_FEMB_Sync(tpc_det_name))
+    #all CheckWIBEth_* header value checks, evaluated in one pass over the header frame
+    dqm_test_suite_wibs.register_test(CheckWIBEth_Header_Rules(tpc_det_name))
 
     dqm_test_suite_wibs.register_test(CheckTimestampsAligned(tpc_det_id),f"CheckTimestampsAligned_{tpc_det_name}")
     dqm_test_suite_wibs.register_test(CheckRequestTimes_WIBEth(tpc_det_name))
 
-    if(not wibpulser):
-        dqm_test_suite_wibs.register_test(CheckRMS_WIBEth(det_name=tpc_det_name,threshold=tpc_rms_high_threshold,verbose=True),
-                                         name=f"CheckRMS_{tpc_det_name}_High")
-        dqm_test_suite_wibs.register_test(CheckRMS_WIBEth(det_name=tpc_det_name,threshold=tpc_rms_low_threshold,operator=operator.lt,verbose=True),
-                                         name=f"CheckRMS_{tpc_det_name}_Low")
-        dqm_test_suite_wibs.register_test(CheckPedestal_WIBEth(det_name=tpc_det_name,verbose=True),
-                                         name=f"CheckPedestal_{tpc_det_name}")
+    def register_channel_tests(suite):
+        suite.register_test(CheckRMS_WIBEth(det_name=tpc_det_name,threshold=tpc_rms_high_threshold,verbose=True),
+                            name=f"CheckRMS_{tpc_det_name}_High")
+        suite.register_test(CheckRMS_WIBEth(det_name=tpc_det_name,threshold=tpc_rms_low_threshold,operator=operator.lt,verbose=True),
+                            name=f"CheckRMS_{tpc_det_name}_Low")
+        suite.register_test(CheckPedestal_WIBEth(det_name=tpc_det_name,verbose=True),
+                            name=f"CheckPedestal_{tpc_det_name}")
 
-    dqm_test_suite = DQMTestSuite("All Tests")
+    if(not wibpulser and not headers_only):
+        register_channel_tests(dqm_test_suite_wibs)
+
+    dqm_test_suite = DQMTestSuite("All Tests",max_workers=test_workers)
     dqm_test_suite.register_test(dqm_test_suite_wibs)
         
     if pds:
         """
         Create separate test suite for DAPHNE and register all related tests
         """
-        dqm_test_suite_daphne = DQMTestSuite("DAPHNETests")
+        dqm_test_suite_daphne = DQMTestSuite("DAPHNETests",max_workers=test_workers)
         dqm_test_suite_daphne.register_test(CheckTimestampsAligned(2),"CheckTimestampsAligned_PDS")
         dqm_test_suite_daphne.register_test(CheckEmptyFragments_DAPHNE(), "CheckEmptyFragments_DAPHNE")
-        dqm_test_suite_daphne.register_test(CheckTimestampDiffs_DAPHNE())
-        dqm_test_suite_daphne.register_test(CheckADCData_DAPHNE())
+        if not headers_only:
+            dqm_test_suite_daphne.register_test(CheckTimestampDiffs_DAPHNE())
+            dqm_test_suite_daphne.register_test(CheckADCData_DAPHNE())
 
         dqm_test_suite.register_test(dqm_test_suite_daphne)
 
 
         
+    #in streaming mode, per-channel statistics are also accumulated over the whole run
+    tpc_data_key = f'detd_k{tpc_det_name}_kWIBEth'
+    tpc_wvfm_key = f'detw_k{tpc_det_name}_kWIBEth'
+    channel_stats = { tpc_data_key: ChannelStatsAccumulator() } if (chunk_size>0 and not wibpulser and not headers_only) else {}
+    if adc_histograms and chunk_size>0 and not headers_only:
+        channel_stats[tpc_wvfm_key] = ChannelADCHistogram()
+
+    dqm_test_suite_channels = DQMTestSuite("Run-level Channel Tests")
+    if tpc_data_key in channel_stats:
+        register_channel_tests(dqm_test_suite_channels)
+    if tpc_wvfm_key in channel_stats:
+        dqm_test_suite_channels.register_test(CheckStuckCodes_WIBEth(det_name=tpc_det_name,verbose=True),
+                                              name=f"CheckStuckCodes_{tpc_det_name}")
+
+    #waveforms only feed the ADC histograms, their rows are not kept
+    wvfm_data_prescale = 1 if tpc_wvfm_key in channel_stats else None
+    keep_channel_rows = [ key for key in channel_stats if key!=tpc_wvfm_key ]
+
+    cache = RecordCache(cache_dir,max_size_mb=cache_size_mb) if cache_dir is not None else None
+
+    #only unpack what the tests read; plots need the full data
+    input_keys = dqm_test_suite.get_input_keys()
+    if input_keys is not None:
+        input_keys |= dqm_test_suite_channels.get_input_keys()
+    unpack_filter = None
+    if headers_only:
+        unpack_filter = dfc.UnpackFilter.quick_look(input_keys)
+        if make_plots:
+            print('No plots are made in --headers-only mode.')
+            make_plots = False
+    elif not (unpack_all or make_plots):
+        unpack_filter = dfc.UnpackFilter(input_keys)
+
     df_dict = {}
+    plot_df_dict = None
+    res = DQMTestResult(DQMResultEnum.INVALID,"No records processed.")
     n_processed_records = 0
+    n_chunk_records = 0
+    n_chunks = 0
+    start_time = time.perf_counter()
     for filename in filenames:
         print(f'Processing file {filename}.')
         
@@ -103,22 +146,95 @@ def main(filenames, nrecords, nworkers, hd, warm, pds, wibpulser, make_plots):
             records_to_process = records[:(nrecords-n_processed_records)]
         print(f'Will process {len(records_to_process)} of {len(records)} records.')
 
-        for rid in records_to_process:
-            print(f'Processing record {rid}')
-            df_dict = dfc.process_record(h5_file,rid,df_dict,MAX_WORKERS=nworkers)
-            n_processed_records += 1
+        processor = dfc.RecordProcessor(h5_file,MAX_WORKERS=nworkers,wvfm_data_prescale=wvfm_data_prescale,
+                                        channel_stats=channel_stats,keep_channel_rows=keep_channel_rows,cache=cache,
+                                        unpack_filter=unpack_filter) if nprocs<=1 else None
+
+        try:
+            i_rec = 0
+            while i_rec < len(records_to_process):
+                #in streaming mode, only take what is needed to fill the current chunk
+                if chunk_size>0:
+                    rid_block = records_to_process[i_rec:i_rec+(chunk_size-n_chunk_records)]
+                else:
+                    rid_block = records_to_process[i_rec:]
+                i_rec += len(rid_block)
+
+                if processor is None:
+                    print(f'Processing {len(rid_block)} records with {nprocs} processes')
+                    df_dict = dfc.process_records_multiprocess(filename,rid_block,df_dict,nprocs=nprocs,MAX_WORKERS=nworkers,
+                                                               wvfm_data_prescale=wvfm_data_prescale,
+                                                               channel_stats=channel_stats,keep_channel_rows=keep_channel_rows,
+                                                               cache=cache,unpack_filter=unpack_filter)
+                else:
+                    for rid in processor.process_records(rid_block,df_dict):
+                        print(f'Processed record {rid}')
+                n_processed_records += len(rid_block)
+                n_chunk_records += len(rid_block)
+
+                if chunk_size>0 and n_chunk_records==chunk_size:
+                    df_dict = dfc.concatenate_dataframes(df_dict)
+                    res = dqm_test_suite.run_test(df_dict)
+                    print(f'Chunk {n_chunks} ({n_chunk_records} records): {res}')
+                    if make_plots and plot_df_dict is None:
+                        plot_df_dict = df_dict
+                    #release the chunk frames now that their results exist
+                    df_dict = {}
+                    n_chunk_records = 0
+                    n_chunks += 1
+        finally:
+            #shut the reader and worker threads down on errors too
+            if processor is not None:
+                processor.close()
+
+        if processor is not None:
+            print(processor.get_timing_summary())
+
+    elapsed = time.perf_counter()-start_time
+    print(f'Processed {n_processed_records} records in {elapsed:.1f} s ({60*n_processed_records/elapsed if elapsed>0 else 0:.0f} records/min).')
+
+    if cache is not None:
+        print(cache.get_summary())
+
+    if chunk_size>0:
+        if n_chunk_records>0:
+            df_dict = dfc.concatenate_dataframes(df_dict)
+            res = dqm_test_suite.run_test(df_dict)
+            print(f'Chunk {n_chunks} ({n_chunk_records} records): {res}')
+            if make_plots and plot_df_dict is None:
+                plot_df_dict = df_dict
+            n_chunks += 1
+        df_dict = plot_df_dict if plot_df_dict is not None else {}
+
+        #each chunk's result covers that chunk only; the run-level one merges them
+        res = dqm_test_suite.get_merged_result()
+        print(f'Run-level result over {n_processed_records} records in {n_chunks} chunks: {res}')
+        print(dqm_test_suite.get_table(merged=True,show_last_update=False))
+
+        for test in dqm_test_suite.get_all_tests():
+            if test.is_test_suite():
+                print(f'Results for {test.get_name()}:')
+                print(test.get_table(merged=True,show_last_update=False))
+
+        run_df_dict = { (adc_histogram_key(key) if key==tpc_wvfm_key else channel_stats_key(key)): acc.to_dataframe()
+                        for key, acc in channel_stats.items() if len(acc)>0 }
+        if len(run_df_dict)>0:
+            dqm_test_suite_channels.run_test(run_df_dict)
+            print(f'Results for {dqm_test_suite_channels.get_name()} over {n_processed_records} records:')
+            print(dqm_test_suite_channels.get_table(show_last_update=False))
 
-    df_dict = dfc.concatenate_dataframes(df_dict)
+    else:
+        df_dict = dfc.concatenate_dataframes(df_dict)
 
-    #print(df_dict.keys())
+        #print(df_dict.keys())
 
-    res = dqm_test_suite.run_test(df_dict)
-    print(dqm_test_suite.get_table(show_last_update=False))
+        res = dqm_test_suite.run_test(df_dict)
+        print(dqm_test_suite.get_table(show_last_update=False))
 
-    for test in dqm_test_suite.get_all_tests():
-        if test.is_test_suite():
-            print(f'Results for {test.get_name()}:')
-            print(test.get_table(show_last_update=False))
+        for test in dqm_test_suite.get_all_tests():
+            if test.is_test_suite():
+                print(f'Results for {test.get_name()}:')
+                print(test.get_table(show_last_update=False))
 
     if(make_plots):
         if(not wibpulser):
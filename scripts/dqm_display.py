@@ -13,7 +13,7 @@ last_mod_time = 0
 images = []
 
 # Regular expression to parse the filenames
-filename_regex = re.compile(r"EventDisplay_run(\d+)_trigger(\d+)_seq\d+_APA(\d+)_plane(\d+)\.svg")
+filename_regex = re.compile(r"EventDisplay_run(\d+)_trigger(\d+)_seq\d+_APA(\d+)_plane(\d+)\.(svg|png|webp|jpe?g)")
 
 def get_latest_files(directory):
 
@@ -2,6 +2,7 @@
 
 import rawdatautils.unpack.utils
 import dqmtools.dataframe_creator as dfc
+from dqmtools.record_cache import RecordCache
 from dqmtools.dqmtools import *
 from dqmtools.dqmtests import *
 from dqmtools.dqmplots import *
@@ -9,6 +10,8 @@ from dqmtools.dqmplots import *
 import hdf5libs
 
 import concurrent.futures
+import os
+import time
 
 import click
 @click.command()
@@ -16,14 +19,17 @@ import click
 @click.argument('output_dir', type=click.Path(exists=True))
 @click.option('--nworkers', default=10, help='How many thread workers to launch (default: 12)')
 @click.option('--nskip', default=0, help='How many trigger records to skip at start of file')
-@click.option('--imgtype', default='svg', help='Type of image to write')
+@click.option('--imgtype', default='png', help='Type of image to write. png, webp and jpeg are drawn directly, other types (svg, pdf) go through plotly (default: png)')
+@click.option('--nprocs', default=min(12,os.cpu_count() or 1), help='How many processes render the raster images (default: one per plane, up to the CPU count)')
+@click.option('--cache-dir', default=None, help='Directory of an on-disk cache of unpacked records, reused across runs (default: no cache)')
+@click.option('--cache-size-mb', default=10000, help='Size limit of the record cache in MB, least recently used records are evicted first (default: 10000)')
 #@click.option('--hd/--vd', default=True, help='Whether we are running HD (or VD) (default: "HD")')
 #@click.option('--warm/--cold', default=True, help='Whether we are running warm or cold (default: "warm")')
 #@click.option('--pds',is_flag=True, help='If PDS was included and should be processed')
 #@click.option('--wibpulser', is_flag=True, help='WIBs in pulser mode')
 #@click.option('--make-plots',is_flag=True, help='Option to make plots')
 
-def main(filename, output_dir, nworkers, nskip, imgtype):
+def main(filename, output_dir, nworkers, nskip, imgtype, nprocs, cache_dir, cache_size_mb):
 
     df_dict = {}
         
@@ -43,7 +49,9 @@ def main(filename, output_dir, nworkers, nskip, imgtype):
 
     print(f"Processing record {rid} in file {filename}.")
     
-    df_dict = dfc.process_record(h5_file,rid,df_dict,MAX_WORKERS=nworkers,ana_data_prescale=1,wvfm_data_prescale=1)
+    cache = RecordCache(cache_dir,max_size_mb=cache_size_mb) if cache_dir is not None else None
+    with dfc.RecordProcessor(h5_file,MAX_WORKERS=nworkers,ana_data_prescale=1,wvfm_data_prescale=1,cache=cache) as processor:
+        df_dict = processor.process_record(rid,df_dict)
     df_dict = dfc.concatenate_dataframes(df_dict)
 
 
@@ -62,16 +70,39 @@ def main(filename, output_dir, nworkers, nskip, imgtype):
         for plane in [0,1,2]:
             planes.append((apa,plane))
 
+    def get_image_name(index,apa,plane):
+        return f"EventDisplay_run{index.run}_trigger{index.trigger}_seq{index.sequence}_{apa}_plane{plane}.{imgtype}"
+
+    start_time = time.perf_counter()
+    if imgtype.lower() in RASTER_FORMATS:
+        #build the matrices here, render them in parallel without plotly
+        rename_PD2HD_APAs(df_dict)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1,min(nprocs,len(planes)))) as executor:
+            futures = []
+            for apa, plane in planes:
+                matrix = get_WIBEth_adc_matrix(df_dict,tpc_det_key,apa,plane,offset=offset)
+                if matrix is None or len(matrix.channels)==0:
+                    print(f"No data for {apa} plane {plane}.")
+                    continue
+                index = matrix.index
+                futures.append(executor.submit(render_adc_matrix,matrix,f"{output_dir}/{get_image_name(index,apa,plane)}",
+                                               title=f"Run {index.run}, Trigger {index.trigger}, {apa} Plane {plane}",
+                                               orientation="vertical",colorscale='plasma',color_range=(-256,256)))
+            for future in concurrent.futures.as_completed(futures):
+                print(f"Completed image {os.path.basename(future.result())}")
+        print(f"Done in {time.perf_counter()-start_time:.1f} s.")
+        return
+
     def make_adc_map_fig(apa,plane):
-        df_tmp, index = dfc.select_record(df_dict[tpc_det_key])
-        df_tmp= df_tmp.reset_index()
         fig = plot_WIBEth_adc_map(df_dict,tpc_det_key,apa,plane,
                                   offset=True,make_static=True,make_tp_overlay=False,
                                   orientation="vertical",colorscale='plasma',color_range=(-256,256))
+        #same cached matrix the figure was drawn from
+        index = get_WIBEth_adc_matrix(df_dict,tpc_det_key,apa,plane).index
         print(f"Figure for {apa} plane {plane} processed...")
         fig.update_layout(title=dict(text=f"Run {index.run}, Trigger {index.trigger}, {apa} Plane {plane}", font=dict(size=24) ) )
-        fig.write_image(f"{output_dir}/EventDisplay_run{index.run}_trigger{index.trigger}_seq{index.sequence}_{apa}_plane{plane}.{imgtype}", scale=3)
-        return f"EventDisplay_run{index.run}_trigger{index.trigger}_seq{index.sequence}_{apa}_plane{plane}.{imgtype}"
+        fig.write_image(f"{output_dir}/{get_image_name(index,apa,plane)}", scale=3)
+        return get_image_name(index,apa,plane)
             
     with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
         future_p = {executor.submit(make_adc_map_fig,
@@ -80,7 +111,7 @@ def main(filename, output_dir, nworkers, nskip, imgtype):
             res = future.result()
             print(f"Completed image {res}")
 
-    print("Done.")
+    print(f"Done in {time.perf_counter()-start_time:.1f} s.")
 
 if __name__ == '__main__':
     main()
@@ -2,14 +2,12 @@
 import sys
 import os
 
-import rawdatautils.unpack.utils
-import detdataformats
 import daqdataformats
 
-from rawdatautils.unpack.dataclasses import *
 import dqmtools.dataframe_creator as dfc
+from dqmtools.dataframe_dict import get_frh_by_fragment_type
+from dqmtools.record_cache import RecordCache
 from hdf5libs import HDF5RawDataFile
-import h5py
 
 import numpy as np
 try:
@@ -33,8 +31,10 @@ import click
 @click.option('--nfiles',   '-nf',          default=-1,     help='Number of files to process in the run (default: all).')
 @click.option('--cathode', is_flag=True,     default=False,  help='Use only cathode channels')
 @click.option('--membrane',is_flag=True,    default=False,  help='Use only membrane channels')
+@click.option('--cache-dir',                default=None,   help='Directory of an on-disk cache of unpacked records, reused across runs (default: no cache)')
+@click.option('--cache-size-mb',            default=10000,  help='Size limit of the record cache in MB (default: 10000)')
 
-def main(input_dir, run, nrecords, nfiles, cathode, membrane):
+def main(input_dir, run, nrecords, nfiles, cathode, membrane, cache_dir, cache_size_mb):
     """
         For the specified RUN script will iterate over datafiles, unpack the DAPHNE streaming data,
         create numpy arrays of the waveforms and save them to the files in current directory.
@@ -63,7 +63,11 @@ def main(input_dir, run, nrecords, nfiles, cathode, membrane):
     else:
         active_chan     = [21, 36]
 
-    
+    cache = RecordCache(cache_dir, max_size_mb=cache_size_mb) if cache_dir is not None else None
+
+    #only the DAPHNE stream waveforms and fragment headers are used
+    unpack_filter = dfc.UnpackFilter(["frh_kDAPHNEStream", "detw_kHD_PDS_kDAPHNEStream"])
+
     for file in files_to_process:
 
         file_id   = file.split("_")[3]
@@ -81,42 +85,10 @@ def main(input_dir, run, nrecords, nfiles, cathode, membrane):
     
         df_dict = {}
 
-        for r in records_to_process:
-
-            with h5py.File(h5_file.get_file_name(), 'r') as f:
-                record_index = dfc.RecordDataBase(run=f.attrs["run_number"],trigger=r[0],sequence=r[1])
-            sids = h5_file.get_source_ids(r)
-
-            for sid in sids:
-
-                sid_unpacker = rawdatautils.unpack.utils.SourceIDUnpacker(record_index)
-                return_dict = sid_unpacker.get_all_data(sid)
-
-                if sid.subsystem != daqdataformats.SourceID.Subsystem.kDetectorReadout:
-                    continue
-                
-                frag        = h5_file.get_frag((record_index.trigger,record_index.sequence),sid)
-                frag_type   = frag.get_fragment_type() #print(frag_type)
-                
-                if frag_type != daqdataformats.FragmentType.kDAPHNEStream:
-                    continue
-
-                det_id      = frag.get_detector_id()
-                type_string = f'{detdataformats.DetID.Subdetector(det_id).name}_{frag_type.name}'
-
-                fragment_unpacker = dfc.get_fragment_unpacker(frag_type,det_id)
-                fragment_unpacker.wvfm_data_prescale = 1
-
-                if fragment_unpacker is None:
-                    print(f'Unknown fragment {type_string}. Source ID {sid}')
-                    return return_dict
-                
-                return_dict = (return_dict | fragment_unpacker.get_all_data(frag) )
-                
-                for key, df in return_dict.items():
-                    if key not in df_dict.keys():
-                        df_dict[key] = []
-                    df_dict[key].extend(df)
+        with dfc.RecordProcessor(h5_file, ana_data_prescale=1, wvfm_data_prescale=1, cache=cache,
+                                 unpack_filter=unpack_filter) as processor:
+            for r in processor.process_records(records_to_process, df_dict):
+                pass
 
         df_dict = dfc.concatenate_dataframes(df_dict)
 
@@ -127,20 +99,23 @@ def main(input_dir, run, nrecords, nfiles, cathode, membrane):
             print('No waveform data in the file.')
             continue
 
-        trigger_ts      = df_dict['frh'].trigger_timestamp_dts
+        #fragment headers of the DAPHNE streams only, other detectors have their own windows
+        df_frh          = get_frh_by_fragment_type(df_dict, daqdataformats.FragmentType.kDAPHNEStream.value)
+
+        trigger_ts      = df_frh.trigger_timestamp_dts
 
         if len(np.unique(trigger_ts)) != len(records_to_process):
             print(f"Unique trigger timestamps for {len(records_to_process)} records \t - \t {len(np.unique(trigger_ts))}")
             print("Problems with trigger timestaps")
     
-        trigger_ts      = np.array(np.unique(df_dict['frh'].trigger_timestamp_dts), dtype=np.int64)
+        trigger_ts      = np.array(np.unique(df_frh.trigger_timestamp_dts), dtype=np.int64)
 
-        print(f"Width of the readout window -- {np.unique(np.array(df_dict['frh'].window_end_dts) - np.array(df_dict['frh'].window_begin_dts))}")
+        print(f"Width of the readout window -- {np.unique(np.array(df_frh.window_end_dts) - np.array(df_frh.window_begin_dts))}")
         #print(f"Unique trigger timestamps for {records_to_process} records \t - \t {len(np.unique(trigger_ts))}")
 
-        req_wave_len = np.unique(np.array(df_dict['frh'].window_end_dts) - np.array(df_dict['frh'].window_begin_dts))[0]
-        window_begin = np.unique(np.array(df_dict['frh'].window_begin_dts))
-        window_end   = np.unique(np.array(df_dict['frh'].window_end_dts))
+        req_wave_len = np.unique(np.array(df_frh.window_end_dts) - np.array(df_frh.window_begin_dts))[0]
+        window_begin = np.unique(np.array(df_frh.window_begin_dts))
+        window_end   = np.unique(np.array(df_frh.window_end_dts))
 
         window_begin = np.array(window_begin, dtype=np.int64)
         window_end   = np.array(window_end, dtype=np.int64)
@@ -189,6 +164,9 @@ def main(input_dir, run, nrecords, nfiles, cathode, membrane):
 
             filename_adc = f"adc_data_run_{run}_srcid_{src_id}_ch_{ch}_{file_id}.npy"
             np.save(filename_adc, waveforms)
+
+    if cache is not None:
+        print(cache.get_summary())
                 
     return
 
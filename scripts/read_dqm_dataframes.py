@@ -1,36 +1,44 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import dqmtools.dataframe_io as dfio
 
 import click
 
 
+def parse_range(value):
+    if value is None:
+        return None
+    first, last = value.split(':')
+    return (int(first), int(last))
+
 @click.command()
 @click.argument('input_filenames', nargs=-1, type=click.Path(exists=True))
-def main(input_filenames):
-    df_dict = {}
-
-    for filename in input_filenames:
-        print(f'Processing file {filename}.')
-
-        with pd.HDFStore(filename, 'r') as store:
-
-            # Loop through each key
-            for key in store.keys():
-                my_key = key[1:]  # remove front '/'
-                if my_key not in df_dict:
-                    df_dict[my_key] = []
-                df_dict[my_key].append(store[key])
-
-    for key in df_dict.keys():
-        df_dict[key] = pd.concat(df_dict[key])
-
-    print(f'Files contained {len(df_dict.keys())} keys.')
-    for key, df in df_dict.items():
+@click.option('--keys', '-k', multiple=True, help='Only consider these keys (can be repeated, default: all)')
+@click.option('--columns', '-c', multiple=True, help='Only load these columns (can be repeated, default: all)')
+@click.option('--runs', default=None, help='Inclusive run range to load, as first:last')
+@click.option('--triggers', default=None, help='Inclusive trigger range to load, as first:last')
+@click.option('--load', is_flag=True, help='Load the selected data instead of only reading metadata')
+def main(input_filenames, keys, columns, runs, triggers, load):
+
+    keys = list(keys) if len(keys) > 0 else None
+    columns = list(columns) if len(columns) > 0 else None
+
+    if load:
+        df_dict = dfio.load_dataframes(input_filenames, keys=keys, columns=columns,
+                                       run_range=parse_range(runs), trigger_range=parse_range(triggers))
+        info = { key: { "n_rows": len(df), "index_names": list(df.index.names), "columns": df.columns.to_list() }
+                 for key, df in df_dict.items() }
+    else:
+        info = dfio.describe_files(input_filenames)
+        if keys is not None:
+            info = { key: entry for key, entry in info.items() if key in keys }
+
+    print(f'Files contained {len(info.keys())} keys.')
+    for key, entry in info.items():
         print(f'\tDataframe name: {key}')
-        print(f'\t\tTotal entries: {len(df)}')
-        print(f'\t\tDataframe indices: {df.index.names}')
-        print(f'\t\tDataframe columns: {df.columns.to_list()}')
+        print(f'\t\tTotal entries: {entry["n_rows"]}')
+        print(f'\t\tDataframe indices: {entry["index_names"]}')
+        print(f'\t\tDataframe columns: {entry["columns"]}')
 
 
 if __name__ == '__main__':
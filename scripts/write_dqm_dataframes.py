@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import dqmtools.dataframe_creator as dfc
+import dqmtools.dataframe_io as dfio
 import hdf5libs
 import os
+import shutil
 import click
 
 
@@ -13,26 +15,51 @@ import click
 @click.option('--append', '-a', is_flag=True, help='Append to file if it already exists.')
 @click.option('--nrecords', '-n', default=1, help='How many Trigger Records to process (default: 1)')
 @click.option('--nworkers', default=10, help='How many thread workers to launch (default: 10)')
+@click.option('--nprocs', default=1, help='How many worker processes to split records across (default: 1)')
 @click.option('--wvfm_data_prescale', default=None, help='Prescale to apply to waveform data storage (default: None)')
 @click.option('--complevel', default=0, help='Compression level to use (0-9, default: 0)')
-@click.option('--complib', default=None, help='Compression library to use (zlib, lzo, bzip2, blosc, default: None)')
-def main(input_filenames, output_filename, force, append, nrecords, wvfm_data_prescale, nworkers, complevel, complib):
+@click.option('--complib', default=None, help='Compression library to use (hdf5: zlib, lzo, bzip2, blosc, default: None; parquet: zstd, snappy, gzip, lz4, brotli, default: zstd)')
+@click.option('--format', 'output_format', type=click.Choice(['hdf5','parquet']), default='hdf5',
+              help='Output format. parquet writes a directory partitioned by key and run, with zstd compression (default: hdf5)')
+@click.option('--flush-records', default=0, help='Write to disk every N records, bounding memory use (default: 0, only at the end)')
+@click.option('--flush-mb', default=0., help='Write to disk once the pending data exceed this many MB (default: 0, no limit)')
+def main(input_filenames, output_filename, force, append, nrecords, wvfm_data_prescale, nworkers, nprocs, complevel, complib, output_format,
+         flush_records, flush_mb):
 
     if force and append:
         print('Cannot use both --force (-f) and --append (-a) options. Use only one.')
     
-    if os.path.isfile(output_filename):
+    if os.path.exists(output_filename):
         print(f'File {output_filename} exists.')
         if force:
             print('Deleting...')
-            os.remove(output_filename)
+            if os.path.isdir(output_filename):
+                shutil.rmtree(output_filename)
+            else:
+                os.remove(output_filename)
         elif append:
             print('Append option enabled. Will append to existing file.')
         else:
             print("Remove file or use '-f' option to force removal, or use '-a' option to append new data to file.")
             return 1
     
+    try:
+        writer = dfio.DataFrameWriter(output_filename, output_format=output_format,
+                                      flush_records=flush_records, flush_mb=flush_mb,
+                                      complevel=complevel, complib=complib)
+    except ValueError as err:
+        print(err)
+        return 1
+
     df_dict = {}
+    n_pending_records = 0
+
+    def flush():
+        frames = dfc.concatenate_dataframes(df_dict)
+        print(frames.keys())
+        writer.write(frames, n_pending_records)
+        df_dict.clear()
+
     n_processed_records = 0
     for filename in input_filenames:
         print(f'Processing file {filename}.')
@@ -46,20 +73,37 @@ def main(input_filenames, output_filename, force, append, nrecords, wvfm_data_pr
             records_to_process = records[:(nrecords-n_processed_records)]
         print(f'Will process {len(records_to_process)} of {len(records)} records.')
 
-        for rid in records_to_process:
-            print(f'Processing record {rid}')
-            df_dict = dfc.process_record(h5_file, rid, df_dict, MAX_WORKERS=nworkers, wvfm_data_prescale=wvfm_data_prescale)
-            n_processed_records += 1
+        if nprocs > 1:
+            #hand the pool at most one flush worth of records at a time
+            block_size = flush_records if flush_records > 0 else len(records_to_process)
+            for i_rec in range(0, len(records_to_process), max(1, block_size)):
+                rid_block = records_to_process[i_rec:i_rec+block_size]
+                print(f'Processing {len(rid_block)} records with {nprocs} processes')
+                dfc.process_records_multiprocess(filename, rid_block, df_dict, nprocs=nprocs,
+                                                 MAX_WORKERS=nworkers, wvfm_data_prescale=wvfm_data_prescale)
+                n_processed_records += len(rid_block)
+                n_pending_records += len(rid_block)
+                if writer.should_flush(df_dict, n_pending_records):
+                    flush()
+                    n_pending_records = 0
+        else:
+            with dfc.RecordProcessor(h5_file, MAX_WORKERS=nworkers, wvfm_data_prescale=wvfm_data_prescale) as processor:
+                for rid in processor.process_records(records_to_process, df_dict):
+                    print(f'Processed record {rid}')
+                    n_processed_records += 1
+                    n_pending_records += 1
+                    if writer.should_flush(df_dict, n_pending_records):
+                        flush()
+                        n_pending_records = 0
+            print(processor.get_timing_summary())
 
         if n_processed_records == nrecords:
             break
 
-    df_dict = dfc.concatenate_dataframes(df_dict)
-
-    print(df_dict.keys())
+    if n_pending_records > 0:
+        flush()
 
-    for key, df in df_dict.items():
-        df.to_hdf(output_filename, key=key, complevel=complevel, complib=complib)
+    print(writer.get_summary())
     
 
 if __name__ == '__main__':
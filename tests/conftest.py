@@ -0,0 +1,5 @@
+import os
+import sys
+
+#run against the source tree when dqmtools is not installed
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","python"))
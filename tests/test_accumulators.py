@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+from dqmtools.accumulators import ChannelStatsAccumulator, ChannelADCHistogram
+
+def make_rows(n_records,seed=0):
+    rng = np.random.default_rng(seed)
+    channels = np.tile(np.arange(6),n_records)
+    return pd.DataFrame({ "channel": channels,
+                          "apa": np.where(channels<3,"APA_P02SU","APA_P01NL").astype(object),
+                          "plane": channels%3,
+                          "adc_rms": rng.normal(5,1,len(channels)),
+                          "adc_mean": rng.normal(900,10,len(channels)) })
+
+def test_channel_stats_string_apa():
+    df = make_rows(20)
+    acc = ChannelStatsAccumulator()
+    for chunk in np.array_split(np.arange(len(df)),4):
+        acc.update(df.iloc[chunk])
+    out = acc.to_dataframe().set_index("channel")
+
+    expected = df.groupby("channel").agg(apa=("apa","first"),plane=("plane","first"),
+                                         adc_rms=("adc_rms","mean"),adc_rms_std=("adc_rms","std"))
+    assert list(out["apa"])==list(expected["apa"])
+    assert list(out["plane"])==list(expected["plane"])
+    np.testing.assert_allclose(out["adc_rms"],expected["adc_rms"])
+    np.testing.assert_allclose(out["adc_rms_std"],expected["adc_rms_std"])
+
+def test_channel_stats_merge_string_apa():
+    df = make_rows(10)
+    half = len(df)//2
+    a = ChannelStatsAccumulator().update(df.iloc[:half])
+    b = ChannelStatsAccumulator().update(df.iloc[half:])
+    single = ChannelStatsAccumulator().update(df)
+    merged = a.merge(b).to_dataframe()
+    pd.testing.assert_frame_equal(merged,single.to_dataframe())
+    assert merged["apa"].iloc[0]=="APA_P02SU"
+
+def make_waveforms(n_rows,pedestals,seed=0):
+    rng = np.random.default_rng(seed)
+    channels = rng.integers(0,len(pedestals),n_rows)
+    lengths = rng.integers(0,200,n_rows)
+    adcs = np.concatenate([ rng.normal(pedestals[c],5,n).astype(np.int64) for c, n in zip(channels,lengths) ])
+    #signals and glitches far outside the pedestal window
+    adcs[rng.integers(0,len(adcs),50)] = rng.integers(0,1<<14,50)
+    return channels, adcs, lengths
+
+def exact_stats(batches,channel,q):
+    samples = []
+    for channels, adcs, lengths in batches:
+        offsets = np.concatenate(([0],np.cumsum(lengths)))
+        samples += [ adcs[offsets[i]:offsets[i+1]] for i in np.nonzero(channels==channel)[0] ]
+    x = np.sort(np.concatenate(samples))
+    return len(x), x[0], x[-1], x[max(int(np.ceil(len(x)*q/100.)),1)-1]
+
+def test_adc_histogram_merge_matches_exact():
+    pedestals = np.array([900,8200,2000,15000])
+    batches = [ make_waveforms(100,pedestals+(60 if i>=2 else 0),seed=i) for i in range(4) ]
+    first, second = ChannelADCHistogram(window=64), ChannelADCHistogram(window=64)
+    for i, batch in enumerate(batches):
+        (first if i<2 else second).update_arrays(*batch)
+    hist = ChannelADCHistogram(window=64).merge(second).merge(first)
+    assert hist.counts.shape==(len(pedestals),64)
+
+    out = hist.to_dataframe(percentiles=(5,95))
+    for row, channel in enumerate(out["channel"]):
+        for q, name in [(5,"adc_p5"),(50,"adc_median"),(95,"adc_p95")]:
+            n, adc_min, adc_max, value = exact_stats(batches,channel,q)
+            assert out[name][row]==value
+        assert (out["n_samples"][row],out["adc_min"][row],out["adc_max"][row])==(n,adc_min,adc_max)
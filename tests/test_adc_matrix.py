@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("rawdatautils")
+pytest.importorskip("hdf5libs")
+
+from dqmtools.dataframe_dict import DataFrameDict
+from dqmtools.dqmplots import plot_utils
+
+def make_df_dict(n_channels=6,n_ticks=8):
+    rng = np.random.default_rng(0)
+    index = ["run","trigger","sequence","src_id","channel"]
+    rows = []
+    for ch in range(n_channels):
+        rows.append(dict(run=1,trigger=5,sequence=0,src_id=0,channel=ch,apa="APA_P01SU",plane=ch%3,
+                         timestamps=np.arange(5000,5000+n_ticks,dtype=np.uint64),
+                         adcs=rng.integers(800,1000,n_ticks).astype(np.uint16)))
+    df_wvfm = pd.DataFrame(rows).set_index(index)
+    df_det = df_wvfm.drop(columns=["timestamps","adcs"]).assign(adc_median=900.)
+    df_frh = pd.DataFrame([dict(run=1,trigger=5,sequence=0,src_id=0,trigger_timestamp_dts=5000)]).set_index(index[:4])
+    return DataFrameDict(detw_x=df_wvfm,detd_x=df_det,frh=df_frh)
+
+def test_adc_matrix_renames_APAs_first():
+    df_dict = make_df_dict()
+    #PD2HD APA_P01SU is shown as APA2
+    matrix = plot_utils.get_WIBEth_adc_matrix(df_dict,"detd_x","APA2",1)
+    assert list(matrix.channels)==[1,4]
+    assert matrix.adcs.shape==(2,8)
+    plot_utils.rename_PD2HD_APAs(df_dict)
+    assert plot_utils.get_WIBEth_adc_matrix(df_dict,"detd_x","APA2",1) is matrix
+
+def test_render_empty_adc_matrix(tmp_path):
+    from dqmtools.dqmplots.wibeth_plots import render_adc_matrix
+    matrix = plot_utils.ADCMatrix(index=None,channels=np.zeros(0,dtype=int),times=np.zeros(0,dtype=int),
+                                  adcs=np.zeros((0,0),dtype=np.int16))
+    assert render_adc_matrix(matrix,tmp_path/"empty.png") is None
+    assert not (tmp_path/"empty.png").exists()
+    matrix = plot_utils.ADCMatrix(index=None,channels=np.arange(3),times=np.arange(4),
+                                  adcs=np.arange(12,dtype=np.int16).reshape(3,4))
+    assert render_adc_matrix(matrix,tmp_path/"small.png",plot_size=None)==tmp_path/"small.png"
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("rawdatautils")
+pytest.importorskip("hdf5libs")
+
+from dataclasses import dataclass
+from typing import Any
+
+import dqmtools.dataframe_creator as dfc
+
+@dataclass
+class Row:
+    run: int
+    trigger: int
+    values: Any
+
+    @staticmethod
+    def index_names():
+        return ["run","trigger"]
+
+def make_rows(first,values):
+    return [ Row(1,first+i,v) for i, v in enumerate(values) ]
+
+def check_values(df,expected):
+    assert len(df)==len(expected)
+    for v, e in zip(df["values"],expected):
+        assert np.array_equal(v,e)
+
+def test_ragged_after_none_chunk():
+    builder = dfc.ColumnarBuilder(chunk_size=2)
+    builder.append(make_rows(0,[None,None]))
+    builder.append(make_rows(2,[np.array([1,2]),np.array([3])]))
+    check_values(builder.to_dataframe(),[[],[],[1,2],[3]])
+
+def test_ragged_after_scalar_chunk():
+    builder = dfc.ColumnarBuilder(chunk_size=2)
+    builder.append(make_rows(0,[5,None]))
+    builder.append(make_rows(2,[np.array([1,2]),None]))
+    builder.append(make_rows(4,[7,8]))
+    check_values(builder.to_dataframe(),[[5],[],[1,2],[],[7],[8]])
+
+def test_merge_ragged_into_none_columns():
+    first = dfc.ColumnarBuilder(chunk_size=2)
+    first.append(make_rows(0,[None,None]))
+    second = dfc.ColumnarBuilder(chunk_size=2)
+    second.append(make_rows(2,[np.array([1,2]),np.array([3])]))
+    third = dfc.ColumnarBuilder(chunk_size=2)
+    third.append(make_rows(4,[None,None]))
+
+    merged = dfc.ColumnarBuilder()
+    for builder in [first,second,third]:
+        merged.append_columns(*builder.export())
+    check_values(merged.to_dataframe(),[[],[],[1,2],[3],[],[]])
+
+def test_nbytes_keeps_rows_buffered():
+    builder = dfc.ColumnarBuilder(chunk_size=4)
+    builder.append(make_rows(0,[np.arange(10,dtype=np.int64)]*2))
+    #estimated from the buffered rows, without converting them
+    assert builder.get_nbytes()==2*(8+8+80)
+    assert len(builder._pending)==2
+    builder.append(make_rows(2,[np.arange(10,dtype=np.int64)]*2))
+    assert len(builder._pending)==0
+    n_converted = builder.get_nbytes()
+    builder.append(make_rows(4,[np.arange(10,dtype=np.int64)]*2))
+    assert builder.get_nbytes()==n_converted*6//4
+    assert len(builder._pending)==2
+    check_values(builder.to_dataframe(),[np.arange(10)]*6)
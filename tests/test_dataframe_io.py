@@ -0,0 +1,27 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("tables")
+
+import dqmtools.dataframe_io as dfio
+
+def make_frames(first):
+    df = pd.DataFrame({"run":[1,1],"trigger":[first,first+1],"n":[3,4]}).set_index(["run","trigger"])
+    return {"frh":df}
+
+def test_append_in_parts(tmp_path):
+    path = str(tmp_path/"out.hdf5")
+    dfio.DataFrameWriter(path,flush_records=2,verbose=False).write(make_frames(0),2)
+    dfio.DataFrameWriter(path,flush_records=2,verbose=False).write(make_frames(2),2)
+    df = dfio.load_key(path,"frh")
+    assert list(df.index.get_level_values("trigger"))==[0,1,2,3]
+
+def test_reject_mixed_layouts(tmp_path):
+    plain = str(tmp_path/"plain.hdf5")
+    dfio.DataFrameWriter(plain,verbose=False).write(make_frames(0),2)
+    with pytest.raises(ValueError,match="unflushed keys"):
+        dfio.DataFrameWriter(plain,flush_records=2,verbose=False)
+    parts = str(tmp_path/"parts.hdf5")
+    dfio.DataFrameWriter(parts,flush_mb=1,verbose=False).write(make_frames(0),2)
+    with pytest.raises(ValueError,match="written in parts"):
+        dfio.DataFrameWriter(parts,verbose=False)
@@ -0,0 +1,32 @@
+from dqmtools.dqmtools import DQMTest, DQMTestResult, DQMResultEnum, DQMTestSuite
+
+class CheckFlag(DQMTest):
+
+    def __init__(self):
+        super().__init__()
+        self.name = "CheckFlag"
+        self.input_keys = ["flag"]
+
+    def run_test(self,df_dict):
+        if df_dict["flag"]:
+            return DQMTestResult(DQMResultEnum.BAD,"flag set")
+        return DQMTestResult(DQMResultEnum.OK,"OK")
+
+def make_suite():
+    sub_suite = DQMTestSuite("Sub Tests")
+    sub_suite.register_test(CheckFlag())
+    suite = DQMTestSuite("All Tests")
+    suite.register_test(sub_suite)
+    return suite, sub_suite
+
+def test_chunk_results_cover_their_chunk():
+    suite, sub_suite = make_suite()
+    results = [ suite.run_test({"flag": flag}).result for flag in [False,True,False,False] ]
+    assert results==[DQMResultEnum.OK,DQMResultEnum.BAD,DQMResultEnum.OK,DQMResultEnum.OK]
+
+    #one BAD chunk counts once in the merged tables
+    merged = suite.get_merged_results().set_index("name")
+    assert merged.loc["Sub Tests","message"].endswith("(1/4 evaluations not OK)")
+    merged = sub_suite.get_merged_results().set_index("name")
+    assert merged.loc["CheckFlag","message"]=="flag set (1/4 evaluations not OK)"
+    assert suite.get_merged_result().result==DQMResultEnum.BAD
@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("rawdatautils")
+
+from dqmtools.dqmtools import DQMResultEnum
+from dqmtools.dqmtests import *
+
+def make_header_frame(n_frags=6):
+    index = pd.MultiIndex.from_tuples([ (1,0,0,s) for s in range(n_frags) ],names=["run","trigger","sequence","src_id"])
+    data = {}
+    for rule in CheckWIBEth_Header_Rules.default_rules:
+        vals = [ np.full(2,rule.good_value) for _ in range(n_frags) ]
+        data[f"{rule.header_field}_vals"] = vals
+        data[f"{rule.header_field}_idx"] = [ np.arange(len(v)) for v in vals ]
+    df = pd.DataFrame(data,index=index)
+    df.at[(1,0,0,2),"crc_err_vals"] = np.array([0,1,1])
+    df.at[(1,0,0,4),"lol_vals"] = np.array([],dtype=np.int64)
+    return { "deth_kHD_TPC_kWIBEth": df }
+
+def test_header_rules_match_single_checks():
+    df_dict = make_header_frame()
+    rules = CheckWIBEth_Header_Rules("HD_TPC")
+    rows = rules.do_tests("CheckWIBEth_Header_Rules_HD_TPC",df_dict)
+    assert len(rows)==len(CheckWIBEth_Header_Rules.default_rules)
+    for rule_class, row in zip(CheckWIBEth_Header_Rules.default_rules,rows):
+        test = rule_class("HD_TPC")
+        res = test.run_test(df_dict)
+        assert (row["name"],row["result"],row["message"])==(test.get_name(),res.result,res.message)
+    bad = { row["name"] for row in rows if row["result"]==DQMResultEnum.BAD }
+    assert bad=={"CheckWIBEth_CRC_Err_HD_TPC","CheckWIBEth_LOL_HD_TPC"}
@@ -0,0 +1,54 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+
+pytest.importorskip("rawdatautils")
+pytest.importorskip("hdf5libs")
+
+import dqmtools.dataframe_creator as dfc
+from dqmtools.accumulators import ChannelStatsAccumulator
+
+class FakeProcessor:
+    """
+    Stands in for RecordProcessor: one detd row per record ID.
+    """
+
+    def __init__(self,filename,channel_stats=None,**kwargs):
+        self.channel_stats = channel_stats if channel_stats is not None else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        pass
+
+    def process_records(self,rids,df_dict):
+        for rid in rids:
+            columns = { "run": np.array([1]), "trigger": np.array([rid]), "channel": np.array([rid%2]),
+                        "adc_rms": np.array([1.]), "adc_mean": np.array([900.]) }
+            builder = dfc.ColumnarBuilder()
+            builder.append_columns(["run","trigger"],columns,{},1)
+            if "detd_x" in self.channel_stats:
+                self.channel_stats["detd_x"].update(builder.to_dataframe())
+            dfc.add_columns(df_dict,"detd_x",builder.export())
+            yield rid
+
+class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+
+    def __init__(self,max_workers=None,mp_context=None):
+        super().__init__(max_workers=max_workers)
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(dfc,"RecordProcessor",FakeProcessor)
+    monkeypatch.setattr(dfc.concurrent.futures,"ProcessPoolExecutor",ThreadPoolExecutor)
+
+def test_multiprocess_without_channel_stats(fake_pool):
+    df_dict = dfc.process_records_multiprocess("file.hdf5",range(5),{},nprocs=2)
+    assert list(dfc.concatenate_dataframes(df_dict)["detd_x"].index.get_level_values("trigger"))==[0,1,2,3,4]
+
+def test_multiprocess_merges_channel_stats(fake_pool):
+    channel_stats = { "detd_x": ChannelStatsAccumulator(info_names=()) }
+    dfc.process_records_multiprocess("file.hdf5",range(5),{},nprocs=2,channel_stats=channel_stats)
+    assert list(channel_stats["detd_x"].n["adc_rms"])==[3,2]
@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("rawdatautils")
+pytest.importorskip("hdf5libs")
+
+import dqmtools.dataframe_creator as dfc
+from dqmtools.dqmtools import DQMTestSuite
+from dqmtools.dqmtests import *
+
+def test_plain_header_keys_keep_all_types():
+    unpack_filter = dfc.UnpackFilter(["frh","detd_kHD_TPC_kWIBEth"])
+    assert unpack_filter.accepts_fragment("kHD_TPC_kWIBEth")
+    assert unpack_filter.accepts_fragment("kHD_PDS_kDAPHNE")
+    assert unpack_filter.get_fragment_types() is None
+
+def test_qualified_header_keys_take_union():
+    unpack_filter = dfc.UnpackFilter(["frh_kDAPHNE","daqh_kWIBEth","detd_kHD_TPC_kWIBEth"])
+    assert unpack_filter.accepts_fragment("kHD_TPC_kWIBEth")
+    assert unpack_filter.accepts_fragment("kHD_PDS_kDAPHNE")
+    assert not unpack_filter.accepts_fragment("kHD_PDS_kDAPHNEStream")
+    assert unpack_filter.get_fragment_types()=={"kWIBEth","kDAPHNE"}
+    assert unpack_filter.get_prescales("kHD_PDS_kDAPHNE",1,1)==(None,None)
+
+def test_detector_header_keys():
+    unpack_filter = dfc.UnpackFilter(["daqh_kHD_PDS","detd_kHD_TPC_kWIBEth"])
+    assert unpack_filter.accepts_fragment("kHD_PDS_kDAPHNE")
+    assert unpack_filter.accepts_fragment("kHD_PDS_kDAPHNEStream")
+    assert not unpack_filter.accepts_fragment("kVD_BottomTPC_kWIBEth")
+    #fragment types of a detector are only known once the fragments are read
+    assert unpack_filter.get_fragment_types() is None
+
+def test_timestamp_check_reads_its_detectors():
+    unpack_filter = dfc.UnpackFilter(CheckTimestampsAligned([2,3]).get_input_keys())
+    assert unpack_filter.accepts_fragment("kHD_TPC_kWIBEth")
+    assert unpack_filter.accepts_fragment("kHD_PDS_kDAPHNEStream")
+    assert not unpack_filter.accepts_fragment("kVD_BottomTPC_kWIBEth")
+
+def test_headers_only_pds_suite():
+    #the suite dqm_analyzer runs with --headers-only --pds
+    suite_wibs = DQMTestSuite("WIBEth Tests")
+    suite_wibs.register_test(CheckAllExpectedFragmentsTest())
+    suite_wibs.register_test(CheckNFrames_WIBEth())
+    suite_wibs.register_test(CheckTimestampDiffs_WIBEth("HD_TPC"))
+    suite_wibs.register_test(CheckWIBEth_COLDDATA_Timestamps_Aligned("HD_TPC"))
+    suite_wibs.register_test(CheckWIBEth_Header_Rules("HD_TPC"))
+    suite_wibs.register_test(CheckTimestampsAligned(3),"CheckTimestampsAligned_HD_TPC")
+    suite_wibs.register_test(CheckRequestTimes_WIBEth("HD_TPC"))
+    suite_daphne = DQMTestSuite("DAPHNETests")
+    suite_daphne.register_test(CheckTimestampsAligned(2),"CheckTimestampsAligned_PDS")
+    suite_daphne.register_test(CheckEmptyFragments_DAPHNE(),"CheckEmptyFragments_DAPHNE")
+    suite = DQMTestSuite("All Tests")
+    suite.register_test(suite_wibs)
+    suite.register_test(suite_daphne)
+
+    unpack_filter = dfc.UnpackFilter.quick_look(suite.get_input_keys())
+    assert unpack_filter.needs_trh()
+    for type_string in ["kHD_TPC_kWIBEth","kHD_PDS_kDAPHNE","kHD_PDS_kDAPHNEStream"]:
+        assert unpack_filter.accepts_fragment(type_string)
+        assert unpack_filter.get_prescales(type_string,1,1)==(None,None)
+    assert not unpack_filter.accepts_subsystem(dfc.daqdataformats.SourceID.Subsystem.kTrigger)